@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from queue import Queue, Empty
+
+from loguru import logger
+
+
+class BatchStats:
+    def __init__(self, history=100):
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.queue_wait = 0.
+        self.forward_time = 0.
+        self.fill_ratio = 0.
+        self.recent = deque(maxlen=history)
+
+    def update(self, size, max_batch_size, queue_waits, forward_time):
+        record = {
+            'size': size,
+            'fill_ratio': size / max_batch_size,
+            'queue_wait_ms': max(queue_waits) * 1000,
+            'forward_ms': forward_time * 1000,
+        }
+        with self.lock:
+            self.batches += 1
+            self.requests += size
+            self.queue_wait += sum(queue_waits)
+            self.forward_time += forward_time
+            self.fill_ratio += record['fill_ratio']
+            self.recent.append(record)
+        return record
+
+    def to_dict(self):
+        with self.lock:
+            batches = max(self.batches, 1)
+            return {
+                'batches': self.batches,
+                'requests': self.requests,
+                'avg_batch_size': self.requests / batches,
+                'avg_fill_ratio': self.fill_ratio / batches,
+                'avg_queue_wait_ms': self.queue_wait / max(self.requests, 1) * 1000,
+                'avg_forward_ms': self.forward_time / batches * 1000,
+                'recent': list(self.recent),
+            }
+
+
+class MicroBatcher:
+    '''
+    Coalesce concurrent requests into batches for a model.
+    A batch is flushed once it holds max_batch_size items, or max_wait_ms
+    after its first item was queued, whichever comes first.
+    batch_fn takes a list of inputs and returns a list of results in the same order.
+    '''
+
+    def __init__(self, name, batch_fn, max_batch_size=8, max_wait_ms=10):
+        assert max_batch_size > 0, 'max_batch_size must be positive'
+        self.name = name
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = BatchStats()
+        self._queue = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    def submit(self, item) -> Future:
+        self._ensure_started()
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def _ensure_started(self):
+        # started lazily so that the worker thread lives in the serving process
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._loop, name=f'batcher-{self.name}', daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # past the deadline, still take whatever is already queued
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            self._run(batch)
+
+    def _run(self, batch):
+        items = [item for item, _, _ in batch]
+        futures = [future for _, future, _ in batch]
+        start = time.perf_counter()
+        queue_waits = [start - enqueued for _, _, enqueued in batch]
+        try:
+            results = self.batch_fn(items)
+            if len(results) != len(items):
+                raise RuntimeError(
+                    f'{self.name}: batch_fn returned {len(results)} results for {len(items)} inputs')
+        except Exception as e:
+            logger.exception("Batch inference failed for {}", self.name)
+            for future in futures:
+                future.set_exception(e)
+            return
+        forward_time = time.perf_counter() - start
+
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+        record = self.stats.update(
+            len(batch), self.max_batch_size, queue_waits, forward_time)
+        logger.debug("{} batch: size={size}, fill={fill_ratio:.2f}, queue wait={queue_wait_ms:.1f}ms, forward={forward_ms:.1f}ms",
+                     self.name, **record)
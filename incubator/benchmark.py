@@ -0,0 +1,843 @@
+'''
+Benchmarks for the incubator inference path, run from the incubator directory:
+
+    python benchmark.py backends --onnx comictextdetector.pt.onnx
+    python benchmark.py startup --onnx comictextdetector.pt.onnx
+    python benchmark.py refine --blocks 30 --workers 1,2,4,8
+    python benchmark.py merge --windows 50
+    python benchmark.py group --blocks 60
+    python benchmark.py assign --lines 10,50,100,500
+    python benchmark.py textlines --lines 50,200,500
+    python benchmark.py lines --pages 20
+    python benchmark.py nms --candidates 100,1000,5000
+    python benchmark.py batch --sizes 1,2,4,8
+    python benchmark.py optimize --input-size 1024
+    python benchmark.py dbhead --onnx comictextdetector.pt.onnx --onnx-shrink comictextdetector.shrink.onnx
+    python benchmark.py precision --pages data/examples --calibration data/calibration
+    python benchmark.py transport --blocks 60
+    python benchmark.py serve --workers 1,2,4,8 --model comictextdetector.pt.onnx
+'''
+import argparse
+import base64
+import ctypes
+import gc
+import io
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+import cv2
+import numpy as np
+
+from tests.conftest import merge_textlines_loop, scattered_textlines, synthetic_detections, synthetic_line_map, \
+    synthetic_yolo_output
+
+SAMPLE_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'KyubeyMadokaMagica.png')
+DEFAULT_MODEL_URL = 'https://github.com/zyddnys/manga-image-translator/releases/download/beta-0.3/comictextdetector.pt'
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # peak rss, in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def trim_memory():
+    # memory freed since, e.g. by the int8 calibration, is handed back to the system before measuring
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def timeit(fn, runs=10, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return np.array(times)
+
+
+def summary(times):
+    return {
+        'mean_ms': times.mean() * 1000,
+        'p50_ms': np.percentile(times, 50) * 1000,
+        'min_ms': times.min() * 1000,
+    }
+
+
+def print_table(rows):
+    if len(rows) == 0:
+        return
+    columns = list(rows[0].keys())
+    cells = [[f'{v:.2f}' if isinstance(v, float) else str(v) for v in row.values()] for row in rows]
+    widths = [max(len(c), *(len(r[i]) for r in cells)) for i, c in enumerate(columns)]
+    print('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in cells:
+        print('  '.join(v.ljust(w) for v, w in zip(r, widths)))
+
+
+def run_isolated(fn, *args):
+    # a fresh interpreter per case, so resident memory is not shared between cases
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(fn, args)
+
+
+def default_model_path():
+    from helper import get_cache_path_by_url
+    return get_cache_path_by_url(DEFAULT_MODEL_URL)
+
+
+def bench_backend(backend, model_path, input_size, runs, ort_options=None):
+    from comic_text_detector.inference import TextDetector
+
+    img = cv2.imread(SAMPLE_IMAGE)
+    rss_start = rss_mb()
+    start = time.perf_counter()
+    detector = TextDetector(model_path, input_size=input_size, backend=backend, ort_options=ort_options)
+    load_time = time.perf_counter() - start
+    rss_loaded = rss_mb()
+    times = timeit(lambda: detector(img), runs)
+
+    return {
+        'backend': backend,
+        'load_s': load_time,
+        **summary(times),
+        'rss_model_mb': rss_loaded - rss_start,
+        'rss_total_mb': rss_mb(),
+    }
+
+
+def cmd_backends(args):
+    cases = [('torch', args.model or default_model_path(), None)]
+    if args.onnx is not None:
+        ort_options = {
+            'num_sessions': args.sessions,
+            'intra_op_threads': args.threads,
+        }
+        cases += [
+            ('opencv', args.onnx, None),
+            ('onnxruntime', args.onnx, ort_options),
+        ]
+    rows = [run_isolated(bench_backend, backend, model_path, args.input_size, args.runs, ort_options)
+            for backend, model_path, ort_options in cases]
+    print_table(rows)
+
+
+def bench_startup(profile, model_path, input_size, server):
+    # cold start in a fresh interpreter: imports, model load and the first detection
+    rss_start = rss_mb()
+    start = time.perf_counter()
+    if server:
+        os.environ['INCUBATOR_PROFILE'] = profile
+        os.environ['INCUBATOR_CTD_MODEL'] = model_path
+        os.environ['INCUBATOR_DEFER_START'] = '1'
+        import main
+        import_time = time.perf_counter() - start
+        detector = main.ctd_model.get()
+    else:
+        from ctd import ComicTextDetector
+        import_time = time.perf_counter() - start
+        detector = ComicTextDetector(model_path, detector_input_size=input_size)
+    load_time = time.perf_counter() - start - import_time
+    detector(cv2.imread(SAMPLE_IMAGE))
+    first_time = time.perf_counter() - start - import_time - load_time
+
+    return {
+        'profile': profile,
+        'backend': detector.text_detector.backend,
+        'import_s': import_time,
+        'load_s': load_time,
+        'first_detect_s': first_time,
+        'startup_s': import_time + load_time + first_time,
+        'rss_mb': rss_mb() - rss_start,
+        'torch_imported': 'torch' in sys.modules,
+    }
+
+
+def cmd_startup(args):
+    cases = [('full', args.model or default_model_path()), ('lite', args.onnx)]
+    rows = [run_isolated(bench_startup, profile, model_path, args.input_size, args.server)
+            for profile, model_path in cases]
+    print_table(rows)
+
+
+def synthetic_page(num_blocks, seed=0):
+    # a page of text bubbles with a slightly noisy predicted mask, no model needed
+    from comic_text_detector.utils.textblock import TextBlock
+
+    rng = np.random.default_rng(seed)
+    cols = 5
+    rows = (num_blocks + cols - 1) // cols
+    bw, bh = 300, 220
+    img = np.full((rows * bh + 40, cols * bw + 40, 3), 235, np.uint8)
+    mask = np.zeros(img.shape[:2], np.uint8)
+    blk_list = []
+    for ii in range(num_blocks):
+        x = 20 + ii % cols * bw + 20
+        y = 20 + ii // cols * bh + 20
+        cv2.ellipse(img, (x + 120, y + 80), (135, 95), 0, 0, 360, (255, 255, 255), -1)
+        cv2.ellipse(img, (x + 120, y + 80), (135, 95), 0, 0, 360, (0, 0, 0), 2)
+        color = tuple(int(c) for c in rng.integers(0, 80, 3))
+        for jj in range(4):
+            text = ''.join(chr(c) for c in rng.integers(65, 91, 8))
+            org = (x + 20, y + 40 + jj * 30)
+            cv2.putText(img, text, org, cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 2, cv2.LINE_AA)
+            cv2.putText(mask, text, org, cv2.FONT_HERSHEY_SIMPLEX, 0.8, 255, 3, cv2.LINE_AA)
+        blk_list.append(TextBlock([x + 10, y + 10, x + 230, y + 150]))
+    noise = rng.integers(0, 40, mask.shape, dtype=np.uint8)
+    mask = cv2.add(cv2.GaussianBlur(mask, (5, 5), 0), noise)
+    return img, mask, blk_list
+
+
+def bench_refine(num_blocks, num_workers, runs):
+    from comic_text_detector.utils.textmask import refine_mask
+
+    img, mask, blk_list = synthetic_page(num_blocks)
+    serial = refine_mask(img, mask, blk_list)
+    if num_workers > 1:
+        with ThreadPoolExecutor(num_workers) as pool:
+            result = refine_mask(img, mask, blk_list, pool=pool)
+            times = timeit(lambda: refine_mask(img, mask, blk_list, pool=pool), runs)
+    else:
+        result = serial
+        times = timeit(lambda: refine_mask(img, mask, blk_list), runs)
+    return {
+        'blocks': num_blocks,
+        'workers': num_workers,
+        **summary(times),
+        'identical': bool((serial == result).all()),
+    }
+
+
+def cmd_refine(args):
+    workers = sorted(set(int(x) for x in args.workers.split(',')))
+    rows = [bench_refine(args.blocks, num_workers, args.runs) for num_workers in workers]
+    for row in rows:
+        row['speedup'] = rows[0]['mean_ms'] / row['mean_ms']
+    print_table(rows)
+
+
+def merge_mask_list_loop(mask_list, pred_mask, pred_thresh=30, refine_mode=0):
+    # the per-component loop merge_mask_list used before, kept as the reference
+    mask_list.sort(key=lambda x: x[1])
+    if pred_thresh > 0:
+        element = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3), (1, 1))
+        pred_mask = cv2.erode(pred_mask, element, iterations=1)
+        _, pred_mask = cv2.threshold(pred_mask, 60, 255, cv2.THRESH_BINARY)
+
+    def merge_component(mask_merged, labels, label_index, stat):
+        x, y, w, h, area = stat
+        x1, y1, x2, y2 = x, y, x+w, y+h
+        label_local = labels[y1: y2, x1: x2]
+        tmp_merged = np.zeros_like(label_local, np.uint8)
+        tmp_merged[np.where(label_local == label_index)] = 255
+        tmp_merged = cv2.bitwise_or(mask_merged[y1: y2, x1: x2], tmp_merged)
+        xor_merged = cv2.bitwise_xor(tmp_merged, pred_mask[y1: y2, x1: x2]).sum()
+        xor_origin = cv2.bitwise_xor(mask_merged[y1: y2, x1: x2], pred_mask[y1: y2, x1: x2]).sum()
+        if xor_merged < xor_origin:
+            mask_merged[y1: y2, x1: x2] = tmp_merged
+
+    mask_merged = np.zeros_like(pred_mask)
+    for candidate_mask, _ in mask_list:
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(candidate_mask, 8, cv2.CV_16U)
+        for label_index in range(1, num_labels):
+            if stats[label_index][2] * stats[label_index][3] >= 3:
+                merge_component(mask_merged, labels, label_index, stats[label_index])
+
+    if refine_mode == 0:
+        mask_merged = cv2.dilate(mask_merged, np.ones((3, 3), np.uint8), iterations=1)
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(255-mask_merged, 8, cv2.CV_16U)
+    sorted_area = np.sort(stats[:, -1])
+    area_thresh = sorted_area[-2] if len(sorted_area) > 1 else sorted_area[-1]
+    for label_index in range(num_labels):
+        if stats[label_index][-1] < area_thresh:
+            merge_component(mask_merged, labels, label_index, stats[label_index])
+    return mask_merged
+
+
+def dense_text_windows(num_windows, seed=0):
+    # candidate masks of windows packed with small glyphs, as refine_mask builds them
+    from comic_text_detector.utils.textmask import get_topk_masklist, get_otsuthresh_masklist
+
+    rng = np.random.default_rng(seed)
+    windows = []
+    for _ in range(num_windows):
+        im = np.full((260, 220, 3), 255, np.uint8)
+        msk = np.zeros(im.shape[:2], np.uint8)
+        for jj in range(14):
+            text = ''.join(chr(c) for c in rng.integers(33, 127, 22))
+            org = (4, 16 + jj * 17)
+            cv2.putText(im, text, org, cv2.FONT_HERSHEY_PLAIN, 0.9, (20, 20, 20), 1)
+            cv2.putText(msk, text, org, cv2.FONT_HERSHEY_PLAIN, 0.9, 255, 2)
+        im = cv2.add(im, rng.integers(0, 30, im.shape, dtype=np.uint8))
+        msk = cv2.add(msk, rng.integers(0, 40, msk.shape, dtype=np.uint8))
+        mask_list = get_topk_masklist(im, msk) + get_otsuthresh_masklist(im, msk)
+        windows.append((mask_list, msk))
+    return windows
+
+
+def cmd_merge(args):
+    from comic_text_detector.utils.textmask import merge_mask_list
+
+    windows = dense_text_windows(args.windows)
+    identical = all((merge_mask_list(list(mask_list), msk) == merge_mask_list_loop(list(mask_list), msk)).all()
+                    for mask_list, msk in windows)
+    rows = []
+    for name, fn in (('loop', merge_mask_list_loop), ('bincount', merge_mask_list)):
+        times = timeit(lambda: [fn(list(mask_list), msk) for mask_list, msk in windows], args.runs)
+        rows.append({'impl': name, 'windows': args.windows, **summary(times)})
+    for row in rows:
+        row['speedup'] = rows[0]['mean_ms'] / row['mean_ms']
+    print_table(rows)
+    print('identical:', identical)
+
+
+def cmd_group(args):
+    from comic_text_detector.utils.textblock import group_output
+
+    blks, lines, im_w, im_h, mask = synthetic_detections(args.blocks)
+    times = timeit(lambda: group_output(blks, lines, im_w, im_h, mask), args.runs)
+    tracemalloc.start()
+    blk_list = group_output(blks, lines, im_w, im_h, mask)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print_table([{
+        'lines': len(lines),
+        'blocks': len(blk_list),
+        **summary(times),
+        'retained_kb': retained / 1024,
+        'peak_kb': peak / 1024,
+    }])
+
+
+def assign_textlines_loop(lines, blk_xyxy, bbox_score_thresh=0.4):
+    # the per line, per block loop group_output used before, kept as the reference
+    from comic_text_detector.utils.imgproc_utils import union_area
+
+    bbox_idx = []
+    for line in lines:
+        bx1, bx2 = line[:, 0].min(), line[:, 0].max()
+        by1, by2 = line[:, 1].min(), line[:, 1].max()
+        bbox_score, best = -1, -1
+        line_area = (by2-by1) * (bx2-bx1)
+        for jj, xyxy in enumerate(blk_xyxy):
+            score = union_area(xyxy, [bx1, by1, bx2, by2]) / line_area
+            if bbox_score < score:
+                bbox_score, best = score, jj
+        bbox_idx.append(best if bbox_score > bbox_score_thresh else -1)
+    return np.array(bbox_idx, np.int64)
+
+
+def cmd_assign(args):
+    from comic_text_detector.utils.textblock import assign_textlines
+
+    rows = []
+    for num_lines in sorted(set(int(x) for x in args.lines.split(','))):
+        # about 3.5 lines per block
+        blks, lines, _, _, _ = synthetic_detections(max(num_lines * 2 // 7, 1))
+        lines = np.concatenate([lines] * (num_lines // len(lines) + 1))[:num_lines]
+        blk_xyxy = blks[0].tolist()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            identical = np.array_equal(assign_textlines(lines, blk_xyxy)[1], assign_textlines_loop(lines, blk_xyxy))
+            loop = summary(timeit(lambda: assign_textlines_loop(lines, blk_xyxy), args.runs))
+        matrix = summary(timeit(lambda: assign_textlines(lines, blk_xyxy), args.runs))
+        rows.append({
+            'lines': num_lines,
+            'blocks': len(blk_xyxy),
+            'loop_ms': loop['mean_ms'],
+            'matrix_ms': matrix['mean_ms'],
+            'speedup': loop['mean_ms'] / matrix['mean_ms'],
+            'identical': identical,
+        })
+    print_table(rows)
+
+
+def cmd_textlines(args):
+    # equivalence with the loop is checked by tests/test_postprocess.py
+    from comic_text_detector.utils.textblock import merge_textlines
+
+    rows = []
+    for num_lines in sorted(set(int(x) for x in args.lines.split(','))):
+        batch = scattered_textlines(num_lines)
+        merged = merge_textlines(batch.to_blocks())
+        loop = summary(timeit(lambda: merge_textlines_loop(batch.to_blocks()), args.runs))
+        grid = summary(timeit(lambda: merge_textlines(batch.to_blocks()), args.runs))
+        rows.append({
+            'lines': num_lines,
+            'blocks': len(merged),
+            'loop_ms': loop['mean_ms'],
+            'grid_ms': grid['mean_ms'],
+            'speedup': loop['mean_ms'] / grid['mean_ms'],
+        })
+    print_table(rows)
+
+
+def cmd_lines(args):
+    # equivalence with the original boxes_from_bitmap is checked by tests/test_postprocess.py
+    from comic_text_detector.inference import StageTimer, TextDetector
+    from comic_text_detector.utils.db_utils import SegDetectorRepresenter
+
+    seg_rep = SegDetectorRepresenter(thresh=0.3)
+    box_thresh = TextDetector.box_thresh
+    rows = []
+    for page in range(args.pages):
+        lines_map = synthetic_line_map(page, noise=args.noise)[None, None]
+        # every contour unclipped and filtered afterwards, as the detector did before
+        start = time.perf_counter()
+        _, all_scores = seg_rep(lines_map.shape[2:], lines_map)
+        all_ms = (time.perf_counter() - start) * 1000
+        timer = StageTimer()
+        lines, scores = seg_rep(lines_map.shape[2:], lines_map, min_score=box_thresh, timer=timer)
+        rows.append({
+            'page': page,
+            'contours': len(all_scores[0]),
+            'lines': len(lines[0]),
+            'all_ms': all_ms,
+            **{f'{stage}_ms': t * 1000 for stage, t in timer.times.items()},
+            'score_first_ms': sum(timer.times.values()) * 1000,
+        })
+    print_table(rows)
+
+
+def cmd_nms(args):
+    # equivalence with the torchvision path is checked by tests/test_postprocess.py
+    from comic_text_detector.utils.nms import non_max_suppression
+
+    try:
+        import torch
+        from comic_text_detector.utils.yolov5_utils import non_max_suppression as non_max_suppression_torch
+    except ImportError:
+        torch = None
+    rows = []
+    for num_candidates in sorted(set(int(x) for x in args.candidates.split(','))):
+        prediction = synthetic_yolo_output(num_candidates)
+        dets = non_max_suppression(prediction, 0.4, 0.35)[0]
+        row = {'candidates': num_candidates, 'kept': len(dets),
+               'numpy_ms': summary(timeit(lambda: non_max_suppression(prediction, 0.4, 0.35), args.runs))['mean_ms']}
+        if torch is not None:
+            # the torchvision path postprocess_yolo used before
+            row['torch_ms'] = summary(timeit(
+                lambda: non_max_suppression_torch(torch.from_numpy(prediction), 0.4, 0.35), args.runs))['mean_ms']
+        rows.append(row)
+    print_table(rows)
+
+
+def same_detections(a, b):
+    # (mask, mask_refined, blk_list) results of the same page
+    return np.array_equal(a[0], b[0]) and np.array_equal(a[2].xyxy, b[2].xyxy) and np.array_equal(a[2].lines, b[2].lines)
+
+
+def cmd_batch(args):
+    from comic_text_detector.inference import TextDetector
+
+    model_path = args.model or default_model_path()
+    detector = TextDetector(model_path, input_size=args.input_size, backend=args.backend)
+    img = cv2.imread(args.image or SAMPLE_IMAGE)
+    outputs = ['mask', 'blocks', 'lines']
+    single = detector(img, outputs=outputs)
+
+    rows = []
+    for batch_size in sorted(set(int(x) for x in args.sizes.split(','))):
+        pages = [img] * batch_size
+        results = detector.batch(pages, outputs=outputs)
+        times = timeit(lambda: detector.batch(pages, outputs=outputs), args.runs)
+        rows.append({
+            'batch': batch_size,
+            'batch_ms': times.mean() * 1000,
+            'page_ms': times.mean() * 1000 / batch_size,
+            'pages_per_s': batch_size / times.mean(),
+            'identical': all(same_detections(single, result) for result in results),
+        })
+    print(f'{detector.backend} backend, {model_path}')
+    print_table(rows)
+
+
+def cmd_optimize(args):
+    # equivalence with the eager network is checked by tests/test_basemodel.py
+    import torch
+    from comic_text_detector.inference import preprocess_img
+    from comic_text_detector.basemodel import TextDetBase
+    from comic_text_detector.utils.imgproc_utils import images_to_blob
+
+    model_path = args.model or default_model_path()
+    img_in = preprocess_img(cv2.imread(args.image or SAMPLE_IMAGE), (args.input_size, args.input_size), to_tensor=False)[0]
+    blob = torch.from_numpy(images_to_blob([img_in] * args.batch_size))
+
+    eager = TextDetBase(model_path).eval()
+    optimized = TextDetBase(model_path, optimize=True).eval()
+    rows = []
+    with torch.no_grad():
+        start = time.perf_counter()
+        optimized(blob)
+        freeze_time = time.perf_counter() - start
+        for name, net in (('eager', eager), ('optimized', optimized)):
+            rows.append({'model': name, **summary(timeit(lambda: net(blob), args.runs))})
+
+    print_table(rows)
+    print(f'first optimized forward (tracing and freezing) {freeze_time * 1000:.0f}ms')
+
+
+def cmd_dbhead(args):
+    import torch
+    from comic_text_detector.inference import TextDetector
+
+    img = cv2.imread(args.image or SAMPLE_IMAGE)
+    rows = []
+    detector = TextDetector(args.model or default_model_path(), input_size=args.input_size)
+    for shrink_only in (False, True):
+        detector.net.text_det.shrink_only = shrink_only
+        with torch.no_grad():
+            rows.append({'backend': 'torch', 'threshold_branch': not shrink_only,
+                         **summary(timeit(lambda: detector(img, outputs=['mask', 'blocks']), args.runs))})
+    # the two exports of utils/export.py, the default and --shrink-only
+    for backend in ('opencv', 'onnxruntime'):
+        for model_path, shrink_only in ((args.onnx, False), (args.onnx_shrink, True)):
+            if model_path is None:
+                continue
+            detector = TextDetector(model_path, input_size=args.input_size, backend=backend)
+            rows.append({'backend': backend, 'threshold_branch': not shrink_only,
+                         **summary(timeit(lambda: detector(img, outputs=['mask', 'blocks']), args.runs))})
+    print_table(rows)
+
+
+def bench_precision(precision, model_path, input_size, page_paths, calibration_dir, calibration_pages, runs):
+    # load time, latency and memory of one precision mode in a fresh interpreter, with its detections for the accuracy
+    from comic_text_detector.inference import TextDetector
+
+    imgs = [cv2.imread(path) for path in page_paths]
+    rss_start = rss_mb()
+    start = time.perf_counter()
+    detector = TextDetector(model_path, input_size=input_size, optimize=True, precision=precision,
+                            calibration_dir=calibration_dir, calibration_pages=calibration_pages)
+    load_time = time.perf_counter() - start
+    outputs = ['blocks', 'lines']
+    detections = [detector(img, outputs=outputs)[2] for img in imgs]
+    times = timeit(lambda: [detector(img, outputs=outputs) for img in imgs], runs, warmup=0) / len(imgs)
+    trim_memory()
+
+    return {
+        'precision': detector.precision,
+        'load_s': load_time,
+        **summary(times),
+        'rss_mb': rss_mb() - rss_start,
+    }, [(blk_list.xyxy, blk_list.lines) for blk_list in detections]
+
+
+def detection_agreement(reference, detections):
+    # reference and detections: per page (block boxes, line polygons). The fp32 detections are the ground truth,
+    # a block or line matches at IoU > 0.5, the IoU is the mean over matched pairs
+    from comic_text_detector.utils.db_utils import DetectionIoUEvaluator
+
+    evaluator = DetectionIoUEvaluator()
+
+    def quads(boxes):
+        return [np.array([[x1, y1], [x2, y1], [x2, y2], [x1, y2]]) for x1, y1, x2, y2 in boxes]
+
+    row = {}
+    for name, index, to_polygons in (('block', 0, quads), ('line', 1, list)):
+        results = []
+        ious = []
+        for expected, detected in zip(reference, detections):
+            result = evaluator.evaluate_image([{'points': p, 'ignore': False} for p in to_polygons(expected[index])],
+                                              [{'points': p} for p in to_polygons(detected[index])])
+            results.append(result)
+            if len(result['iouMat']) > 0:
+                ious += [result['iouMat'][pair['gt']][pair['det']] for pair in result['pairs']]
+        metrics = evaluator.combine_results(results)
+        # nothing detected by either, nothing to compare
+        empty = all(result['gtCare'] == 0 and result['detCare'] == 0 for result in results)
+        row[f'{name}_hmean'] = float('nan') if empty else metrics['hmean']
+        row[f'{name}_iou'] = float(np.mean(ious)) if ious else float('nan')
+    return row
+
+
+def cmd_precision(args):
+    from comic_text_detector.utils.io_utils import find_all_imgs
+
+    model_path = args.model or default_model_path()
+    page_paths = find_all_imgs(args.pages, abs_path=True) if args.pages else [SAMPLE_IMAGE]
+    rows = []
+    reference = None
+    for precision in args.modes.split(','):
+        row, detections = run_isolated(bench_precision, precision, model_path, args.input_size, page_paths,
+                                       args.calibration or args.pages, args.calibration_pages, args.runs)
+        if reference is None:
+            reference = detections
+        rows.append({**row, **detection_agreement(reference, detections)})
+    print(f'{len(page_paths)} pages, accuracy against the first mode')
+    print_table(rows)
+
+
+def cmd_transport(args):
+    from werkzeug.test import EnvironBuilder
+    from werkzeug.wrappers import Request
+    from ctd import format_blocks
+    from comic_text_detector.utils.textblock import group_output
+    from transport import decode_bgr, pack_blocks, pack_pixels, unpack_blocks
+
+    # request side: the page as a multipart form file, as the raw encoded body, as raw pixels
+    img, _, _ = synthetic_page(args.blocks)
+    png = cv2.imencode('.png', img)[1].tobytes()
+    pixels = pack_pixels(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+
+    def multipart():
+        environ = EnvironBuilder(method='POST', data={'image': (io.BytesIO(png), 'page.png')}).get_environ()
+        return decode_bgr(Request(environ).files['image'].read())
+
+    def raw(body, content_type):
+        environ = EnvironBuilder(method='POST', data=body, content_type=content_type).get_environ()
+        return decode_bgr(Request(environ).get_data())
+
+    rows = []
+    for name, fn, size in [('multipart png', multipart, len(png)),
+                           ('raw png', lambda: raw(png, 'image/png'), len(png)),
+                           ('raw pixels', lambda: raw(pixels, 'application/x-incubator-pixels'), len(pixels))]:
+        assert np.array_equal(fn(), img)
+        rows.append({'request': name, 'body_kb': size / 1024, **summary(timeit(fn, args.runs))})
+    print_table(rows)
+
+    # response side: JSON with base64 png masks against the packed arrays
+    blks, lines, im_w, im_h, mask = synthetic_detections(args.blocks)
+    blk_list = group_output(blks, lines, im_w, im_h, mask)
+
+    def to_json(with_lines, with_mask):
+        result = {'blks': format_blocks(blk_list, lines=with_lines)}
+        if with_mask:
+            result['mask'] = base64.b64encode(cv2.imencode('.png', mask)[1].tobytes()).decode()
+        return json.dumps(result).encode()
+
+    rows = []
+    for outputs, with_lines, with_mask in [('blocks', False, False), ('blocks,lines', True, False),
+                                           ('blocks,lines,mask', True, True)]:
+        packed = pack_blocks(blk_list, lines=with_lines, mask=mask if with_mask else None)
+        unpacked = unpack_blocks(packed)
+        assert np.array_equal(unpacked['boxes'], blk_list.xyxy) and np.array_equal(unpacked['vertical'], blk_list.vertical)
+        if with_lines:
+            assert np.array_equal(unpacked['lines'], blk_list.lines)
+        encoded = to_json(with_lines, with_mask)
+        rows.append({
+            'outputs': outputs,
+            'json_ms': summary(timeit(lambda: to_json(with_lines, with_mask), args.runs))['mean_ms'],
+            'json_kb': len(encoded) / 1024,
+            'packed_ms': summary(timeit(lambda: pack_blocks(blk_list, lines=with_lines, mask=mask if with_mask else None),
+                                        args.runs))['mean_ms'],
+            'packed_kb': len(packed) / 1024,
+        })
+    print_table(rows)
+
+
+def post_image(url, data, timeout=60):
+    # multipart/form-data with the page as the image file field
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="page.png"\r\n'
+            f'Content-Type: image/png\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    req = Request(url, data=body, headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    start = time.perf_counter()
+    try:
+        with urlopen(req, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except HTTPError as e:
+        status = e.code
+    return status, time.perf_counter() - start
+
+
+def wait_healthy(url, server=None, timeout=600):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f'server exited with code {server.returncode}')
+        try:
+            with urlopen(url + '/health', timeout=5) as response:
+                if response.status == 200:
+                    return
+        except (HTTPError, URLError, OSError):
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f'{url} not healthy after {timeout}s')
+
+
+def load_test(url, data, num_requests, concurrency):
+    # concurrency clients sending num_requests pages in total, as fast as they are answered
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(lambda _: post_image(url + '/magic/comic-text-detector', data), range(num_requests)))
+    elapsed = time.perf_counter() - start
+    times = np.array([t for status, t in results if status == 200])
+    row = {
+        'ok': len(times),
+        'busy_503': sum(status == 503 for status, _ in results),
+        'errors': sum(status not in (200, 503) for status, _ in results),
+        'throughput_rps': len(times) / elapsed,
+    }
+    for q in (50, 95, 99):
+        row[f'p{q}_ms'] = np.percentile(times, q) * 1000 if len(times) else float('nan')
+    return row
+
+
+def cmd_serve(args):
+    with open(args.image or SAMPLE_IMAGE, 'rb') as f:
+        data = f.read()
+    if args.url is not None:
+        wait_healthy(args.url)
+        print_table([{'url': args.url, **load_test(args.url, data, args.requests, args.concurrency)}])
+        return
+
+    # a fresh serve.py per worker count, caching off so every request runs the models
+    env = dict(os.environ, INCUBATOR_CACHE_MB='0', INCUBATOR_PROFILE=args.profile)
+    if args.model is not None:
+        env['INCUBATOR_CTD_MODEL'] = args.model
+    if args.max_queue is not None:
+        env['INCUBATOR_MAX_QUEUE'] = str(args.max_queue)
+    url = f'http://127.0.0.1:{args.port}'
+    rows = []
+    for workers in [int(w) for w in args.workers.split(',')]:
+        server = subprocess.Popen([sys.executable, 'serve.py', '--workers', str(workers), '--port', str(args.port)],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_healthy(url, server)
+            # one round outside the measurement, so every worker has served a request
+            load_test(url, data, workers, workers)
+            rows.append({'workers': workers, **load_test(url, data, args.requests, args.concurrency)})
+        finally:
+            server.terminate()
+            server.wait()
+    print_table(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='incubator benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('backends', help='latency and memory of the detector backends')
+    p.add_argument('--model', help='torch checkpoint, defaults to the cached comictextdetector.pt')
+    p.add_argument('--onnx', help='exported onnx model, enables the opencv and onnxruntime backends')
+    p.add_argument('--input-size', type=int, default=1024)
+    p.add_argument('--runs', type=int, default=10)
+    p.add_argument('--sessions', type=int, default=1, help='onnxruntime session pool size')
+    p.add_argument('--threads', type=int, default=0, help='onnxruntime intra-op threads, 0 for default')
+    p.set_defaults(func=cmd_backends)
+
+    p = subparsers.add_parser('startup', help='cold start time and memory of the full and lite (onnx, no torch) profiles')
+    p.add_argument('--model', help='torch checkpoint of the full profile, defaults to the cached comictextdetector.pt')
+    p.add_argument('--onnx', required=True, help='exported onnx model of the lite profile')
+    p.add_argument('--input-size', type=int, default=1024)
+    p.add_argument('--server', action='store_true', help='import the whole server, full needs manga ocr installed')
+    p.set_defaults(func=cmd_startup)
+
+    p = subparsers.add_parser('refine', help='mask refinement latency by worker count, on a synthetic page')
+    p.add_argument('--blocks', type=int, default=30)
+    p.add_argument('--workers', default=f'1,2,4,{os.cpu_count()}', help='comma separated worker counts')
+    p.add_argument('--runs', type=int, default=10)
+    p.set_defaults(func=cmd_refine)
+
+    p = subparsers.add_parser('merge', help='merge_mask_list against the per-component loop, on dense text windows')
+    p.add_argument('--windows', type=int, default=50)
+    p.add_argument('--runs', type=int, default=5)
+    p.set_defaults(func=cmd_merge)
+
+    p = subparsers.add_parser('group', help='group_output latency and memory on a synthetic page')
+    p.add_argument('--blocks', type=int, default=60)
+    p.add_argument('--runs', type=int, default=10)
+    p.set_defaults(func=cmd_group)
+
+    p = subparsers.add_parser('assign', help='line to block assignment against the per line loop')
+    p.add_argument('--lines', default='10,50,100,200,500', help='comma separated line counts')
+    p.add_argument('--runs', type=int, default=10)
+    p.set_defaults(func=cmd_assign)
+
+    p = subparsers.add_parser('textlines', help='merge_textlines against the all pairs loop, on scattered lines')
+    p.add_argument('--lines', default='50,200,500', help='comma separated line counts')
+    p.add_argument('--runs', type=int, default=5)
+    p.set_defaults(func=cmd_textlines)
+
+    p = subparsers.add_parser('lines', help='text line extraction from the DB map, per page stage breakdown')
+    p.add_argument('--pages', type=int, default=20)
+    p.add_argument('--noise', type=float, default=0.3, help='speckle amplitude, more noise leaves more small contours')
+    p.set_defaults(func=cmd_lines)
+
+    p = subparsers.add_parser('nms', help='numpy nms of the block detections, against the torchvision path if installed')
+    p.add_argument('--candidates', default='100,1000,5000', help='comma separated counts of boxes above the threshold')
+    p.add_argument('--runs', type=int, default=10)
+    p.set_defaults(func=cmd_nms)
+
+    p = subparsers.add_parser('batch', help='per page latency and throughput of batched detection by batch size')
+    p.add_argument('--model', help='detector model, defaults to the cached comictextdetector.pt')
+    p.add_argument('--backend', help='detector backend, by model file extension by default')
+    p.add_argument('--input-size', type=int, default=1024)
+    p.add_argument('--sizes', default='1,2,4,8', help='comma separated batch sizes')
+    p.add_argument('--image', help=f'page to detect, defaults to {os.path.basename(SAMPLE_IMAGE)}')
+    p.add_argument('--runs', type=int, default=5)
+    p.set_defaults(func=cmd_batch)
+
+    p = subparsers.add_parser('optimize', help='eager against fused and frozen torch detector, latency')
+    p.add_argument('--model', help='torch checkpoint, defaults to the cached comictextdetector.pt')
+    p.add_argument('--input-size', type=int, default=1024)
+    p.add_argument('--batch-size', type=int, default=1)
+    p.add_argument('--image', help=f'page to detect, defaults to {os.path.basename(SAMPLE_IMAGE)}')
+    p.add_argument('--runs', type=int, default=10)
+    p.set_defaults(func=cmd_optimize)
+
+    p = subparsers.add_parser('dbhead', help='detection latency with and without the DB threshold branch')
+    p.add_argument('--model', help='torch checkpoint, defaults to the cached comictextdetector.pt')
+    p.add_argument('--onnx', help='onnx export with the threshold branch')
+    p.add_argument('--onnx-shrink', help='onnx export without it, utils/export.py --shrink-only')
+    p.add_argument('--input-size', type=int, default=1024)
+    p.add_argument('--image', help=f'page to detect, defaults to {os.path.basename(SAMPLE_IMAGE)}')
+    p.add_argument('--runs', type=int, default=10)
+    p.set_defaults(func=cmd_dbhead)
+
+    p = subparsers.add_parser('precision', help='latency, memory and accuracy of the fp32, bf16 and int8 torch detector')
+    p.add_argument('--model', help='torch checkpoint, defaults to the cached comictextdetector.pt')
+    p.add_argument('--modes', default='fp32,bf16,int8', help='comma separated precisions, the first is the reference')
+    p.add_argument('--pages', help=f'directory of pages to detect, defaults to {os.path.basename(SAMPLE_IMAGE)}')
+    p.add_argument('--calibration', help='directory of int8 calibration pages, defaults to --pages')
+    p.add_argument('--calibration-pages', type=int, default=32)
+    p.add_argument('--input-size', type=int, default=1024)
+    p.add_argument('--runs', type=int, default=3)
+    p.set_defaults(func=cmd_precision)
+
+    p = subparsers.add_parser('transport', help='multipart and JSON against the raw body and packed result transport')
+    p.add_argument('--blocks', type=int, default=60)
+    p.add_argument('--runs', type=int, default=10)
+    p.set_defaults(func=cmd_transport)
+
+    p = subparsers.add_parser('serve', help='latency percentiles and throughput of serve.py by worker count, over http')
+    p.add_argument('--workers', default='1,2,4,8', help='comma separated worker counts')
+    p.add_argument('--requests', type=int, default=100, help='detection requests per worker count')
+    p.add_argument('--concurrency', type=int, default=16, help='clients sending requests at the same time')
+    p.add_argument('--profile', default='lite', choices=('full', 'lite'))
+    p.add_argument('--model', help='detector model, defaults to the one of the profile')
+    p.add_argument('--max-queue', type=int, help='INCUBATOR_MAX_QUEUE of the workers, unlimited by default')
+    p.add_argument('--image', help=f'page to detect, defaults to {os.path.basename(SAMPLE_IMAGE)}')
+    p.add_argument('--port', type=int, default=43102)
+    p.add_argument('--url', help='load test a server already running there instead')
+    p.set_defaults(func=cmd_serve)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from loguru import logger
+
+
+def make_key(data: bytes, **params):
+    # content hash of the input, plus everything else the result depends on
+    h = hashlib.sha256(data)
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    '''
+    Cache of JSON-serializable results keyed by make_key, or of bytes with raw=True.
+    Entries are kept in memory up to max_bytes of serialized results, least recently used evicted first.
+    With disk_dir set, entries are also written there, one file per key, and outlive the process.
+    '''
+
+    def __init__(self, name, max_bytes=256 * 1024 * 1024, disk_dir=None):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, raw=False):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return data if raw else json.loads(data)
+
+        data = self._read_disk(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._insert(key, data)
+        return data if raw else json.loads(data)
+
+    def put(self, key, value, raw=False):
+        data = value if raw else json.dumps(value, ensure_ascii=False).encode()
+        with self._lock:
+            self._insert(key, data)
+        self._write_disk(key, data)
+
+    def cached(self, key, submit):
+        # a Future of the cached result, or of submit() whose result is stored once done
+        value = self.get(key)
+        if value is not None:
+            future = Future()
+            future.set_result(value)
+            return future
+
+        def store(future):
+            if future.exception() is None:
+                self.put(key, future.result())
+
+        future = submit()
+        future.add_done_callback(store)
+        return future
+
+    def _insert(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._entries[key] = data
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + '.json')
+
+    def _read_disk(self, key):
+        if self.disk_dir is None:
+            return None
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, key, data):
+        if self.disk_dir is None:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written to a temporary file first, so readers never see a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception("Failed to write {} cache entry {}", self.name, key)
+
+    def to_dict(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.memory_hits + self.disk_hits) / max(lookups, 1),
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+                'disk_dir': self.disk_dir,
+            }
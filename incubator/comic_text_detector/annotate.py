@@ -0,0 +1,194 @@
+'''
+Annotate directories of pages with the detector, for training data, run from the incubator directory:
+
+    python -m comic_text_detector.annotate comictextdetector.pt data/chapters --save-dir data/annotations --recursive
+
+Pages stream through three stages connected by bounded queues: a pool of threads reading and decoding images ahead,
+batched detection, and a pool of threads encoding and writing the outputs, so the model is not idle during either.
+Pages whose outputs all exist are skipped, so an interrupted run resumes where it stopped.
+'''
+import argparse
+import json
+import logging
+import os
+import os.path as osp
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+from comic_text_detector.inference import TextDetector, default_backend
+from comic_text_detector.utils.imgproc_utils import xyxy2yolo, get_yololabel_strings
+from comic_text_detector.utils.io_utils import imread, find_all_imgs, NumpyEncoder
+from comic_text_detector.utils.textmask import REFINEMASK_ANNOTATION
+
+logger = logging.getLogger(__name__)
+
+
+class Page:
+    # an input image and the paths of its outputs, named after the image in out_dir
+    def __init__(self, img_path, out_dir, save_json=False):
+        self.img_path = img_path
+        self.out_dir = out_dir
+        imname = Path(img_path).stem
+        self.label_path = osp.join(self.out_dir, imname + '.txt')
+        self.poly_path = osp.join(self.out_dir, 'line-' + imname + '.txt')
+        self.json_path = osp.join(self.out_dir, imname + '.json') if save_json else None
+        self.img_copy_path = osp.join(self.out_dir, imname + '.png')
+        self.mask_path = osp.join(self.out_dir, 'mask-' + imname + '.png')
+
+    def done(self):
+        # the line polygons are only written for pages with text lines
+        paths = [self.label_path, self.img_copy_path, self.mask_path]
+        if self.json_path is not None:
+            paths.append(self.json_path)
+        return all(osp.exists(path) for path in paths)
+
+
+def find_pages(img_dir_list, save_dir, recursive=False, save_json=False):
+    if isinstance(img_dir_list, str):
+        img_dir_list = [img_dir_list]
+    pages = []
+    for img_dir in img_dir_list:
+        # subdirectories are mirrored in save_dir
+        for rel_path in find_all_imgs(img_dir, recursive=recursive):
+            pages.append(Page(osp.join(img_dir, rel_path), osp.join(save_dir, osp.dirname(rel_path)), save_json))
+    return pages
+
+
+def write_atomic(path, data):
+    # through a temporary file, so an interrupted run never leaves an output that looks complete
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def encode_png(img):
+    return cv2.imencode('.png', img)[1].tobytes()
+
+
+def write_page(page, img, mask_refined, blk_list):
+    im_h, im_w = img.shape[:2]
+    os.makedirs(page.out_dir, exist_ok=True)
+
+    blk_xyxy = xyxy2yolo([blk.xyxy for blk in blk_list], im_w, im_h)
+    yolo_label = get_yololabel_strings([1] * len(blk_xyxy), blk_xyxy) if blk_xyxy is not None else ''
+    write_atomic(page.label_path, yolo_label.encode('utf8'))
+
+    polys = [line for blk in blk_list for line in blk.lines]
+    if len(polys) != 0:
+        lines = '\n'.join(' '.join(str(int(v)) for v in poly) for poly in np.array(polys).reshape(-1, 8))
+        write_atomic(page.poly_path, (lines + '\n').encode('utf8'))
+    if page.json_path is not None:
+        blk_dict_list = [blk.to_dict() for blk in blk_list]
+        write_atomic(page.json_path, json.dumps(blk_dict_list, ensure_ascii=False, cls=NumpyEncoder).encode('utf8'))
+    write_atomic(page.img_copy_path, encode_png(img))
+    # written last, done() checks it
+    write_atomic(page.mask_path, encode_png(mask_refined))
+
+
+def annotate(model, pages, batch_size=4, num_decoders=4, num_writers=4, queue_size=16, resume=True):
+    '''
+    Detect the text of every page and write its annotations.
+    At most queue_size pages are decoded ahead of detection, and at most queue_size detected pages wait to be written.
+    Returns the counts of pages done, skipped and failed, with the elapsed time and the throughput in pages per second.
+    '''
+    todo = [page for page in pages if not (resume and page.done())]
+    stats = {'pages': len(todo), 'skipped': len(pages) - len(todo), 'failed': 0}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(num_decoders, thread_name_prefix='annotate-decode') as decoders, \
+            ThreadPoolExecutor(num_writers, thread_name_prefix='annotate-write') as writers, \
+            tqdm(total=len(todo), unit='page') as progress:
+        decoded, written = deque(), deque()
+        pending = iter(todo)
+
+        def prefetch():
+            while len(decoded) < queue_size:
+                page = next(pending, None)
+                if page is None:
+                    return
+                decoded.append((page, decoders.submit(imread, page.img_path)))
+
+        def collect_written(limit):
+            while len(written) > limit:
+                page, future = written.popleft()
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception('Failed to write the annotations of %s', page.img_path)
+                    stats['failed'] += 1
+                progress.update()
+
+        prefetch()
+        while decoded:
+            batch = []
+            while decoded and len(batch) < batch_size:
+                page, future = decoded.popleft()
+                try:
+                    img = future.result()
+                except Exception:
+                    img = None
+                    logger.exception('Failed to read %s', page.img_path)
+                if img is None:
+                    logger.warning('Skipping %s, not an image', page.img_path)
+                    stats['failed'] += 1
+                    progress.update()
+                    continue
+                batch.append((page, img))
+            # the next pages decode while this batch runs
+            prefetch()
+            if not batch:
+                continue
+
+            results = model.batch([img for _, img in batch], refine_mode=REFINEMASK_ANNOTATION, keep_undetected_mask=True)
+            for (page, img), (_, mask_refined, blk_list) in zip(batch, results):
+                collect_written(queue_size - 1)
+                written.append((page, writers.submit(write_page, page, img, mask_refined, blk_list)))
+        collect_written(0)
+
+    stats['elapsed_s'] = time.perf_counter() - start
+    stats['pages_per_s'] = (stats['pages'] - stats['failed']) / max(stats['elapsed_s'], 1e-9)
+    return stats
+
+
+def default_device(model_path):
+    if default_backend(model_path) != 'torch':
+        return 'cpu'
+    import torch
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='annotate pages with the comic text detector')
+    parser.add_argument('model', help='detector model, .pt or .onnx')
+    parser.add_argument('img_dirs', nargs='+', help='directories of pages')
+    parser.add_argument('--save-dir', required=True)
+    parser.add_argument('--recursive', action='store_true', help='also the pages of subdirectories, mirrored in save-dir')
+    parser.add_argument('--save-json', action='store_true', help='also write the blocks as json')
+    parser.add_argument('--no-resume', dest='resume', action='store_false', help='annotate pages already annotated again')
+    parser.add_argument('--backend', help='detector backend, by model file extension by default')
+    parser.add_argument('--input-size', type=int, default=1024)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--decoders', type=int, default=4, help='threads reading pages')
+    parser.add_argument('--writers', type=int, default=4, help='threads writing annotations')
+    parser.add_argument('--queue-size', type=int, default=16, help='pages buffered between the stages')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    model = TextDetector(model_path=args.model, input_size=args.input_size, device=default_device(args.model),
+                         act='leaky', backend=args.backend)
+    pages = find_pages(args.img_dirs, args.save_dir, recursive=args.recursive, save_json=args.save_json)
+    stats = annotate(model, pages, batch_size=args.batch_size, num_decoders=args.decoders, num_writers=args.writers,
+                     queue_size=args.queue_size, resume=args.resume)
+    print(f"{stats['pages']} pages in {stats['elapsed_s']:.1f}s, {stats['pages_per_s']:.2f} pages/s, "
+          f"{stats['skipped']} skipped as already annotated, {stats['failed']} failed")
+
+
+if __name__ == '__main__':
+    main()
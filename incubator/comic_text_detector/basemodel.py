@@ -1,14 +1,18 @@
 import copy
+import itertools
+import threading
+import warnings
 
-import cv2
 import torch
 import torch.nn as nn
 # from torchsummary import summary
 
 from comic_text_detector.models.yolov5.common import C3, Conv
 from comic_text_detector.models.yolov5.yolo import load_yolov5_ckpt
+# re-exported, the onnx backends moved to onnxmodel so that they can run without torch
+from comic_text_detector.onnxmodel import TextDetBaseDNN, TextDetBaseORT  # noqa: F401
 from comic_text_detector.utils.weight_init import init_weights
-from comic_text_detector.utils.yolov5_utils import fuse_conv_and_bn
+from comic_text_detector.utils.yolov5_utils import fuse_conv_and_bn, fuse_deconv_and_bn
 
 CUDA = True if torch.cuda.is_available() else False
 DEVICE = 'cuda' if CUDA else 'cpu'
@@ -102,12 +106,16 @@ class DBHead(nn.Module):
             nn.ConvTranspose2d(in_channels // 4, 1, 2, 2)
             )
         self.thresh = self._init_thresh(in_channels)
+        # at inference only the shrink maps are read, with shrink_only the threshold branch is skipped
+        self.shrink_only = False
 
     def forward(self, f80, f40, u40, shrink_with_sigmoid=True, step_eval=False):
         shrink_with_sigmoid = self.shrink_with_sigmoid
         u80 = self.upconv3(torch.cat([f40, u40], dim = 1)) # 256@80
         x = self.upconv4(torch.cat([f80, u80], dim = 1)) # 128@160
         x = self.conv(x)
+        if self.shrink_only and not self.training and not step_eval:
+            return torch.sigmoid(self.binarize(x))
         threshold_maps = self.thresh(x)
         x = self.binarize(x)
         shrink_maps = torch.sigmoid(x)
@@ -219,12 +227,71 @@ def get_base_det_models(model_path, device='cpu', half=False, act='leaky'):
         return blk_det.eval().half(), text_seg.eval().half(), text_det.eval().half()
     return blk_det.eval().to(device), text_seg.eval().to(device), text_det.eval().to(device)
 
+def fuse_bn(model):
+    # folds every BatchNorm2d that follows a Conv2d or ConvTranspose2d in a Sequential into the convolution
+    for seq in model.modules():
+        if not isinstance(seq, nn.Sequential):
+            continue
+        for ii in range(len(seq) - 1):
+            conv, bn = seq[ii], seq[ii + 1]
+            if not isinstance(bn, nn.BatchNorm2d):
+                continue
+            if isinstance(conv, nn.ConvTranspose2d):
+                seq[ii] = fuse_deconv_and_bn(conv, bn)
+            elif isinstance(conv, nn.Conv2d):
+                seq[ii] = fuse_conv_and_bn(conv, bn)
+            else:
+                continue
+            seq[ii + 1] = nn.Identity()
+    return model
+
+class BlockDetector(nn.Module):
+    # the yolov5 block detector, returning its detections and the backbone features, for tracing
+    def __init__(self, blk_det):
+        super(BlockDetector, self).__init__()
+        self.blk_det = blk_det
+
+    def forward(self, x):
+        return self.blk_det(x, detect=True)
+
+class InferenceHeads(nn.Module):
+    # the mask and DB heads as one module of the backbone features, for tracing
+    def __init__(self, text_seg, text_det):
+        super(InferenceHeads, self).__init__()
+        self.text_seg = text_seg
+        self.text_det = text_det
+
+    def forward(self, f160, f80, f40, f20, f3):
+        mask, features = self.text_seg(f160, f80, f40, f20, f3, forward_mode=TEXTDET_INFERENCE)
+        lines = self.text_det(*features, step_eval=False)
+        return mask, lines
+
+def freeze_heads(heads, features):
+    # traced on the features of a first batch, the traced graph holds for any batch size and input shape.
+    # Not passed through torch.jit.optimize_for_inference: on CPU it converts to and from mkldnn around
+    # the transposed convolutions, which is slower than the frozen graph
+    with warnings.catch_warnings():
+        # newer torch versions deprecate TorchScript in favour of torch.compile
+        warnings.simplefilter('ignore', FutureWarning)
+        with torch.no_grad():
+            traced = torch.jit.trace(heads.eval(), tuple(features), check_trace=False)
+        return torch.jit.freeze(traced)
+
 class TextDetBase(nn.Module):
-    def __init__(self, model_path, device='cpu', half=False, fuse=False, act='leaky'):
+    def __init__(self, model_path, device='cpu', half=False, fuse=False, act='leaky', optimize=False):
         super(TextDetBase, self).__init__()
         self.blk_det, self.text_seg, self.text_det = get_base_det_models(model_path, device, half, act=act)
+        # line extraction only reads the shrink map
+        self.text_det.shrink_only = True
         if fuse:
             self.fuse()
+        # what forward runs, frozen or quantized versions replace them
+        self.blocks = BlockDetector(self.blk_det)
+        self.heads = InferenceHeads(self.text_seg, self.text_det)
+        self.frozen = False
+        self._freeze_lock = threading.Lock()
+        if optimize:
+            self.optimize()
 
     def fuse(self):
         def _fuse(model):
@@ -237,24 +304,59 @@ class TextDetBase(nn.Module):
         self.text_seg = _fuse(self.text_seg)
         self.text_det = _fuse(self.text_det)
 
+    def optimize(self):
+        # inference only: batchnorm folded into every convolution of the heads, and the heads frozen with
+        # TorchScript on the first forward pass. The yolov5 block detector is fused when loaded and stays eager,
+        # its detect layer builds grids by input shape
+        self.fuse()
+        fuse_bn(self.text_seg)
+        fuse_bn(self.text_det)
+        self.frozen = True
+
+    def quantize(self, calibration_inputs):
+        # int8 post-training static quantization of the block detector and the heads, CPU only.
+        # Activation ranges are observed on calibration_inputs, an iterable of N x 3 x H x W batches.
+        # The yolov5 detect layer stays float, and the float modules are dropped afterwards
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.fx import utils as fx_utils
+        from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+        from comic_text_detector.models.yolov5.yolo import Detect
+
+        for m in self.modules():
+            if isinstance(m, (nn.LeakyReLU, nn.ReLU)):
+                m.inplace = False  # quantized activations are not in place
+        qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+        calibration_inputs = iter(calibration_inputs)
+        example = next(calibration_inputs, None)
+        if example is None:
+            raise ValueError('no calibration inputs')
+
+        with torch.no_grad():
+            features = self.blocks(example)[1]
+            blocks = prepare_fx(self.blocks, qconfig_mapping, (example,),
+                                prepare_custom_config=PrepareCustomConfig().set_non_traceable_module_classes([Detect]))
+            heads = prepare_fx(self.heads, qconfig_mapping, tuple(features))
+            for blob in itertools.chain([example], calibration_inputs):
+                heads(*blocks(blob)[1])
+            self.blocks = convert_fx(blocks)
+            self.heads = convert_fx(heads)
+        self.blk_det = self.text_seg = self.text_det = None
+        # torch caches the device of every module it quantizes, which would keep the float weights and observers alive
+        device_cache = getattr(fx_utils.assert_and_get_unique_device, 'cache_clear', None)
+        if device_cache is not None:
+            device_cache()
+
     def forward(self, features):
-        blks, features = self.blk_det(features, detect=True)
-        mask, features = self.text_seg(*features, forward_mode=TEXTDET_INFERENCE)
-        lines = self.text_det(*features, step_eval=False)
+        blks, features = self.blocks(features)
+        if self.frozen and not isinstance(self.heads, torch.jit.ScriptModule):
+            # traced in the process that runs it rather than at load, the server may load before forking workers
+            with self._freeze_lock:
+                if not isinstance(self.heads, torch.jit.ScriptModule):
+                    self.heads = freeze_heads(self.heads, features)
+        mask, lines = self.heads(*features)
         return blks[0], mask, lines
 
-class TextDetBaseDNN:
-    def __init__(self, input_size, model_path):
-        self.input_size = input_size
-        self.model = cv2.dnn.readNetFromONNX(model_path)
-        self.uoln = self.model.getUnconnectedOutLayersNames()
-
-    def __call__(self, im_in):
-        blob = cv2.dnn.blobFromImage(im_in, scalefactor=1 / 255.0, size=(self.input_size, self.input_size))
-        self.model.setInput(blob)
-        blks, mask, lines_map  = self.model.forward(self.uoln)
-        return blks, mask, lines_map
-
 if __name__ == '__main__':
     device = 'cuda'
     weights = r'data/yolov5sblk.ckpt'
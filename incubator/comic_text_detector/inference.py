@@ -1,102 +1,76 @@
 import json
+import logging
+import math
+import os
 import os.path as osp
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Union
 
 import cv2
 import numpy as np
-import torch
 from tqdm import tqdm
 
-from comic_text_detector.basemodel import TextDetBase, TextDetBaseDNN
+from comic_text_detector.onnxmodel import TextDetBaseDNN, TextDetBaseORT
 from comic_text_detector.utils.db_utils import SegDetectorRepresenter
-from comic_text_detector.utils.imgproc_utils import letterbox, xyxy2yolo, get_yololabel_strings
-from comic_text_detector.utils.io_utils import imread, imwrite, find_all_imgs, NumpyEncoder
+from comic_text_detector.utils.imgproc_utils import images_to_blob, letterbox
+from comic_text_detector.utils.io_utils import find_all_imgs, imread, is_tensor, to_numpy
+from comic_text_detector.utils.nms import non_max_suppression
 from comic_text_detector.utils.textblock import TextBlock, group_output, visualize_textblocks
-from comic_text_detector.utils.textmask import refine_mask, refine_undetected_mask, REFINEMASK_INPAINT, \
-    REFINEMASK_ANNOTATION
-from comic_text_detector.utils.yolov5_utils import non_max_suppression
+from comic_text_detector.utils.textmask import refine_mask, refine_undetected_mask, REFINEMASK_INPAINT
 
+logger = logging.getLogger(__name__)
+
+# what TextDetector can produce, stages no requested output depends on are skipped
+OUTPUT_BLOCKS = 'blocks'
+OUTPUT_LINES = 'lines'
+OUTPUT_MASK = 'mask'
+OUTPUT_MASK_REFINED = 'mask_refined'
+DETECTOR_OUTPUTS = (OUTPUT_BLOCKS, OUTPUT_LINES, OUTPUT_MASK, OUTPUT_MASK_REFINED)
+
+# numeric precision of the torch backend on CPU: bf16 runs under autocast, int8 is quantized after calibration
+PRECISION_FP32 = 'fp32'
+PRECISION_BF16 = 'bf16'
+PRECISION_INT8 = 'int8'
+PRECISIONS = (PRECISION_FP32, PRECISION_BF16, PRECISION_INT8)
+
+
+def model2annotations(model_path, img_dir_list, save_dir, save_json=False, recursive=False, **annotate_options):
+    # see comic_text_detector/annotate.py, pages already annotated in save_dir are skipped unless resume=False
+    from comic_text_detector.annotate import annotate, default_device, find_pages
 
-def model2annotations(model_path, img_dir_list, save_dir, save_json=False):
-    if isinstance(img_dir_list, str):
-        img_dir_list = [img_dir_list]
-    cuda = torch.cuda.is_available()
-    device = 'cuda' if cuda else 'cpu'
     model = TextDetector(model_path=model_path,
-                         input_size=1024, device=device, act='leaky')
-    imglist = []
-    for img_dir in img_dir_list:
-        imglist += find_all_imgs(img_dir, abs_path=True)
-    for img_path in tqdm(imglist):
-        imgname = osp.basename(img_path)
-        img = imread(img_path)
-        im_h, im_w = img.shape[:2]
-        imname = imgname.replace(Path(imgname).suffix, '')
-        maskname = 'mask-'+imname+'.png'
-        poly_save_path = osp.join(save_dir, 'line-' + imname + '.txt')
-        mask, mask_refined, blk_list = model(
-            img, refine_mode=REFINEMASK_ANNOTATION, keep_undetected_mask=True)
-        polys = []
-        blk_xyxy = []
-        blk_dict_list = []
-        for blk in blk_list:
-            polys += blk.lines
-            blk_xyxy.append(blk.xyxy)
-            blk_dict_list.append(blk.to_dict())
-        blk_xyxy = xyxy2yolo(blk_xyxy, im_w, im_h)
-        if blk_xyxy is not None:
-            cls_list = [1] * len(blk_xyxy)
-            yolo_label = get_yololabel_strings(cls_list, blk_xyxy)
-        else:
-            yolo_label = ''
-        with open(osp.join(save_dir, imname+'.txt'), 'w', encoding='utf8') as f:
-            f.write(yolo_label)
-
-        # num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask)
-        # _, mask = cv2.threshold(mask, 50, 255, cv2.THRESH_BINARY)
-        # draw_connected_labels(num_labels, labels, stats, centroids)
-        # visualize_textblocks(img, blk_list)
-        # cv2.imshow('rst', img)
-        # cv2.imshow('mask', mask)
-        # cv2.imshow('mask_refined', mask_refined)
-        # cv2.waitKey(0)
-
-        if len(polys) != 0:
-            if isinstance(polys, list):
-                polys = np.array(polys)
-            polys = polys.reshape(-1, 8)
-            np.savetxt(poly_save_path, polys, fmt='%d')
-        if save_json:
-            with open(osp.join(save_dir, imname+'.json'), 'w', encoding='utf8') as f:
-                f.write(json.dumps(blk_dict_list,
-                        ensure_ascii=False, cls=NumpyEncoder))
-        imwrite(osp.join(save_dir, imgname), img)
-        imwrite(osp.join(save_dir, maskname), mask_refined)
-
-
-def preprocess_img(img, input_size=(1024, 1024), device='cpu', bgr2rgb=True, half=False, to_tensor=True):
+                         input_size=1024, device=default_device(model_path), act='leaky')
+    pages = find_pages(img_dir_list, save_dir, recursive=recursive, save_json=save_json)
+    return annotate(model, pages, **annotate_options)
+
+
+def preprocess_img(img, input_size=(1024, 1024), device='cpu', bgr2rgb=True, half=False, to_tensor=True, auto=False):
+    # auto: keep the aspect ratio and only pad up to a multiple of the stride
     if bgr2rgb:
         img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
     img_in, ratio, (dw, dh) = letterbox(
-        img, new_shape=input_size, auto=False, stride=64)
+        img, new_shape=input_size, auto=auto, stride=64)
     if to_tensor:
         img_in = img_in.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
         img_in = np.array([np.ascontiguousarray(img_in)]
                           ).astype(np.float32) / 255
         if to_tensor:
+            import torch
             img_in = torch.from_numpy(img_in).to(device)
             if half:
                 img_in = img_in.half()
     return img_in, ratio, int(dw), int(dh)
 
 
-def postprocess_mask(img: Union[torch.Tensor, np.ndarray], thresh=None):
+def postprocess_mask(img: Union['torch.Tensor', np.ndarray], thresh=None):
     # img = img.permute(1, 2, 0)
-    if isinstance(img, torch.Tensor):
-        img = img.squeeze_()
+    if is_tensor(img):
+        img = img.squeeze()
         if img.device != 'cpu':
-            img = img.detach_().cpu()
+            img = img.detach().cpu()
         img = img.numpy()
     else:
         img = img.squeeze()
@@ -109,10 +83,7 @@ def postprocess_mask(img: Union[torch.Tensor, np.ndarray], thresh=None):
 
 
 def postprocess_yolo(det, conf_thresh, nms_thresh, resize_ratio, sort_func=None):
-    det = non_max_suppression(det, conf_thresh, nms_thresh)[0]
-    # bbox = det[..., 0:4]
-    if det.device != 'cpu':
-        det = det.detach_().cpu().numpy()
+    det = non_max_suppression(to_numpy(det), conf_thresh, nms_thresh)[0]
     det[..., [0, 2]] = det[..., [0, 2]] * resize_ratio[0]
     det[..., [1, 3]] = det[..., [1, 3]] * resize_ratio[1]
     if sort_func is not None:
@@ -124,59 +95,243 @@ def postprocess_yolo(det, conf_thresh, nms_thresh, resize_ratio, sort_func=None)
     return blines, cls, confs
 
 
+def resolve_outputs(outputs=None):
+    # None requests every output
+    if outputs is None:
+        return frozenset(DETECTOR_OUTPUTS)
+    if isinstance(outputs, str):
+        outputs = [outputs]
+    outputs = frozenset(outputs)
+    unknown = outputs.difference(DETECTOR_OUTPUTS)
+    if unknown:
+        raise ValueError(f'unknown detector outputs: {sorted(unknown)}, expected some of {DETECTOR_OUTPUTS}')
+    return outputs
+
+
+def default_backend(model_path):
+    # by file extension, exported onnx models run on opencv
+    return 'opencv' if Path(model_path).suffix == '.onnx' else 'torch'
+
+
+def needs_blocks(outputs):
+    # lines are grouped into blocks, and the refined mask is refined block by block
+    return not outputs.isdisjoint((OUTPUT_BLOCKS, OUTPUT_LINES, OUTPUT_MASK_REFINED))
+
+
+class StageTimer:
+    def __init__(self):
+        self.times = {}
+        self.last = time.perf_counter()
+
+    def mark(self, stage):
+        # the time since the previous mark is added to stage
+        now = time.perf_counter()
+        self.times[stage] = self.times.get(stage, 0.) + now - self.last
+        self.last = now
+
+    def __str__(self):
+        return ', '.join(f'{stage}={t * 1000:.1f}ms' for stage, t in self.times.items())
+
+
 class TextDetector:
     lang_list = ['eng', 'ja', 'unknown']
     langcls2idx = {'eng': 0, 'ja': 1, 'unknown': 2}
+    # text lines scoring below it on the line map are dropped
+    box_thresh = 0.6
 
-    def __init__(self, model_path, input_size=1024, device='cpu', half=False, nms_thresh=0.35, conf_thresh=0.4, mask_thresh=0.3, act='leaky'):
+    def __init__(self, model_path, input_size=1024, device='cpu', half=False, nms_thresh=0.35, conf_thresh=0.4, mask_thresh=0.3, act='leaky',
+                 backend=None, ort_options=None, dynamic_input=False, tile_size=None, tile_overlap=256, tile_batch_size=4,
+                 refine_workers=1, optimize=False, precision=PRECISION_FP32, calibration_dir=None, calibration_pages=32):
         super(TextDetector, self).__init__()
         cuda = device == 'cuda'
 
-        if Path(model_path).suffix == '.onnx':
-            self.model = cv2.dnn.readNetFromONNX(model_path)
+        if backend is None:
+            backend = default_backend(model_path)
+        if dynamic_input and backend == 'opencv':
+            raise ValueError('dynamic_input is not supported by the opencv backend, '
+                             'use onnxruntime with a model exported with --dynamic')
+        if backend == 'onnxruntime':
+            self.net = TextDetBaseORT(input_size, model_path, **(ort_options or {}))
+        elif backend == 'opencv':
             self.net = TextDetBaseDNN(input_size, model_path)
-            self.backend = 'opencv'
+        elif backend == 'torch':
+            # only the torch backend imports torch
+            from comic_text_detector.basemodel import TextDetBase
+            self.net = TextDetBase(model_path, device=device, act=act, optimize=optimize)
         else:
-            self.net = TextDetBase(model_path, device=device, act=act)
-            self.backend = 'torch'
+            raise ValueError(f'unknown backend: {backend}')
+        self.backend = backend
+        # fused and frozen network, torch backend only, see TextDetBase.optimize
+        self.optimize = optimize and backend == 'torch'
+
+        if dynamic_input and backend == 'onnxruntime' and not self.net.dynamic_shape:
+            raise ValueError(f'dynamic_input needs a model exported with dynamic height and width (--dynamic), '
+                             f'{model_path} has a fixed input shape')
 
         if isinstance(input_size, int):
             input_size = (input_size, input_size)
+        if dynamic_input:
+            # input_size is the long side target, the short side follows the page aspect ratio
+            input_size = tuple(int(math.ceil(x / 64) * 64) for x in input_size)
         self.input_size = input_size
+        self.dynamic_input = dynamic_input
+        # pages larger than tile_size are detected in overlapping tiles
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_batch_size = tile_batch_size
+        # threads refining the mask of different blocks in parallel, on a pool started on first use.
+        # Serial by default, threads only pay off with several free cores
+        self.refine_workers = refine_workers
+        self._refine_pool = None
+        self._refine_pool_pid = None
+        self._refine_pool_lock = threading.Lock()
         self.device = device
         self.half = half
         self.conf_thresh = conf_thresh
         self.nms_thresh = nms_thresh
         self.seg_rep = SegDetectorRepresenter(thresh=0.3)
+        self.precision = self._set_precision(precision, calibration_dir, calibration_pages)
 
-    @torch.no_grad()
-    def __call__(self, img, refine_mode=REFINEMASK_INPAINT, keep_undetected_mask=False):
-        img_in, ratio, dw, dh = preprocess_img(
-            img, input_size=self.input_size, device=self.device, half=self.half, to_tensor=self.backend == 'torch')
-        im_h, im_w = img.shape[:2]
+    def _set_precision(self, precision, calibration_dir, calibration_pages):
+        if precision not in PRECISIONS:
+            raise ValueError(f'unknown precision: {precision}, expected one of {PRECISIONS}')
+        if precision == PRECISION_FP32:
+            return precision
+        if self.backend != 'torch' or self.device != 'cpu':
+            raise ValueError(f'{precision} precision needs the torch backend on cpu')
 
-        blks, mask, lines_map = self.net(img_in)
+        import torch
 
-        resize_ratio = (
-            im_w / (self.input_size[0] - dw), im_h / (self.input_size[1] - dh))
-        blks = postprocess_yolo(blks, self.conf_thresh,
-                                self.nms_thresh, resize_ratio)
+        if precision == PRECISION_BF16:
+            if not torch.backends.mkldnn.is_available() or not torch.ops.mkldnn._is_mkldnn_bf16_supported():
+                logger.warning('this CPU does not support bf16, the detector runs in fp32')
+                return PRECISION_FP32
+            return precision
+
+        if calibration_dir is None:
+            raise ValueError('int8 precision needs calibration_dir, a directory of sample pages')
+        start = time.perf_counter()
+        self.net.quantize(self._calibration_inputs(calibration_dir, calibration_pages))
+        logger.info('quantized the detector to int8 on pages of %s in %.1fs', calibration_dir, time.perf_counter() - start)
+        return precision
+
+    def _calibration_inputs(self, img_dir, num_pages):
+        # network inputs of up to num_pages pages of img_dir, one page at a time
+        import torch
+
+        for img_path in find_all_imgs(img_dir, abs_path=True)[:num_pages]:
+            img = imread(img_path)
+            if img is None:
+                logger.warning('skipping %s for calibration, not an image', img_path)
+                continue
+            yield torch.from_numpy(images_to_blob([self._preprocess(img)[0]]))
 
+    def _preprocess(self, img):
+        # the letterboxed page, _forward batches the pages of one input shape into a single blob
+        return preprocess_img(img, input_size=self.input_size, to_tensor=False, auto=self.dynamic_input)
+
+    def _forward(self, img_ins, timer):
+        # the exported onnx model has a fixed batch size of 1, opencv runs it page by page
         if self.backend == 'opencv':
-            if mask.shape[1] == 2:     # some version of opencv spit out reversed result
-                tmp = mask
-                mask = lines_map
-                lines_map = tmp
-        mask = postprocess_mask(mask)
+            outputs = [self.net(img_in) for img_in in img_ins]
+            timer.mark('forward')
+            return outputs
+
+        # with dynamic input pages only share a forward pass with pages of the same input shape
+        groups = {}
+        for ii, img_in in enumerate(img_ins):
+            groups.setdefault(img_in.shape, []).append(ii)
+
+        outputs = [None] * len(img_ins)
+        for indices in groups.values():
+            blob = images_to_blob([img_ins[ii] for ii in indices])
+            timer.mark('preprocess')
+            # copied off the device once per batch, then sliced per page
+            blks, mask, lines_map = (to_numpy(output) for output in self._run(blob))
+            timer.mark('forward')
+            for jj, ii in enumerate(indices):
+                outputs[ii] = blks[jj:jj+1], mask[jj:jj+1], lines_map[jj:jj+1]
+        return outputs
+
+    def _run(self, blob):
+        # blob: N x 3 x H x W float32, returns the block detections, text mask and DB line map of the batch
+        if self.backend == 'onnxruntime':
+            return self.net.forward(blob)
+
+        import torch
+
+        blob = torch.from_numpy(blob).to(self.device)
+        if self.half:
+            blob = blob.half()
+        with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=self.precision == PRECISION_BF16):
+            return self.net(blob)
+
+    def _get_refine_pool(self):
+        # None with a single worker. A pool started before a fork has no threads in the child, it gets its own
+        if self.refine_workers <= 1:
+            return None
+        with self._refine_pool_lock:
+            if self._refine_pool is None or self._refine_pool_pid != os.getpid():
+                self._refine_pool = ThreadPoolExecutor(self.refine_workers, thread_name_prefix='refine-mask')
+                self._refine_pool_pid = os.getpid()
+            return self._refine_pool
+
+    def close(self):
+        # stops the refinement threads, the detector starts them again if it is used afterwards
+        with self._refine_pool_lock:
+            if self._refine_pool is not None and self._refine_pool_pid == os.getpid():
+                self._refine_pool.shutdown()
+            self._refine_pool = None
 
-        lines, scores = self.seg_rep(self.input_size, lines_map)
-        box_thresh = 0.6
-        idx = np.where(scores[0] > box_thresh)
-        lines, scores = lines[0][idx], scores[0][idx]
+    def _needs_tiling(self, img):
+        return self.tile_size is not None and max(img.shape[:2]) > self.tile_size
 
-        # map output to input img
+    def __call__(self, img, refine_mode=REFINEMASK_INPAINT, keep_undetected_mask=False, outputs=None):
+        return self.batch([img], refine_mode, keep_undetected_mask, outputs)[0]
+
+    def batch(self, imgs, refine_mode=REFINEMASK_INPAINT, keep_undetected_mask=False, outputs=None):
+        # outputs: names from DETECTOR_OUTPUTS to compute, None for all of them.
+        # Returns (mask, mask_refined, blk_list) per image, outputs that were not requested are None
+        outputs = resolve_outputs(outputs)
+        timer = StageTimer()
+        results = [None] * len(imgs)
+        indices = []
+        for ii, img in enumerate(imgs):
+            if self._needs_tiling(img):
+                results[ii] = self._detect_tiled(img, refine_mode, keep_undetected_mask, outputs, timer)
+            else:
+                indices.append(ii)
+
+        inputs = [self._preprocess(imgs[ii]) for ii in indices]
+        timer.mark('preprocess')
+        outputs_net = self._forward([img_in for img_in, _, _, _ in inputs], timer)
+        for ii, (_, _, dw, dh), (blks, mask, lines_map) in zip(indices, inputs, outputs_net):
+            results[ii] = self._postprocess(
+                imgs[ii], blks, mask, lines_map, dw, dh, refine_mode, keep_undetected_mask, outputs, timer)
+
+        logger.debug('detected %d images (%s): %s', len(imgs), ', '.join(sorted(outputs)), timer)
+        return results
+
+    def _postprocess(self, img, blks, mask, lines_map, dw, dh, refine_mode, keep_undetected_mask, outputs, timer):
+        im_h, im_w = img.shape[:2]
+        in_h, in_w = lines_map.shape[-2:]
+        resize_ratio = (
+            im_w / (in_w - dw), im_h / (in_h - dh))
+
+        # map output to input img, group_output filters blocks by the raw mask too
+        mask = postprocess_mask(mask)
         mask = mask[: mask.shape[0]-dh, : mask.shape[1]-dw]
         mask = cv2.resize(mask, (im_w, im_h), interpolation=cv2.INTER_LINEAR)
+        timer.mark('mask')
+        if not needs_blocks(outputs):
+            return mask, None, None
+
+        blks = postprocess_yolo(blks, self.conf_thresh,
+                                self.nms_thresh, resize_ratio)
+        timer.mark('nms')
+
+        lines, scores = self.seg_rep((in_h, in_w), lines_map, min_score=self.box_thresh, timer=timer)
+        lines, scores = lines[0], scores[0]
         if lines.size == 0:
             lines = []
         else:
@@ -184,15 +339,94 @@ class TextDetector:
             lines[..., 0] *= resize_ratio[0]
             lines[..., 1] *= resize_ratio[1]
             lines = lines.astype(np.int32)
+        timer.mark('lines')
+        return self._group(img, blks, mask, lines, refine_mode, keep_undetected_mask, outputs, timer)
+
+    def _group(self, img, blks, mask, lines, refine_mode, keep_undetected_mask, outputs, timer):
+        im_h, im_w = img.shape[:2]
         blk_list = group_output(blks, lines, im_w, im_h, mask)
-        mask_refined = refine_mask(
-            img, mask, blk_list, refine_mode=refine_mode)
-        if keep_undetected_mask:
-            mask_refined = refine_undetected_mask(
-                img, mask, mask_refined, blk_list, refine_mode=refine_mode)
+        timer.mark('group')
 
+        mask_refined = None
+        if OUTPUT_MASK_REFINED in outputs:
+            mask_refined = refine_mask(
+                img, mask, blk_list, refine_mode=refine_mode, pool=self._get_refine_pool())
+            timer.mark('refine')
+            if keep_undetected_mask:
+                mask_refined = refine_undetected_mask(
+                    img, mask, mask_refined, blk_list, refine_mode=refine_mode, pool=self._get_refine_pool())
+                timer.mark('refine_undetected')
+
+        if OUTPUT_MASK not in outputs:
+            mask = None
+        if outputs.isdisjoint((OUTPUT_BLOCKS, OUTPUT_LINES)):
+            blk_list = None
         return mask, mask_refined, blk_list
 
+    def _detect_tiled(self, img, refine_mode, keep_undetected_mask, outputs, timer):
+        # overlapping windows run through the network tile_batch_size at a time,
+        # the network never sees more than one batch of tiles
+        im_h, im_w = img.shape[:2]
+        windows = [(x, y, min(self.tile_size, im_w), min(self.tile_size, im_h))
+                   for y in tile_starts(im_h, self.tile_size, self.tile_overlap)
+                   for x in tile_starts(im_w, self.tile_size, self.tile_overlap)]
+        with_blocks = needs_blocks(outputs)
+
+        # tiles are blended by taking the maximum score in overlapping areas
+        mask = np.zeros((im_h, im_w), np.uint8)
+        lines_map = np.zeros((im_h, im_w), np.float16) if with_blocks else None
+        candidates = []
+        for start in range(0, len(windows), self.tile_batch_size):
+            batch_windows = windows[start: start + self.tile_batch_size]
+            inputs = [self._preprocess(img[y: y + h, x: x + w]) for x, y, w, h in batch_windows]
+            timer.mark('preprocess')
+            outputs_net = self._forward([img_in for img_in, _, _, _ in inputs], timer)
+            for (x, y, w, h), (_, _, dw, dh), (blks, tile_mask, tile_lines) in zip(batch_windows, inputs, outputs_net):
+                in_h, in_w = tile_lines.shape[-2:]
+
+                tile_mask = postprocess_mask(tile_mask)[: in_h - dh, : in_w - dw]
+                tile_mask = cv2.resize(tile_mask, (w, h), interpolation=cv2.INTER_LINEAR)
+                np.maximum(mask[y: y + h, x: x + w], tile_mask, out=mask[y: y + h, x: x + w])
+                timer.mark('mask')
+                if not with_blocks:
+                    continue
+
+                blks = to_numpy(blks)[0]
+                blks = blks[blks[:, 4] > self.conf_thresh]
+                rx, ry = w / (in_w - dw), h / (in_h - dh)
+                blks[:, [0, 2]] *= rx
+                blks[:, [1, 3]] *= ry
+                blks[:, 0] += x
+                blks[:, 1] += y
+                candidates.append(blks)
+
+                tile_lines = to_numpy(tile_lines)[0, 0, : in_h - dh, : in_w - dw].astype(np.float32)
+                tile_lines = cv2.resize(tile_lines, (w, h), interpolation=cv2.INTER_LINEAR)
+                np.maximum(lines_map[y: y + h, x: x + w], tile_lines, out=lines_map[y: y + h, x: x + w])
+                timer.mark('lines')
+
+        if not with_blocks:
+            return mask, None, None
+
+        # boxes cut by tile borders are merged by nms across tiles
+        blks = postprocess_yolo(np.concatenate(candidates)[None], self.conf_thresh,
+                                self.nms_thresh, (1, 1))
+        timer.mark('nms')
+
+        lines, scores = self.seg_rep((im_h, im_w), lines_map[None, None], min_score=self.box_thresh, timer=timer)
+        lines = lines[0]
+        lines = [] if lines.size == 0 else lines.astype(np.int32)
+        timer.mark('lines')
+        return self._group(img, blks, mask, lines, refine_mode, keep_undetected_mask, outputs, timer)
+
+
+def tile_starts(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    step = max(tile_size - overlap, 1)
+    starts = list(range(0, length - tile_size, step))
+    return starts + [length - tile_size]
+
 
 def traverse_by_dict(img_dir_list, dict_dir):
     if isinstance(img_dir_list, str):
@@ -9,6 +9,7 @@ from .common import *
 class Detect(nn.Module):
     stride = None  # strides computed during build
     onnx_dynamic = False  # ONNX export parameter
+    grid_cache_size = 64  # grids cached for dynamic input shapes
 
     def __init__(self, nc=80, anchors=(), ch=(), inplace=True):  # detection layer
         super().__init__()
@@ -18,6 +19,7 @@ class Detect(nn.Module):
         self.na = len(anchors[0]) // 2  # number of anchors
         self.grid = [torch.zeros(1)] * self.nl  # init grid
         self.anchor_grid = [torch.zeros(1)] * self.nl  # init anchor grid
+        self.grid_cache = {}  # (nx, ny, i, device, dtype) -> (grid, anchor_grid)
         self.register_buffer('anchors', torch.tensor(anchors).float().view(self.nl, -1, 2))  # shape(nl,na,2)
         self.m = nn.ModuleList(nn.Conv2d(x, self.no * self.na, 1) for x in ch)  # output conv
         self.inplace = inplace  # use in-place ops (e.g. slice assignment)
@@ -30,10 +32,12 @@ class Detect(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
-                if self.onnx_dynamic or self.grid[i].shape[2:4] != x[i].shape[2:4]:
+                if self.onnx_dynamic:
                     self.grid[i], self.anchor_grid[i] = self._make_grid(nx, ny, i)
+                elif self.grid[i].shape[2:4] != x[i].shape[2:4]:
+                    self.grid[i], self.anchor_grid[i] = self._cached_grid(nx, ny, i)
 
-                y = x[i].sigmoid()
+                y = x[i].float().sigmoid()  # decoded in float32, boxes would lose pixels in bfloat16
                 if self.inplace:
                     y[..., 0:2] = (y[..., 0:2] * 2 - 0.5 + self.grid[i]) * self.stride[i]  # xy
                     y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
@@ -45,6 +49,15 @@ class Detect(nn.Module):
 
         return x if self.training else (torch.cat(z, 1), x)
 
+    def _cached_grid(self, nx, ny, i):
+        # grids for every input shape seen, so alternating page shapes do not rebuild them
+        key = (nx, ny, i, self.anchors.device, self.anchors.dtype)
+        if key not in self.grid_cache:
+            if len(self.grid_cache) >= self.grid_cache_size:
+                self.grid_cache.pop(next(iter(self.grid_cache)))
+            self.grid_cache[key] = self._make_grid(nx, ny, i)
+        return self.grid_cache[key]
+
     def _make_grid(self, nx=20, ny=20, i=0):
         d = self.anchors[i].device
         if check_version(torch.__version__, '1.10.0'):  # torch>=1.10.0 meshgrid workaround for torch>=0.7 compatibility
@@ -0,0 +1,104 @@
+# Backends running an exported onnx model. They need neither torch nor torchvision,
+# so a server using them never imports torch
+from queue import Queue
+
+import cv2
+import numpy as np
+
+from comic_text_detector.utils.imgproc_utils import images_to_blob
+
+
+# outputs of a model exported by utils/export.py: block detections, text mask and DB line map
+OUTPUT_NAMES = ('blk', 'seg', 'det')
+
+class TextDetBaseDNN:
+    def __init__(self, input_size, model_path):
+        self.input_size = input_size
+        self.model = cv2.dnn.readNetFromONNX(model_path)
+        self.uoln = self.model.getUnconnectedOutLayersNames()
+        # some opencv versions list the outputs in another order, they are put back in export order by name
+        self.output_order = [self.uoln.index(name) for name in OUTPUT_NAMES] \
+            if sorted(self.uoln) == sorted(OUTPUT_NAMES) else None
+
+    def __call__(self, im_in):
+        # im_in is already letterboxed, it may be non-square with dynamic input
+        blob = cv2.dnn.blobFromImage(im_in, scalefactor=1 / 255.0, size=(im_in.shape[1], im_in.shape[0]))
+        self.model.setInput(blob)
+        outputs = self.model.forward(self.uoln)
+        if self.output_order is not None:
+            return tuple(outputs[ii] for ii in self.output_order)
+        blks, mask, lines_map = outputs
+        if mask.shape[1] == 2:
+            # exported under other names: the mask has one channel, a line map with the threshold branch two
+            mask, lines_map = lines_map, mask
+        return blks, mask, lines_map
+
+ORT_OPTIMIZATION_LEVELS = {
+    'disable': 'ORT_DISABLE_ALL',
+    'basic': 'ORT_ENABLE_BASIC',
+    'extended': 'ORT_ENABLE_EXTENDED',
+    'all': 'ORT_ENABLE_ALL',
+}
+
+class TextDetBaseORT:
+    def __init__(self, input_size, model_path, num_sessions=1, intra_op_threads=0, inter_op_threads=0,
+                 graph_optimization='all', mem_arena=True, providers=None):
+        import onnxruntime as ort
+
+        self.input_size = input_size
+        with open(model_path, 'rb') as f:
+            model_bytes = f.read()
+
+        # sessions of the pool share one copy of the weights
+        self.initializers = load_onnx_initializers(model_bytes, ort) if num_sessions > 1 else {}
+
+        self.sessions = Queue()
+        for _ in range(num_sessions):
+            sess_options = ort.SessionOptions()
+            sess_options.intra_op_num_threads = intra_op_threads
+            sess_options.inter_op_num_threads = inter_op_threads
+            sess_options.graph_optimization_level = getattr(
+                ort.GraphOptimizationLevel, ORT_OPTIMIZATION_LEVELS[graph_optimization])
+            sess_options.enable_cpu_mem_arena = mem_arena
+            for name, value in self.initializers.items():
+                sess_options.add_initializer(name, value)
+            self.sessions.put(ort.InferenceSession(
+                model_bytes, sess_options, providers=providers or ['CPUExecutionProvider']))
+
+        session = self.sessions.queue[0]
+        model_input = session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.output_names = [o.name for o in session.get_outputs()]
+        # a named or unknown batch axis was exported as dynamic, the default export has a batch size of 1
+        self.dynamic_batch = not isinstance(model_input.shape[0], int)
+        # and only a model exported with dynamic height and width takes non-square inputs, see dynamic_input
+        self.dynamic_shape = not all(isinstance(dim, int) for dim in model_input.shape[2:])
+
+    def __call__(self, im_in):
+        return self.forward(images_to_blob([im_in]))
+
+    def forward(self, blob):
+        # blob: N x 3 x H x W, same layout as the torch path, see images_to_blob.
+        # Runs as one batch if the model takes it, image by image otherwise
+        if not self.dynamic_batch and blob.shape[0] > 1:
+            outputs = [self.forward(blob[ii: ii + 1]) for ii in range(blob.shape[0])]
+            return tuple(np.concatenate(output) for output in zip(*outputs))
+        session = self.sessions.get()
+        try:
+            blks, mask, lines_map = session.run(self.output_names, {self.input_name: blob})
+        finally:
+            self.sessions.put(session)
+        return blks, mask, lines_map
+
+def load_onnx_initializers(model_bytes, ort):
+    try:
+        import onnx
+        from onnx import numpy_helper
+    except ImportError:
+        return {}
+    model = onnx.load_from_string(model_bytes)
+    initializers = {}
+    for init in model.graph.initializer:
+        # OrtValue keeps a reference to the numpy buffer, nothing is copied
+        initializers[init.name] = ort.OrtValue.ortvalue_from_numpy(numpy_helper.to_array(init))
+    return initializers
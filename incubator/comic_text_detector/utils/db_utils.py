@@ -3,8 +3,9 @@ import numpy as np
 import pyclipper
 from shapely.geometry import Polygon
 from collections import namedtuple
-import torch
 import warnings
+
+from comic_text_detector.utils.io_utils import is_tensor
 warnings.filterwarnings('ignore')
 
 
@@ -29,6 +30,42 @@ def iou_rotate(box_a, box_b, method='union'):
             raise NotImplementedError
         return iou
 
+def mark_stage(timer, stage):
+    if timer is not None:
+        timer.mark(stage)
+
+def order_box_points(points: np.ndarray) -> np.ndarray:
+    # (n, 4, 2) cv2.boxPoints ordered as SegDetectorRepresenter.get_mini_boxes does:
+    # top left, top right, bottom right, bottom left
+    order = np.argsort(points[..., 0], axis=1, kind='stable')
+    points = np.take_along_axis(points, order[..., None], axis=1)
+    left_down = points[:, 1, 1] > points[:, 0, 1]
+    right_down = points[:, 3, 1] > points[:, 2, 1]
+    index = np.stack([
+        np.where(left_down, 0, 1),
+        np.where(right_down, 2, 3),
+        np.where(right_down, 3, 2),
+        np.where(left_down, 1, 0),
+    ], axis=1)
+    return np.take_along_axis(points, index[..., None], axis=1)
+
+def unclip_distances(polygons: np.ndarray, unclip_ratio=1.5) -> np.ndarray:
+    # area * unclip_ratio / perimeter of (n, k, 2) polygons, summed in the order shapely does
+    polygons = np.asarray(polygons, dtype=np.float64)
+    x, y = polygons[..., 0], polygons[..., 1]
+    num_points = polygons.shape[1]
+    area = np.zeros(len(polygons))
+    for ii in range(1, num_points):
+        area += (x[:, ii] - x[:, 0]) * (y[:, ii - 1] - y[:, (ii + 1) % num_points])
+    area = np.abs(area / 2)
+    length = np.zeros(len(polygons))
+    for ii in range(num_points):
+        dx = x[:, (ii + 1) % num_points] - x[:, ii]
+        dy = y[:, (ii + 1) % num_points] - y[:, ii]
+        length += np.sqrt(dx * dx + dy * dy)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return area * unclip_ratio / length
+
 class SegDetectorRepresenter():
     def __init__(self, thresh=0.3, box_thresh=0.7, max_candidates=1000, unclip_ratio=1.5):
         self.min_size = 3
@@ -37,7 +74,7 @@ class SegDetectorRepresenter():
         self.max_candidates = max_candidates
         self.unclip_ratio = unclip_ratio
 
-    def __call__(self, batch, pred, is_output_polygon=False):
+    def __call__(self, batch, pred, is_output_polygon=False, min_score=None, timer=None):
         '''
         batch: (image, polygons, ignore_tags
         batch: a dict produced by dataloaders.
@@ -56,14 +93,15 @@ class SegDetectorRepresenter():
         boxes_batch = []
         scores_batch = []
         # print(pred.size())
-        batch_size = pred.size(0) if isinstance(pred, torch.Tensor) else pred.shape[0]
+        batch_size = pred.size(0) if is_tensor(pred) else pred.shape[0]
         for batch_index in range(batch_size):
             # height, width = batch['shape'][batch_index]
             height, width = pred.shape[1], pred.shape[2]
             if is_output_polygon:
                 boxes, scores = self.polygons_from_bitmap(pred[batch_index], segmentation[batch_index], width, height)
             else:
-                boxes, scores = self.boxes_from_bitmap(pred[batch_index], segmentation[batch_index], width, height)
+                boxes, scores = self.boxes_from_bitmap(
+                    pred[batch_index], segmentation[batch_index], width, height, min_score, timer)
             boxes_batch.append(boxes)
             scores_batch.append(scores)
         return boxes_batch, scores_batch
@@ -120,14 +158,17 @@ class SegDetectorRepresenter():
             scores.append(score)
         return boxes, scores
 
-    def boxes_from_bitmap(self, pred, _bitmap, dest_width, dest_height):
+    def boxes_from_bitmap(self, pred, _bitmap, dest_width, dest_height, min_score=None, timer=None):
         '''
         _bitmap: single map with shape (H, W),
             whose values are binarized as {0, 1}
+        min_score: only return the boxes scoring above it. If None, there is a row for every one of the first
+            max_candidates contours, left zero for contours too thin to make a box
+        timer: optional StageTimer, marked after finding, scoring and unclipping the contours
         '''
 
         assert len(_bitmap.shape) == 2
-        if isinstance(pred, torch.Tensor):
+        if is_tensor(pred):
             bitmap = _bitmap.cpu().numpy()  # The first channel
             pred = pred.cpu().detach().numpy()
         else:
@@ -135,39 +176,48 @@ class SegDetectorRepresenter():
         height, width = bitmap.shape
         contours, _ = cv2.findContours((bitmap * 255).astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
         num_contours = min(len(contours), self.max_candidates)
-        boxes = np.zeros((num_contours, 4, 2), dtype=np.int16)
-        scores = np.zeros((num_contours,), dtype=np.float32)
+        mark_stage(timer, 'lines_contours')
 
+        # contours are scored before anything is unclipped, most of them are rejected here
+        points = np.zeros((num_contours, 4, 2), dtype=np.float32)
+        scores = np.zeros((num_contours,), dtype=np.float32)
+        kept = np.zeros((num_contours,), dtype=bool)
         for index in range(num_contours):
             contour = contours[index].squeeze(1)
-            points, sside = self.get_mini_boxes(contour)
-            # if sside < self.min_size:
-            #     continue
-            if sside < 2:
+            bounding_box = cv2.minAreaRect(contour)
+            if min(bounding_box[1]) < 2:
                 continue
-            points = np.array(points)
-            score = self.box_score_fast(pred, contour)
-            # if self.box_thresh > score:
-            #     continue
-
-            box = self.unclip(points, unclip_ratio=self.unclip_ratio).reshape(-1, 1, 2)
-            box, sside = self.get_mini_boxes(box)
-            # if sside < 5:
-            #     continue
-            box = np.array(box)
-            if not isinstance(dest_width, int):
-                dest_width = dest_width.item()
-                dest_height = dest_height.item()
-
-            box[:, 0] = np.clip(np.round(box[:, 0] / width * dest_width), 0, dest_width)
-            box[:, 1] = np.clip(np.round(box[:, 1] / height * dest_height), 0, dest_height)
-            boxes[index, :, :] = box.astype(np.int16)
-            scores[index] = score
+            scores[index] = self.box_score_fast(pred, contour)
+            if min_score is not None and not scores[index] > min_score:
+                continue
+            points[index] = cv2.boxPoints(bounding_box)
+            kept[index] = True
+        kept_index = np.flatnonzero(kept)
+        points[kept_index] = order_box_points(points[kept_index])
+        mark_stage(timer, 'lines_score')
+
+        distances = unclip_distances(points[kept_index], self.unclip_ratio)
+        boxes = np.zeros((num_contours, 4, 2), dtype=np.float32)
+        for index, distance in zip(kept_index.tolist(), distances.tolist()):
+            offset = pyclipper.PyclipperOffset()
+            offset.AddPath(points[index], pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
+            expanded = np.array(offset.Execute(distance)).reshape(-1, 1, 2)
+            boxes[index] = cv2.boxPoints(cv2.minAreaRect(expanded))
+        boxes[kept_index] = order_box_points(boxes[kept_index])
+        mark_stage(timer, 'lines_unclip')
+
+        if not isinstance(dest_width, int):
+            dest_width = dest_width.item()
+            dest_height = dest_height.item()
+        boxes[..., 0] = np.clip(np.round(boxes[..., 0] / width * dest_width), 0, dest_width)
+        boxes[..., 1] = np.clip(np.round(boxes[..., 1] / height * dest_height), 0, dest_height)
+        boxes = boxes.astype(np.int16)
+        if min_score is not None:
+            boxes, scores = boxes[kept_index], scores[kept_index]
         return boxes, scores
 
     def unclip(self, box, unclip_ratio=1.5):
-        poly = Polygon(box)
-        distance = poly.area * unclip_ratio / poly.length
+        distance = unclip_distances(np.asarray(box)[None], unclip_ratio)[0]
         offset = pyclipper.PyclipperOffset()
         offset.AddPath(box, pyclipper.JT_ROUND, pyclipper.ET_CLOSEDPOLYGON)
         expanded = np.array(offset.Execute(distance))
@@ -206,9 +256,10 @@ class SegDetectorRepresenter():
         box[:, 0] = box[:, 0] - xmin
         box[:, 1] = box[:, 1] - ymin
         cv2.fillPoly(mask, box.reshape(1, -1, 2).astype(np.int32), 1)
+        bitmap = bitmap[ymin:ymax + 1, xmin:xmax + 1]
         if bitmap.dtype == np.float16:
             bitmap = bitmap.astype(np.float32)
-        return cv2.mean(bitmap[ymin:ymax + 1, xmin:xmax + 1], mask)[0]
+        return cv2.mean(bitmap, mask)[0]
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""
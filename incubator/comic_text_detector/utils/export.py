@@ -1,8 +1,11 @@
-import onnx
-import onnxsim
+import argparse
+import importlib.util
+import inspect
+
 import torch
 import torch.nn as nn
 
+from comic_text_detector.basemodel import DBHead, TextDetBase
 from comic_text_detector.models.yolov5.common import Conv
 from comic_text_detector.models.yolov5.yolo import Detect
 
@@ -19,8 +22,11 @@ def concate_models(blk_weights, seg_weights, det_weights, save_path):
     textdetector_dict['text_det'] = torch.load(det_weights, map_location='cpu')['weights']
     torch.save(textdetector_dict, save_path)
 
-def export_onnx(model, im, file, opset, train=False, simplify=True, dynamic=False, inplace=False):
+def export_onnx(model, im, file, opset, train=False, simplify=True, dynamic=False, inplace=False, shrink_only=False):
     # YOLOv5 ONNX export
+    # shrink_only: the DB line map output only has the shrink map channel, without the threshold branch.
+    # The default keeps the two channel line map of the released models.
+    # simplify: checked and simplified with onnx and onnxsim, only needed then
     f = file + '.onnx'
     for k, m in model.named_modules():
         if isinstance(m, Conv):  # assign export-friendly activations
@@ -28,15 +34,27 @@ def export_onnx(model, im, file, opset, train=False, simplify=True, dynamic=Fals
                 m.act = SiLU()
         elif isinstance(m, Detect):
             m.inplace = inplace
-            m.onnx_dynamic = False
+            m.onnx_dynamic = dynamic  # grids follow the input shape
+        elif isinstance(m, DBHead):
+            m.shrink_only = shrink_only
+    # newer torch versions export through dynamo by default, which needs onnxscript
+    export_options = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
     torch.onnx.export(model, im, f, verbose=False, opset_version=opset,
                         training=torch.onnx.TrainingMode.TRAINING if train else torch.onnx.TrainingMode.EVAL,
                         do_constant_folding=not train,
                         input_names=['images'],
                         output_names=['blk', 'seg', 'det'],
                         dynamic_axes={'images': {0: 'batch', 2: 'height', 3: 'width'},  # shape(1,3,640,640)
-                                    'output': {0: 'batch', 1: 'anchors'}  # shape(1,25200,85)
-                                    } if dynamic else None)
+                                    'blk': {0: 'batch', 1: 'anchors'},  # shape(1,25200,7)
+                                    'seg': {0: 'batch', 2: 'height', 3: 'width'},
+                                    'det': {0: 'batch', 2: 'height', 3: 'width'},
+                                    } if dynamic else None,
+                        **export_options)
+    if not simplify:
+        return
+
+    import onnx
+    import onnxsim
 
     # Checks
     model_onnx = onnx.load(f)  # load onnx model
@@ -47,4 +65,27 @@ def export_onnx(model, im, file, opset, train=False, simplify=True, dynamic=Fals
         dynamic_input_shape=dynamic,
         input_shapes={'images': list(im.shape)} if dynamic else None)
     assert check, 'assert check failed'
-    onnx.save(model_onnx, f)
\ No newline at end of file
+    onnx.save(model_onnx, f)
+
+def main():
+    parser = argparse.ArgumentParser(description='export the text detector to onnx, as <model>.onnx')
+    parser.add_argument('model', help='text detector checkpoint, e.g. comictextdetector.pt')
+    parser.add_argument('--input-size', type=int, default=1024)
+    parser.add_argument('--opset', type=int, default=14)
+    parser.add_argument('--dynamic', action='store_true', help='dynamic batch size and input shape')
+    parser.add_argument('--shrink-only', action='store_true', help='line map without the DB threshold channel')
+    parser.add_argument('--no-simplify', dest='simplify', action='store_false',
+                        help='export as traced, without onnx and onnxsim')
+    parser.add_argument('--output', help='output path without .onnx, defaults to the model path')
+    args = parser.parse_args()
+    if args.simplify and not all(importlib.util.find_spec(name) for name in ('onnx', 'onnxsim')):
+        parser.error('simplifying the model needs onnx and onnxsim: pip install onnx onnxsim, or pass --no-simplify')
+
+    model = TextDetBase(args.model).eval()
+    im = torch.zeros(1, 3, args.input_size, args.input_size)
+    export_onnx(model, im, args.output or args.model, args.opset, simplify=args.simplify, dynamic=args.dynamic,
+                shrink_only=args.shrink_only)
+
+
+if __name__ == '__main__':
+    main()
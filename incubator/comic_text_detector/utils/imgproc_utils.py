@@ -116,6 +116,16 @@ def letterbox(im, new_shape=(640, 640), color=(0, 0, 0), auto=False, scaleFill=F
     im = cv2.copyMakeBorder(im, 0, dh, 0, dw, cv2.BORDER_CONSTANT, value=color)  # add border
     return im, ratio, (dw, dh)
 
+def images_to_blob(imgs):
+    # letterboxed HWC uint8 images of one shape to an N x 3 x H x W float32 batch in [0, 1], channels reversed.
+    # Each image is written straight into its slot of the batch, no per image array is stacked
+    im_h, im_w = imgs[0].shape[:2]
+    out = np.empty((len(imgs), 3, im_h, im_w), np.float32)
+    for ii, img in enumerate(imgs):
+        out[ii] = img.transpose((2, 0, 1))[::-1]
+    out /= 255
+    return out
+
 def resize_keepasp(im, new_shape=640, scaleup=True, interpolation=cv2.INTER_LINEAR, stride=None):
     shape = im.shape[:2]  # current shape [height, width]
 
@@ -1,6 +1,7 @@
 import glob
 import json
 import os.path as osp
+import sys
 from pathlib import Path
 
 import cv2
@@ -26,17 +27,28 @@ class NumpyEncoder(json.JSONEncoder):
                 return int(obj)
         return json.JSONEncoder.default(self, obj)
 
-def find_all_imgs(img_dir, abs_path=False):
+def is_tensor(x):
+    # torch is only imported by the torch backend, until then nothing can be a tensor
+    torch = sys.modules.get('torch')
+    return torch is not None and isinstance(x, torch.Tensor)
+
+def to_numpy(x):
+    if is_tensor(x):
+        return x.detach().cpu().float().numpy()
+    return x
+
+def find_all_imgs(img_dir, abs_path=False, recursive=False):
+    # with recursive, also the images of every subdirectory, named by their path relative to img_dir
     imglist = list()
-    for filep in glob.glob(osp.join(img_dir, "*")):
-        filename = osp.basename(filep)
-        file_suffix = Path(filename).suffix
-        if file_suffix.lower() not in IMG_EXT:
+    pattern = osp.join(glob.escape(img_dir), '**', '*') if recursive else osp.join(glob.escape(img_dir), '*')
+    for filep in sorted(glob.glob(pattern, recursive=recursive)):
+        file_suffix = Path(filep).suffix
+        if file_suffix.lower() not in IMG_EXT or not osp.isfile(filep):
             continue
         if abs_path:
             imglist.append(filep)
         else:
-            imglist.append(filename)
+            imglist.append(osp.relpath(filep, img_dir))
     return imglist
 
 imread = lambda imgpath, read_type=cv2.IMREAD_COLOR: cv2.imdecode(np.fromfile(imgpath, dtype=np.uint8), read_type)
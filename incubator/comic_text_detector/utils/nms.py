@@ -0,0 +1,88 @@
+import numpy as np
+
+# above it nms walks the boxes one by one instead of comparing all pairs up front
+MATRIX_NMS_MAX_BOXES = 1024
+
+
+def xywh2xyxy(x: np.ndarray) -> np.ndarray:
+    # nx4 boxes from [x, y, w, h] to [x1, y1, x2, y2] where xy1=top-left, xy2=bottom-right
+    y = np.empty_like(x)
+    y[:, 0] = x[:, 0] - x[:, 2] / 2
+    y[:, 1] = x[:, 1] - x[:, 3] / 2
+    y[:, 2] = x[:, 0] + x[:, 2] / 2
+    y[:, 3] = x[:, 1] + x[:, 3] / 2
+    return y
+
+
+def nms(boxes: np.ndarray, scores: np.ndarray, iou_thresh: float, groups: np.ndarray = None, max_keep=None) -> np.ndarray:
+    '''
+    Greedy non-maximum suppression of xyxy boxes, as torchvision.ops.nms computes it.
+    With groups, a box only suppresses boxes of the same group, so classes can share one call.
+    Returns the indices of the kept boxes by decreasing score, stopping after max_keep of them.
+    '''
+    order = np.argsort(-scores, kind='stable')
+    boxes = boxes[order]
+    groups = None if groups is None else groups[order]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+    def suppressed_by(ii, rest):
+        w = np.maximum(np.minimum(boxes[ii, 2], boxes[rest, 2]) - np.maximum(boxes[ii, 0], boxes[rest, 0]), 0)
+        h = np.maximum(np.minimum(boxes[ii, 3], boxes[rest, 3]) - np.maximum(boxes[ii, 1], boxes[rest, 1]), 0)
+        inter = w * h
+        suppressed = inter / (areas[ii] + areas[rest] - inter) > iou_thresh
+        if groups is not None:
+            suppressed &= groups[rest] == groups[ii]
+        return suppressed
+
+    keep = []
+    if len(boxes) <= MATRIX_NMS_MAX_BOXES:
+        # every pair at once, the greedy pass is then one row per kept box
+        index = np.arange(len(boxes))
+        suppressed = suppressed_by(index[:, None], index[None, :])
+        removed = np.zeros(len(boxes), dtype=bool)
+        for ii in range(len(boxes)):
+            if removed[ii]:
+                continue
+            keep.append(ii)
+            if max_keep is not None and len(keep) >= max_keep:
+                break
+            removed |= suppressed[ii]
+    else:
+        # the boxes not suppressed yet, highest score first
+        remaining = np.arange(len(boxes))
+        while len(remaining) > 0 and (max_keep is None or len(keep) < max_keep):
+            ii, rest = remaining[0], remaining[1:]
+            keep.append(ii)
+            remaining = rest[~suppressed_by(ii, rest)]
+    return order[np.array(keep, dtype=np.int64)]
+
+
+def non_max_suppression(prediction, conf_thresh=0.25, iou_thresh=0.45, agnostic=False, max_det=300, max_nms=30000):
+    '''
+    NMS of YOLO outputs on numpy arrays, for any backend.
+    prediction: (batch, boxes, 5 + classes) of [x, y, w, h, obj_conf, class confs...]
+    Boxes are pre-filtered by objectness and class confidence, then at most max_nms boxes per image, highest confidence first,
+    go through one NMS call per image with boxes grouped by class.
+    Returns an (n, 6) array of [x1, y1, x2, y2, conf, cls] per image, by decreasing confidence.
+    '''
+    assert 0 <= conf_thresh <= 1, f'Invalid Confidence threshold {conf_thresh}, valid values are between 0.0 and 1.0'
+    assert 0 <= iou_thresh <= 1, f'Invalid IoU {iou_thresh}, valid values are between 0.0 and 1.0'
+    prediction = np.asarray(prediction, dtype=np.float32)
+    output = [np.zeros((0, 6), dtype=np.float32) for _ in range(len(prediction))]
+    for xi, x in enumerate(prediction):
+        x = x[x[:, 4] > conf_thresh]
+        if len(x) == 0:
+            continue
+        cls_conf = x[:, 5:] * x[:, 4:5]  # conf = obj_conf * cls_conf
+        cls = cls_conf.argmax(axis=1)
+        conf = cls_conf[np.arange(len(x)), cls]
+        det = np.concatenate([xywh2xyxy(x[:, :4]), conf[:, None], cls[:, None].astype(np.float32)], axis=1)
+        det = det[conf > conf_thresh]
+        if len(det) == 0:
+            continue
+        if len(det) > max_nms:
+            det = det[np.argsort(-det[:, 4], kind='stable')[:max_nms]]
+        groups = None if agnostic else det[:, 5].astype(np.int64)
+        keep = nms(det[:, :4], det[:, 4], iou_thresh, groups, max_det)
+        output[xi] = det[keep]
+    return output
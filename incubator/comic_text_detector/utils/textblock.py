@@ -4,9 +4,8 @@ from typing import List
 
 import cv2
 import numpy as np
-from shapely.geometry import Polygon
 
-from comic_text_detector.utils.imgproc_utils import union_area, xywh2xyxypoly, rotate_polygons
+from comic_text_detector.utils.imgproc_utils import xywh2xyxypoly, rotate_polygons
 
 LANG_LIST = ['eng', 'ja', 'unknown']
 LANGCLS2IDX = {'eng': 0, 'ja': 1, 'unknown': 2}
@@ -266,17 +265,290 @@ class TextBlock(object):
             return self.default_stroke_width
         return 0
 
-def sort_textblk_list(blk_list: List[TextBlock], im_w: int, im_h: int) -> List[TextBlock]:
-    if len(blk_list) == 0:
-        return blk_list
-    num_ja = 0
-    xyxy = []
-    for blk in blk_list:
-        if blk.language == 'ja':
-            num_ja += 1
-        xyxy.append(blk.xyxy)
-    xyxy = np.array(xyxy)
-    flip_lr = num_ja > len(blk_list) / 2
+def _column(name, get=None, put=None):
+    # a TextBlockView attribute stored in the TextBlockBatch array of the same name
+    def fget(self):
+        value = getattr(self._batch, name)[self._index]
+        return value if get is None else get(value)
+
+    def fset(self, value):
+        getattr(self._batch, name)[self._index] = value if put is None else put(value)
+
+    return property(fget, fset)
+
+def _optional(value):
+    return None if np.isnan(value).any() else value
+
+def _nan_if_none(value):
+    return np.nan if value is None else value
+
+
+class TextBlockView(TextBlock):
+    '''
+    A TextBlock whose boxes, lines and scalar attributes live in a TextBlockBatch,
+    reads and writes go to the batch arrays. lines, distance and vec are array views, xyxy a list like TextBlock's.
+    Other attributes (text, colors, fonts...) are kept per block by the batch.
+    The number of lines of a block is fixed, use TextBlockBatch.to_block for a standalone TextBlock.
+    '''
+
+    def __init__(self, batch, index):
+        object.__setattr__(self, '_batch', batch)
+        object.__setattr__(self, '_index', index)
+
+    xyxy = _column('xyxy', get=lambda v: v.tolist(), put=lambda xyxy: [int(num) for num in xyxy])
+    language = _column('language', get=lambda v: LANG_LIST[v], put=lambda v: LANGCLS2IDX[v])
+    vertical = _column('vertical', get=bool)
+    font_size = _column('font_size', get=float)
+    angle = _column('angle', get=int)
+    vec = _column('vec', get=_optional, put=_nan_if_none)
+    norm = _column('norm', get=float)
+    merged = _column('merged', get=bool)
+    weight = _column('weight', get=float)
+
+    @property
+    def lines(self):
+        start, end = self._batch.offsets[self._index: self._index + 2]
+        return self._batch.lines[start: end]
+
+    @lines.setter
+    def lines(self, lines):
+        start, end = self._batch.offsets[self._index: self._index + 2]
+        lines = np.asarray(lines).reshape(-1, 4, 2)
+        if len(lines) != end - start:
+            raise ValueError('the number of lines of a block in a TextBlockBatch is fixed')
+        self._batch.lines[start: end] = lines
+
+    @property
+    def distance(self):
+        start, end = self._batch.offsets[self._index: self._index + 2]
+        return _optional(self._batch.distance[start: end]) if end > start else None
+
+    @distance.setter
+    def distance(self, distance):
+        start, end = self._batch.offsets[self._index: self._index + 2]
+        self._batch.distance[start: end] = _nan_if_none(distance)
+
+    def adjust_bbox(self, with_bbox=False):
+        adjust_textblk_bboxes(self._batch, [self._index], with_bbox=with_bbox)
+
+    def __getattr__(self, name):
+        # only called for attributes that are not columns
+        if name.startswith('__') or name in ('_batch', '_index'):
+            raise AttributeError(name)
+        extras = self._batch.block_extras(self._index)
+        if name not in extras:
+            if name not in TEXTBLOCK_DEFAULTS:
+                raise AttributeError(name)
+            extras[name] = copy.deepcopy(TEXTBLOCK_DEFAULTS[name])
+        return extras[name]
+
+    def __setattr__(self, name, value):
+        if isinstance(getattr(type(self), name, None), property):
+            object.__setattr__(self, name, value)
+        else:
+            self._batch.block_extras(self._index)[name] = value
+
+    def __copy__(self):
+        return self._batch.to_block(self._index)
+
+    def __deepcopy__(self, memo):
+        return self._batch.to_block(self._index)
+
+    def to_dict(self):
+        return self._batch.block_dict(self._index)
+
+
+# attributes of a fresh TextBlock, the fields of TextBlock.to_dict
+TEXTBLOCK_DEFAULTS = vars(TextBlock([0, 0, 0, 0]))
+TEXTBLOCK_COLUMNS = ('xyxy', 'lines', 'language', 'vertical', 'font_size', 'distance', 'angle', 'vec', 'norm', 'merged', 'weight')
+
+
+class TextBlockBatch:
+    '''
+    Columnar storage of the text blocks of a page.
+    Boxes, flags and scalar attributes are arrays with one row per block, the line polygons of all blocks are
+    one (N_lines, 4, 2) array, block i owns lines[offsets[i]: offsets[i + 1]], as does the per line distance.
+    Unset vec and distance are nan, a block whose distance does not have one value per line has none.
+    Iterating and indexing give TextBlockView objects, so it can be used where a list of TextBlock is expected.
+    '''
+
+    def __init__(self, xyxy, lines, offsets, language=None, vertical=None, font_size=None, distance=None,
+                 angle=None, vec=None, norm=None, merged=None, weight=None, extras=None):
+        num_blks = len(offsets) - 1
+        self.xyxy = np.asarray(xyxy, np.int64).reshape(num_blks, 4)
+        self.lines = np.asarray(lines, np.int64).reshape(-1, 4, 2)
+        self.offsets = np.asarray(offsets, np.int64)
+        num_lines = len(self.lines)
+
+        def column(value, default, dtype, shape=(num_blks,)):
+            if value is None:
+                return np.full(shape, default, dtype)
+            return np.asarray(value, dtype).reshape(shape)
+
+        self.language = column(language, LANGCLS2IDX['unknown'], np.int8)
+        self.vertical = column(vertical, False, bool)
+        self.font_size = column(font_size, -1, np.float64)
+        self.distance = column(distance, np.nan, np.float64, (num_lines,))
+        self.angle = column(angle, 0, np.int64)
+        self.vec = column(vec, np.nan, np.float64, (num_blks, 2))
+        self.norm = column(norm, -1, np.float64)
+        self.merged = column(merged, False, bool)
+        self.weight = column(weight, -1, np.float64)
+        # attributes that are not columns, a dict per block, created when first written
+        self.extras = [None] * num_blks if extras is None else list(extras)
+
+    @classmethod
+    def from_blocks(cls, blk_list: List[TextBlock]) -> 'TextBlockBatch':
+        num_blks = len(blk_list)
+        lines = [np.asarray(blk.lines, np.int64).reshape(-1, 4, 2) for blk in blk_list]
+        counts = np.array([len(l) for l in lines], np.int64)
+        offsets = np.zeros(num_blks + 1, np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        distance = np.full(offsets[-1], np.nan)
+        for ii, blk in enumerate(blk_list):
+            # blocks split from a larger one keep the distances of all its lines, those are dropped
+            if blk.distance is not None and len(blk.distance) == counts[ii]:
+                distance[offsets[ii]: offsets[ii + 1]] = blk.distance
+        extras = []
+        for blk in blk_list:
+            extra = {k: v for k, v in vars(blk).items()
+                     if k not in TEXTBLOCK_COLUMNS and k not in ('_batch', '_index')
+                     and not (k in TEXTBLOCK_DEFAULTS and _same_value(v, TEXTBLOCK_DEFAULTS[k]))}
+            if isinstance(blk, TextBlockView):
+                extra.update(blk._batch.extras[blk._index] or {})
+            extras.append(extra or None)
+        return cls(
+            xyxy=np.array([blk.xyxy for blk in blk_list], np.int64).reshape(num_blks, 4),
+            lines=np.concatenate(lines) if num_blks > 0 else np.zeros((0, 4, 2), np.int64),
+            offsets=offsets,
+            language=[LANGCLS2IDX[blk.language] for blk in blk_list],
+            vertical=[blk.vertical for blk in blk_list],
+            font_size=[blk.font_size for blk in blk_list],
+            distance=distance,
+            angle=[blk.angle for blk in blk_list],
+            vec=[_nan_if_none(blk.vec) * np.ones(2) for blk in blk_list],
+            norm=[blk.norm for blk in blk_list],
+            merged=[blk.merged for blk in blk_list],
+            weight=[blk.weight for blk in blk_list],
+            extras=extras,
+        )
+
+    @classmethod
+    def concatenate(cls, batches: List['TextBlockBatch']) -> 'TextBlockBatch':
+        if len(batches) == 0:
+            return cls.from_blocks([])
+        offsets, num_lines = [np.zeros(1, np.int64)], 0
+        for batch in batches:
+            offsets.append(batch.offsets[1:] + num_lines)
+            num_lines += batch.offsets[-1]
+        return cls(
+            xyxy=np.concatenate([b.xyxy for b in batches]),
+            lines=np.concatenate([b.lines for b in batches]),
+            offsets=np.concatenate(offsets),
+            extras=[extra for b in batches for extra in b.extras],
+            **{name: np.concatenate([getattr(b, name) for b in batches])
+               for name in TEXTBLOCK_COLUMNS if name not in ('xyxy', 'lines')},
+        )
+
+    def take(self, indices) -> 'TextBlockBatch':
+        # blocks at indices, in that order
+        indices = np.asarray(indices, np.int64)
+        counts = np.diff(self.offsets)[indices]
+        offsets = np.zeros(len(indices) + 1, np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        line_indices = np.repeat(self.offsets[:-1][indices] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return TextBlockBatch(
+            xyxy=self.xyxy[indices],
+            lines=self.lines[line_indices],
+            offsets=offsets,
+            distance=self.distance[line_indices],
+            extras=[self.extras[ii] for ii in indices],
+            **{name: getattr(self, name)[indices]
+               for name in TEXTBLOCK_COLUMNS if name not in ('xyxy', 'lines', 'distance')},
+        )
+
+    def line_counts(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def line_blocks(self) -> np.ndarray:
+        # index of the block owning each line
+        return np.repeat(np.arange(len(self)), self.line_counts())
+
+    def block_extras(self, index) -> dict:
+        if self.extras[index] is None:
+            self.extras[index] = {}
+        return self.extras[index]
+
+    def to_block(self, index) -> TextBlock:
+        start, end = self.offsets[index: index + 2]
+        distance = self.distance[start: end]
+        vec = self.vec[index]
+        blk = TextBlock(self.xyxy[index].tolist(),
+                        lines=self.lines[start: end].tolist(),
+                        language=LANG_LIST[self.language[index]],
+                        vertical=bool(self.vertical[index]),
+                        font_size=float(self.font_size[index]),
+                        distance=None if np.isnan(distance).any() else distance,
+                        angle=int(self.angle[index]),
+                        vec=None if np.isnan(vec).any() else vec,
+                        norm=float(self.norm[index]),
+                        merged=bool(self.merged[index]),
+                        weight=float(self.weight[index]))
+        for name, value in (self.extras[index] or {}).items():
+            setattr(blk, name, copy.deepcopy(value))
+        return blk
+
+    def to_blocks(self) -> List[TextBlock]:
+        return [self.to_block(ii) for ii in range(len(self))]
+
+    def block_dict(self, index) -> dict:
+        # same fields as TextBlock.to_dict, with plain python values
+        start, end = self.offsets[index: index + 2]
+        distance = self.distance[start: end]
+        vec = self.vec[index]
+        blk_dict = copy.deepcopy(TEXTBLOCK_DEFAULTS)
+        blk_dict.update(copy.deepcopy(self.extras[index] or {}))
+        blk_dict.update(
+            xyxy=self.xyxy[index].tolist(),
+            lines=self.lines[start: end].tolist(),
+            language=LANG_LIST[self.language[index]],
+            vertical=bool(self.vertical[index]),
+            font_size=float(self.font_size[index]),
+            distance=None if np.isnan(distance).any() else distance.tolist(),
+            angle=int(self.angle[index]),
+            vec=None if np.isnan(vec).any() else vec.tolist(),
+            norm=float(self.norm[index]),
+            merged=bool(self.merged[index]),
+            weight=float(self.weight[index]),
+        )
+        return blk_dict
+
+    def to_dict_list(self) -> List[dict]:
+        return [self.block_dict(ii) for ii in range(len(self))]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index) -> TextBlockView:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return TextBlockView(self, index)
+
+    def __iter__(self):
+        return (TextBlockView(self, ii) for ii in range(len(self)))
+
+
+def _same_value(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return False
+    return type(a) == type(b) and a == b
+
+
+def textblk_grid_weights(xyxy: np.ndarray, num_ja: int, im_w: int, im_h: int) -> np.ndarray:
+    # reading order weights, blocks are read grid cell by grid cell, right to left for japanese pages
+    flip_lr = num_ja > len(xyxy) / 2
     im_oriw = im_w
     if im_w > im_h:
         im_w /= 2
@@ -295,7 +567,26 @@ def sort_textblk_list(blk_list: List[TextBlock], im_w: int, im_h: int) -> List[T
     grid_weights = grid_indices * img_area + 1.2 * (center_x - grid_x * im_w / num_gridx) + (center_y - grid_y * im_h / num_gridy)
     if im_w != im_oriw:
         grid_weights[np.where(grid_x >= num_gridx)] += img_area * num_gridy * num_gridx
-    
+    return grid_weights
+
+def sort_textblk_list(blk_list: List[TextBlock], im_w: int, im_h: int) -> List[TextBlock]:
+    if len(blk_list) == 0:
+        return blk_list
+    if isinstance(blk_list, TextBlockBatch):
+        num_ja = int((blk_list.language == LANGCLS2IDX['ja']).sum())
+        grid_weights = textblk_grid_weights(blk_list.xyxy, num_ja, im_w, im_h)
+        order = np.argsort(grid_weights, kind='stable')
+        blk_list = blk_list.take(order)
+        blk_list.weight[:] = grid_weights[order]
+        return blk_list
+
+    num_ja = 0
+    xyxy = []
+    for blk in blk_list:
+        if blk.language == 'ja':
+            num_ja += 1
+        xyxy.append(blk.xyxy)
+    grid_weights = textblk_grid_weights(np.array(xyxy), num_ja, im_w, im_h)
     for blk, weight in zip(blk_list, grid_weights):
         blk.weight = weight
     blk_list.sort(key=lambda blk: blk.weight)
@@ -343,6 +634,122 @@ def examine_textblk(blk: TextBlock, im_w: int, im_h: int, sort: bool = False) ->
     if sort:
         blk.sort_lines()
 
+def examine_textblocks(batch: TextBlockBatch, im_w: int, im_h: int, sort: bool = False) -> None:
+    # examine_textblk for every block of the batch at once, blocks need at least one line
+    lines = batch.lines.astype(np.float64)
+    starts = batch.offsets[:-1]
+    counts = batch.line_counts()
+    line_blks = batch.line_blocks()
+    if len(batch) == 0:
+        return
+    middle_pnts = (lines[:, [1, 2, 3, 0]] + lines) / 2
+    vec_v = middle_pnts[:, 2] - middle_pnts[:, 0]   # vertical vectors of textlines
+    vec_h = middle_pnts[:, 1] - middle_pnts[:, 3]   # horizontal vectors of textlines
+    center_pnts = (lines[:, 0] + lines[:, 2]) / 2
+    v = np.add.reduceat(vec_v, starts, axis=0)
+    h = np.add.reduceat(vec_h, starts, axis=0)
+    norm_v, norm_h = np.linalg.norm(v, axis=1), np.linalg.norm(h, axis=1)
+    is_ja = batch.language == LANGCLS2IDX['ja']
+    vertical = np.where(is_ja, norm_v > norm_h, norm_v > norm_h * 2)
+
+    primary_vec = np.where(vertical[:, None], v, h)
+    primary_norm = np.where(vertical, norm_v, norm_h)
+    # vertical manga text is read from right to left, so origin is (imw, 0)
+    origin = np.where(vertical[:, None], np.array([[im_w, 0]], np.float64), np.array([[0, 0]], np.float64))
+    distance_vectors = center_pnts - origin[line_blks]
+    font_size = np.round(np.where(vertical, norm_h, norm_v) / counts)
+
+    rotation_angle = (np.arctan2(primary_vec[:, 1], primary_vec[:, 0]) / math.pi * 180).astype(np.int64)
+    distance = np.linalg.norm(distance_vectors, axis=1)
+    line_vec = primary_vec[line_blks]
+    rad_matrix = np.arccos((distance_vectors * line_vec).sum(axis=1) / (distance * primary_norm[line_blks]))
+    distance = np.abs(np.sin(rad_matrix) * distance)
+
+    angle = np.where(vertical, rotation_angle - 90, rotation_angle)
+    angle[np.abs(angle) < 3] = 0
+    batch.distance[:] = distance
+    batch.angle[:] = angle
+    batch.font_size[:] = font_size
+    batch.vertical[:] = vertical
+    batch.vec[:] = primary_vec
+    batch.norm[:] = primary_norm
+    if sort:
+        # lines of each block by distance, sorted block by block like TextBlock.sort_lines,
+        # so that lines at equal distances end up in the same order
+        order = np.arange(len(lines))
+        for start, end in zip(starts[counts > 1], (starts + counts)[counts > 1]):
+            order[start: end] = start + np.argsort(distance[start: end])
+        batch.lines[:] = batch.lines[order]
+        batch.distance[:] = distance[order]
+
+def adjust_textblk_bboxes(batch: TextBlockBatch, indices, with_bbox=False) -> None:
+    # TextBlock.adjust_bbox for the blocks at indices
+    indices = np.asarray(indices, np.int64)
+    if len(indices) == 0:
+        return
+    sub = batch.take(indices)
+    starts = sub.offsets[:-1]
+    lines_min = np.minimum.reduceat(sub.lines.min(axis=1), starts, axis=0)
+    lines_max = np.maximum.reduceat(sub.lines.max(axis=1), starts, axis=0)
+    xyxy = np.concatenate([lines_min, lines_max], axis=1)
+    if with_bbox:
+        xyxy[:, :2] = np.minimum(xyxy[:, :2], batch.xyxy[indices, :2])
+        xyxy[:, 2:] = np.maximum(xyxy[:, 2:], batch.xyxy[indices, 2:])
+    batch.xyxy[indices] = xyxy
+
+def quads_intersect(quads1, quads2) -> np.ndarray:
+    # pairwise test of (n, 4, 2) quads by separating axes, touching quads intersect as with shapely.
+    # Edge directions and the image axes are tried besides the edge normals, so degenerate quads are covered too
+    quads1, quads2 = np.asarray(quads1), np.asarray(quads2)
+    integer = np.issubdtype(quads1.dtype, np.integer) and np.issubdtype(quads2.dtype, np.integer)
+    dtype = np.int64 if integer else np.float64
+    quads1, quads2 = quads1.astype(dtype).reshape(-1, 4, 2), quads2.astype(dtype).reshape(-1, 4, 2)
+    edges = np.concatenate([np.roll(quads1, -1, axis=1) - quads1, np.roll(quads2, -1, axis=1) - quads2], axis=1)
+    normals = np.stack([-edges[..., 1], edges[..., 0]], axis=-1)
+    image_axes = np.broadcast_to(np.eye(2, dtype=dtype), (len(edges), 2, 2))
+    axes = np.concatenate([normals, edges, image_axes], axis=1)
+    proj1 = np.einsum('nad,npd->nap', axes, quads1)
+    proj2 = np.einsum('nad,npd->nap', axes, quads2)
+    separated = (proj1.max(axis=2) < proj2.min(axis=2)) | (proj2.max(axis=2) < proj1.min(axis=2))
+    return ~separated.any(axis=1)
+
+class LineGrid:
+    '''
+    Uniform grid over line bounding boxes, a box is registered in every cell it covers.
+    query returns the indices of the boxes intersecting a query box, in ascending order.
+    '''
+
+    def __init__(self, boxes: np.ndarray, cell_size: float):
+        self.boxes = np.asarray(boxes, np.float64).reshape(-1, 4)
+        self.cell_size = max(float(cell_size), 1.)
+        self.cells = {}
+        for idx, (cx1, cy1, cx2, cy2) in enumerate(self._cells(self.boxes).tolist()):
+            for cx in range(cx1, cx2 + 1):
+                for cy in range(cy1, cy2 + 1):
+                    self.cells.setdefault((cx, cy), []).append(idx)
+
+    def _cells(self, boxes):
+        return np.floor(boxes / self.cell_size).astype(np.int64)
+
+    def query(self, box) -> np.ndarray:
+        cx1, cy1, cx2, cy2 = self._cells(np.asarray(box, np.float64)).tolist()
+        if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) > len(self.cells):
+            candidates = np.arange(len(self.boxes))
+        else:
+            found = [self.cells.get((cx, cy), []) for cx in range(cx1, cx2 + 1) for cy in range(cy1, cy2 + 1)]
+            candidates = np.unique(np.fromiter((idx for idxs in found for idx in idxs), np.int64))
+        boxes = self.boxes[candidates]
+        hit = (boxes[:, 0] <= box[2]) & (boxes[:, 2] >= box[0]) & (boxes[:, 1] <= box[3]) & (boxes[:, 3] >= box[1])
+        return candidates[hit]
+
+def copy_textblk(blk: TextBlock) -> TextBlock:
+    # a shallow copy which does not share the lists that are modified in place
+    new_blk = copy.copy(blk)
+    new_blk.xyxy = list(blk.xyxy)
+    new_blk.lines = list(blk.lines)
+    new_blk.text = copy.copy(blk.text)
+    return new_blk
+
 def try_merge_textline(blk: TextBlock, blk2: TextBlock, fntsize_tol=1.3, distance_tol=2) -> bool:
     if blk2.merged:
         return False
@@ -354,8 +761,7 @@ def try_merge_textline(blk: TextBlock, blk2: TextBlock, fntsize_tol=1.3, distanc
     cos_vec = vec_prod / blk.norm / blk2.norm
     distance = blk2.distance[-1] - blk.distance[-1]
     distance_p1 = np.linalg.norm(np.array(blk2.lines[-1][0]) - np.array(blk.lines[-1][0]))
-    l1, l2 = Polygon(blk.lines[-1]), Polygon(blk2.lines[-1])
-    if not l1.intersects(l2):
+    if not quads_intersect([blk.lines[-1]], [blk2.lines[-1]])[0]:
         if fntsize_div > fntsize_tol or 1 / fntsize_div > fntsize_tol:
             return False
         if abs(cos_vec) < 0.866:   # cos30
@@ -374,16 +780,50 @@ def try_merge_textline(blk: TextBlock, blk2: TextBlock, fntsize_tol=1.3, distanc
     blk2.merged = True
     return True
 
-def merge_textlines(blk_list: List[TextBlock]) -> List[TextBlock]:
+def merge_textlines(blk_list: List[TextBlock], fntsize_tol=1.3, distance_tol=2) -> List[TextBlock]:
     if len(blk_list) < 2:
         return blk_list
     blk_list.sort(key=lambda blk: blk.distance[0])
+    # try_merge_textline only looks at the last line of both blocks. Blocks after the current one are
+    # left as they are until their turn, so their last lines are indexed once
+    last_lines = np.array([blk.lines[-1] for blk in blk_list], np.float64).reshape(-1, 4, 2)
+    line_boxes = np.concatenate([last_lines.min(axis=1), last_lines.max(axis=1)], axis=1)
+    first_points = last_lines[:, 0]
+    font_sizes = np.array([blk.font_size for blk in blk_list], np.float64)
+    # lines that do not intersect merge only within 2.5 times the average font size of both blocks,
+    # which is at most max(1, fntsize_tol) times that of the current block if the font sizes are positive
+    bounded_reach = bool((font_sizes > 0).all())
+    line_size = np.maximum(line_boxes[:, 2] - line_boxes[:, 0], line_boxes[:, 3] - line_boxes[:, 1])
+    grid = LineGrid(line_boxes, max(np.median(line_size), 2.5 * np.median(font_sizes)))
+
     merged_list = []
     for ii, current_blk in enumerate(blk_list):
         if current_blk.merged:
             continue
-        for jj, blk in enumerate(blk_list[ii+1:]):
-            try_merge_textline(current_blk, blk)
+        start = ii + 1
+        while start < len(blk_list):
+            # a merge changes the last line and font size of current_blk, the remaining blocks are queried again
+            last_line = np.array(current_blk.lines[-1], np.float64)
+            box = np.concatenate([last_line.min(axis=0), last_line.max(axis=0)])
+            if bounded_reach:
+                reach = 2.5 * max(1., fntsize_tol) * current_blk.font_size * (1 + 1e-6) + 1e-6
+                p = last_line[0]
+                query_box = np.concatenate([np.minimum(box[:2], p - reach), np.maximum(box[2:], p + reach)])
+                candidates = grid.query(query_box)
+                candidates = candidates[candidates >= start]
+                near = np.linalg.norm(first_points[candidates] - p, axis=1) <= reach
+                cand_boxes = line_boxes[candidates]
+                overlap = (cand_boxes[:, 0] <= box[2]) & (cand_boxes[:, 2] >= box[0]) & \
+                    (cand_boxes[:, 1] <= box[3]) & (cand_boxes[:, 3] >= box[1])
+                candidates = candidates[near | overlap]
+            else:
+                candidates = np.arange(start, len(blk_list))
+            for jj in candidates.tolist():
+                if try_merge_textline(current_blk, blk_list[jj], fntsize_tol, distance_tol):
+                    start = jj + 1
+                    break
+            else:
+                break
         merged_list.append(current_blk)
     for blk in merged_list:
         blk.adjust_bbox(with_bbox=False)
@@ -394,14 +834,15 @@ def split_textblk(blk: TextBlock):
     l0 = np.array(blk.lines[0])
     lines.sort(key=lambda line: np.linalg.norm(np.array(line[0]) - l0[0]))
     distance_tol = font_size * 2
-    current_blk = copy.deepcopy(blk)
+    current_blk = copy_textblk(blk)
     current_blk.lines = [l0]
     sub_blk_list = [current_blk]
     textblock_splitted = False
+    # whether each line intersects the one before it
+    intersects = quads_intersect(lines[:-1], lines[1:]) if len(lines) > 1 else []
     for jj, line in enumerate(lines[1:]):
-        l1, l2 = Polygon(lines[jj]), Polygon(line)
         split = False
-        if not l1.intersects(l2):
+        if not intersects[jj]:
             line_disance = abs(distance[jj+1] - distance[jj])
             if line_disance > distance_tol:
                 split = True
@@ -409,7 +850,7 @@ def split_textblk(blk: TextBlock):
                 if len(current_blk.lines) > 1 or line_disance > font_size:
                     split = abs(lines[jj][0][1] - line[0][1]) > font_size
         if split:
-            current_blk = copy.deepcopy(current_blk)
+            current_blk = copy_textblk(current_blk)
             current_blk.lines = [line]
             sub_blk_list.append(current_blk)
         else:
@@ -420,9 +861,52 @@ def split_textblk(blk: TextBlock):
             current_blk.adjust_bbox(with_bbox=False)
     return textblock_splitted, sub_blk_list
 
-def group_output(blks, lines, im_w, im_h, mask=None, sort_blklist=True) -> List[TextBlock]:
+def assign_textlines(lines, blk_xyxy: np.ndarray, bbox_score_thresh=0.4):
+    # the block covering the largest share of each line's bounding box, if that share is above bbox_score_thresh.
+    # Returns the line boxes and the block index of every line, -1 for unassigned lines
+    lines = np.asarray(lines, np.int64).reshape(-1, 4, 2)
+    line_boxes = np.concatenate([lines.min(axis=1), lines.max(axis=1)], axis=1)
+    bbox_idx = np.full(len(lines), -1, np.int64)
+    if len(lines) == 0 or len(blk_xyxy) == 0:
+        return line_boxes, bbox_idx
+
+    # union_area of every line and block: -1 when they do not intersect
+    blk_xyxy = np.asarray(blk_xyxy, np.int64)
+    x1 = np.maximum(line_boxes[:, None, 0], blk_xyxy[None, :, 0])
+    y1 = np.maximum(line_boxes[:, None, 1], blk_xyxy[None, :, 1])
+    x2 = np.minimum(line_boxes[:, None, 2], blk_xyxy[None, :, 2])
+    y2 = np.minimum(line_boxes[:, None, 3], blk_xyxy[None, :, 3])
+    inter = np.where((y2 < y1) | (x2 < x1), -1, (y2 - y1) * (x2 - x1))
+    line_area = (line_boxes[:, 3] - line_boxes[:, 1]) * (line_boxes[:, 2] - line_boxes[:, 0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = inter / line_area[:, None]
+    # degenerate lines score nan, which never wins; argmax keeps the first block among equal scores
+    scores[np.isnan(scores)] = -np.inf
+    best = scores.argmax(axis=1)
+    best_score = scores[np.arange(len(lines)), best]
+    assigned = best_score > bbox_score_thresh
+    bbox_idx[assigned] = best[assigned]
+    return line_boxes, bbox_idx
+
+def mask_box_scores(mask: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    # mask[y1: y2, x1: x2].mean() / 255 for every box, from one integral image. Empty boxes score nan
+    boxes = np.asarray(boxes, np.int64).reshape(-1, 4)
+    im_h, im_w = mask.shape[:2]
+    # slice bounds as python slicing resolves them
+    def bound(v, size):
+        return np.clip(np.where(v < 0, v + size, v), 0, size)
+    x1, x2 = bound(boxes[:, 0], im_w), bound(boxes[:, 2], im_w)
+    y1, y2 = bound(boxes[:, 1], im_h), bound(boxes[:, 3], im_h)
+    x2, y2 = np.maximum(x2, x1), np.maximum(y2, y1)
+    # int32 sums are exact as long as the whole mask sums below 2 ** 31
+    integral = cv2.integral(mask, sdepth=cv2.CV_32S if 255 * im_h * im_w < 2 ** 31 else cv2.CV_64F)
+    sums = integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums / ((y2 - y1) * (x2 - x1)) / 255
+
+def group_output(blks, lines, im_w, im_h, mask=None, sort_blklist=True) -> TextBlockBatch:
     blk_list: List[TextBlock] = []
-    scattered_lines = {'ver': [], 'hor': []}
+    scattered_lines = []
     for bbox, cls, conf in zip(*blks):
         # cls could give wrong result
         blk_list.append(TextBlock(bbox, language=LANG_LIST[cls]))
@@ -430,84 +914,88 @@ def group_output(blks, lines, im_w, im_h, mask=None, sort_blklist=True) -> List[
     # step1: filter & assign lines to textblocks
     bbox_score_thresh = 0.4
     mask_score_thresh = 0.1
-    for ii, line in enumerate(lines):
-        bx1, bx2 = line[:, 0].min(), line[:, 0].max()
-        by1, by2 = line[:, 1].min(), line[:, 1].max()
-        bbox_score, bbox_idx = -1, -1
-        line_area = (by2-by1) * (bx2-bx1)
-        for jj, blk in enumerate(blk_list):
-            score = union_area(blk.xyxy, [bx1, by1, bx2, by2]) / line_area
-            if bbox_score < score:
-                bbox_score = score
-                bbox_idx = jj
-        if bbox_score > bbox_score_thresh:
-            blk_list[bbox_idx].lines.append(line)
-        else:   # if no textblock was assigned, check whether there is "enough" textmask
-            if mask is not None:
-                mask_score = mask[by1: by2, bx1: bx2].mean() / 255
-                if mask_score < mask_score_thresh:
-                    continue
-            blk = TextBlock([bx1, by1, bx2, by2], [line])
-            examine_textblk(blk, im_w, im_h, sort=False)
-            if blk.vertical:
-                scattered_lines['ver'].append(blk)
-            else:
-                scattered_lines['hor'].append(blk)
+    line_boxes, bbox_idx = assign_textlines(lines, np.array([blk.xyxy for blk in blk_list]).reshape(-1, 4),
+                                            bbox_score_thresh)
+    for ii in np.flatnonzero(bbox_idx >= 0):
+        blk_list[bbox_idx[ii]].lines.append(lines[ii])
+    # if no textblock was assigned, check whether there is "enough" textmask
+    unassigned = np.flatnonzero(bbox_idx < 0)
+    if mask is not None:
+        mask_scores = mask_box_scores(mask, line_boxes[unassigned])
+        unassigned = unassigned[~(mask_scores < mask_score_thresh)]
+    for ii in unassigned:
+        scattered_lines.append(TextBlock(line_boxes[ii], [lines[ii]]))
 
     # step2: filter textblocks, sort & split textlines
-    final_blk_list = []
+    kept_blk_list = []
+    no_lines = [blk for blk in blk_list if len(blk.lines) == 0]
+    if mask is not None and len(no_lines) > 0:
+        no_lines_scores = mask_box_scores(mask, np.array([blk.xyxy for blk in no_lines]))
+        filtered = {id(blk) for blk, score in zip(no_lines, no_lines_scores) if score < mask_score_thresh}
+    else:
+        filtered = set()
     for blk in blk_list:
         # filter textblocks 
         if len(blk.lines) == 0:
+            if id(blk) in filtered:
+                continue
             bx1, by1, bx2, by2 = blk.xyxy
-            if mask is not None:
-                mask_score = mask[by1: by2, bx1: bx2].mean() / 255
-                if mask_score < mask_score_thresh:
-                    continue
             xywh = np.array([[bx1, by1, bx2-bx1, by2-by1]])
             blk.lines = xywh2xyxypoly(xywh).reshape(-1, 4, 2).tolist()
-        examine_textblk(blk, im_w, im_h, sort=True)
-        
-        # split manga text if there is a distance gap
-        textblock_splitted = False
-        if len(blk.lines) > 1:
-            if blk.language == 'ja':
-                textblock_splitted = True
-            elif blk.vertical:
-                textblock_splitted = True
-        if textblock_splitted:
-            textblock_splitted, sub_blk_list = split_textblk(blk)
-        else:
-            sub_blk_list = [blk]
-        # modify textblock to fit its textlines
+        kept_blk_list.append(blk)
+    batch = TextBlockBatch.from_blocks(kept_blk_list)
+    examine_textblocks(batch, im_w, im_h, sort=True)
+
+    # split manga text if there is a distance gap, blocks that are not split are kept in the batch.
+    # Split blocks have no distance: the block they come from had one per line of the whole block, which they
+    # used to keep, with a length that does not match their lines
+    multi_lines = batch.line_counts() > 1
+    try_split = multi_lines & ((batch.language == LANGCLS2IDX['ja']) | batch.vertical)
+    # modify textblock to fit its textlines
+    adjust_textblk_bboxes(batch, np.flatnonzero(~try_split), with_bbox=True)
+    unsplit = np.flatnonzero(~try_split)
+    split_blk_list, order = [], []
+    num_unsplit = 0
+    for ii in range(len(batch)):
+        if not try_split[ii]:
+            order.append(num_unsplit)
+            num_unsplit += 1
+            continue
+        textblock_splitted, sub_blk_list = split_textblk(batch.to_block(ii))
         if not textblock_splitted:
             for blk in sub_blk_list:
                 blk.adjust_bbox(with_bbox=True)
-        final_blk_list += sub_blk_list
+        for blk in sub_blk_list:
+            order.append(len(unsplit) + len(split_blk_list))
+            split_blk_list.append(blk)
+    parts = [TextBlockBatch.concatenate([batch.take(unsplit), TextBlockBatch.from_blocks(split_blk_list)]).take(order)]
 
     # step3: merge scattered lines, sort textblocks by "grid"
-    final_blk_list += merge_textlines(scattered_lines['hor'])
-    final_blk_list += merge_textlines(scattered_lines['ver'])
+    scattered = TextBlockBatch.from_blocks(scattered_lines)
+    examine_textblocks(scattered, im_w, im_h, sort=False)
+    scattered_list = scattered.to_blocks()
+    parts.append(TextBlockBatch.from_blocks(merge_textlines([blk for blk in scattered_list if not blk.vertical])))
+    parts.append(TextBlockBatch.from_blocks(merge_textlines([blk for blk in scattered_list if blk.vertical])))
+    final_blks = TextBlockBatch.concatenate(parts)
     if sort_blklist:
-        final_blk_list = sort_textblk_list(final_blk_list, im_w, im_h)
-
-    for blk in final_blk_list:
-        if blk.language == 'eng' and not blk.vertical:
-            num_lines = len(blk.lines)
-            if num_lines == 0:
-                continue
-            # blk.line_spacing = blk.bounding_rect()[3] / num_lines / blk.font_size
-            expand_size = max(int(blk.font_size * 0.1), 2)
-            rad = np.deg2rad(blk.angle)
-            shifted_vec = np.array([[[-1, -1],[1, -1],[1, 1],[-1, 1]]])
-            shifted_vec = shifted_vec * np.array([[[np.sin(rad), np.cos(rad)]]]) * expand_size
-            lines = blk.lines_array() + shifted_vec
-            lines[..., 0] = np.clip(lines[..., 0], 0, im_w-1)
-            lines[..., 1] = np.clip(lines[..., 1], 0, im_h-1)
-            blk.lines = lines.astype(np.int64).tolist()
-            blk.font_size += expand_size
-            
-    return final_blk_list
+        final_blks = sort_textblk_list(final_blks, im_w, im_h)
+
+    # pad horizontal english lines
+    padded = (final_blks.language == LANGCLS2IDX['eng']) & ~final_blks.vertical & (final_blks.line_counts() > 0)
+    if padded.any():
+        line_blks = final_blks.line_blocks()
+        padded_lines = padded[line_blks]
+        expand_size = np.maximum((final_blks.font_size * 0.1).astype(np.int64), 2)
+        rad = np.deg2rad(final_blks.angle)
+        shifted_vec = np.array([[[-1, -1],[1, -1],[1, 1],[-1, 1]]])
+        shifted_vec = shifted_vec * np.stack([np.sin(rad), np.cos(rad)], axis=1)[:, None] * expand_size[:, None, None]
+        lines = final_blks.lines[padded_lines] + shifted_vec[line_blks[padded_lines]]
+        lines[..., 0] = np.clip(lines[..., 0], 0, im_w-1)
+        lines[..., 1] = np.clip(lines[..., 1], 0, im_h-1)
+        final_blks.lines[padded_lines] = lines.astype(np.int64)
+        final_blks.font_size[padded] += expand_size[padded]
+
+    return final_blks
 
 def visualize_textblocks(canvas, blk_list:  List[TextBlock]):
     lw = max(round(sum(canvas.shape) / 2 * 0.003), 2)  # line width
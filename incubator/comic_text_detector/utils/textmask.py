@@ -1,3 +1,4 @@
+from concurrent.futures import Executor
 from typing import List
 
 import cv2
@@ -89,24 +90,20 @@ def merge_mask_list(mask_list, pred_mask, blk: TextBlock = None, pred_thresh=30,
         pred_mask = cv2.erode(pred_mask, element, iterations=1)
         _, pred_mask = cv2.threshold(pred_mask, 60, 255, cv2.THRESH_BINARY)
     connectivity = 8
+    # a component is merged when it brings mask_merged closer to pred_mask, that is when
+    # xor(mask_merged | component, pred_mask).sum() < xor(mask_merged, pred_mask).sum().
+    # Only the newly set pixels change the xor, each by 255 - 2 * pred, and components of one
+    # label image are disjoint, so all of them are decided at once from per label sums
+    pred_gain = 255 - 2 * pred_mask.astype(np.int64)
     mask_merged = np.zeros_like(pred_mask)
     for ii, (candidate_mask, xor_sum) in enumerate(mask_list):
         num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(candidate_mask, connectivity, cv2.CV_16U)
-        for label_index, stat, centroid in zip(range(num_labels), stats, centroids):
-            if label_index != 0: # skip background label
-                x, y, w, h, area = stat
-                if w * h < 3:
-                    continue
-                x1, y1, x2, y2 = x, y, x+w, y+h
-                label_local = labels[y1: y2, x1: x2]
-                label_cordinates = np.where(label_local==label_index)
-                tmp_merged = np.zeros_like(label_local, np.uint8)
-                tmp_merged[label_cordinates] = 255
-                tmp_merged = cv2.bitwise_or(mask_merged[y1: y2, x1: x2], tmp_merged)
-                xor_merged = cv2.bitwise_xor(tmp_merged, pred_mask[y1: y2, x1: x2]).sum()
-                xor_origin = cv2.bitwise_xor(mask_merged[y1: y2, x1: x2], pred_mask[y1: y2, x1: x2]).sum()
-                if xor_merged < xor_origin:
-                    mask_merged[y1: y2, x1: x2] = tmp_merged
+        free = mask_merged == 0
+        xor_change = np.bincount(labels[free], weights=pred_gain[free], minlength=num_labels)
+        accepted = xor_change < 0
+        accepted[0] = False     # background label
+        accepted[stats[:, 2] * stats[:, 3] < 3] = False
+        mask_merged[accepted[labels]] = 255
 
     if refine_mode == REFINEMASK_INPAINT:
         mask_merged = cv2.dilate(mask_merged, np.ones((3, 3), np.uint8), iterations=1)
@@ -117,23 +114,14 @@ def merge_mask_list(mask_list, pred_mask, blk: TextBlock = None, pred_thresh=30,
         area_thresh = sorted_area[-2]
     else:
         area_thresh = sorted_area[-1]
-    for label_index, stat, centroid in zip(range(num_labels), stats, centroids):
-        x, y, w, h, area = stat
-        if area < area_thresh:
-            x1, y1, x2, y2 = x, y, x+w, y+h
-            label_local = labels[y1: y2, x1: x2]
-            label_cordinates = np.where(label_local==label_index)
-            tmp_merged = np.zeros_like(label_local, np.uint8)
-            tmp_merged[label_cordinates] = 255
-            tmp_merged = cv2.bitwise_or(mask_merged[y1: y2, x1: x2], tmp_merged)
-            xor_merged = cv2.bitwise_xor(tmp_merged, pred_mask[y1: y2, x1: x2]).sum()
-            xor_origin = cv2.bitwise_xor(mask_merged[y1: y2, x1: x2], pred_mask[y1: y2, x1: x2]).sum()
-            if xor_merged < xor_origin:
-                mask_merged[y1: y2, x1: x2] = tmp_merged
+    xor_change = np.bincount(labels.ravel(), weights=pred_gain.ravel(), minlength=num_labels)
+    accepted = (xor_change < 0) & (stats[:, -1] < area_thresh)
+    accepted[0] = False     # label 0 is mask_merged itself
+    mask_merged[accepted[labels]] = 255
     return mask_merged
 
 
-def refine_undetected_mask(img: np.ndarray, mask_pred: np.ndarray, mask_refined: np.ndarray, blk_list: List[TextBlock], refine_mode=REFINEMASK_INPAINT):
+def refine_undetected_mask(img: np.ndarray, mask_pred: np.ndarray, mask_refined: np.ndarray, blk_list: List[TextBlock], refine_mode=REFINEMASK_INPAINT, pool: Executor = None):
     mask_pred[np.where(mask_refined > 30)] = 0
     _, pred_mask_t = cv2.threshold(mask_pred, 30, 255, cv2.THRESH_BINARY)
     num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(pred_mask_t, 4, cv2.CV_16U)
@@ -153,19 +141,32 @@ def refine_undetected_mask(img: np.ndarray, mask_pred: np.ndarray, mask_refined:
             if bbox_score / w / h < 0.5:
                 seg_blk_list.append(TextBlock(bbox))
     if len(seg_blk_list) > 0:
-        mask_refined = cv2.bitwise_or(mask_refined, refine_mask(img, mask_pred, seg_blk_list, refine_mode=refine_mode))
+        mask_refined = cv2.bitwise_or(mask_refined, refine_mask(img, mask_pred, seg_blk_list, refine_mode=refine_mode, pool=pool))
     return mask_refined
 
 
-def refine_mask(img: np.ndarray, pred_mask: np.ndarray, blk_list: List[TextBlock], refine_mode: int = REFINEMASK_INPAINT) -> np.ndarray:
+def refine_block_mask(img: np.ndarray, pred_mask: np.ndarray, blk: TextBlock, refine_mode: int = REFINEMASK_INPAINT):
+    # refines the window around one block, only reads img and pred_mask
+    bx1, by1, bx2, by2 = expand_textwindow(img.shape, blk.xyxy, expand_r=16)
+    im = np.ascontiguousarray(img[by1: by2, bx1: bx2])
+    msk = np.ascontiguousarray(pred_mask[by1: by2, bx1: bx2])
+    mask_list = get_topk_masklist(im, msk)
+    mask_list += get_otsuthresh_masklist(im, msk, per_channel=False)
+    mask_merged = merge_mask_list(mask_list, msk, blk=blk, text_window=[bx1, by1, bx2, by2], refine_mode=refine_mode)
+    return (bx1, by1, bx2, by2), mask_merged
+
+
+def refine_mask(img: np.ndarray, pred_mask: np.ndarray, blk_list: List[TextBlock], refine_mode: int = REFINEMASK_INPAINT, pool: Executor = None) -> np.ndarray:
+    # block windows are independent, with a pool, e.g. a ThreadPoolExecutor owned by the caller, they are refined
+    # in parallel, most of the work is in opencv calls that release the GIL.
+    # Partial masks are or-ed in block order, so the result is the same as the serial one
+    if pool is not None and len(blk_list) > 1:
+        results = pool.map(lambda blk: refine_block_mask(img, pred_mask, blk, refine_mode), blk_list)
+    else:
+        results = (refine_block_mask(img, pred_mask, blk, refine_mode) for blk in blk_list)
+
     mask_refined = np.zeros_like(pred_mask)
-    for blk in blk_list:
-        bx1, by1, bx2, by2 = expand_textwindow(img.shape, blk.xyxy, expand_r=16)
-        im = np.ascontiguousarray(img[by1: by2, bx1: bx2])
-        msk = np.ascontiguousarray(pred_mask[by1: by2, bx1: bx2])
-        mask_list = get_topk_masklist(im, msk)
-        mask_list += get_otsuthresh_masklist(im, msk, per_channel=False)
-        mask_merged = merge_mask_list(mask_list, msk, blk=blk, text_window=[bx1, by1, bx2, by2], refine_mode=refine_mode)
+    for (bx1, by1, bx2, by2), mask_merged in results:
         mask_refined[by1: by2, bx1: bx2] = cv2.bitwise_or(mask_refined[by1: by2, bx1: bx2], mask_merged)
     return mask_refined
 
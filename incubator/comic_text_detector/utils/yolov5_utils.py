@@ -42,6 +42,30 @@ def fuse_conv_and_bn(conv, bn):
 
     return fusedconv
 
+def fuse_deconv_and_bn(deconv, bn):
+    # Fuse transposed convolution and batchnorm layers, the weights of a transposed convolution are (in, out / groups, kh, kw)
+    fuseddeconv = nn.ConvTranspose2d(deconv.in_channels,
+                                     deconv.out_channels,
+                                     kernel_size=deconv.kernel_size,
+                                     stride=deconv.stride,
+                                     padding=deconv.padding,
+                                     output_padding=deconv.output_padding,
+                                     groups=deconv.groups,
+                                     bias=True,
+                                     dilation=deconv.dilation).requires_grad_(False).to(deconv.weight.device)
+
+    # prepare filters, batchnorm scales the output channels of every group
+    scale = bn.weight.div(torch.sqrt(bn.running_var + bn.eps))
+    groups = deconv.groups
+    w_deconv = deconv.weight.view(groups, deconv.in_channels // groups, deconv.out_channels // groups, -1)
+    fuseddeconv.weight.copy_((w_deconv * scale.view(groups, 1, -1, 1)).view(fuseddeconv.weight.shape))
+
+    # prepare spatial bias
+    b_deconv = torch.zeros(deconv.out_channels, device=deconv.weight.device) if deconv.bias is None else deconv.bias
+    fuseddeconv.bias.copy_((b_deconv - bn.running_mean).mul(scale) + bn.bias)
+
+    return fuseddeconv
+
 def check_anchor_order(m):
     # Check anchor order against stride order for YOLOv5 Detect() module m, and correct if necessary
     a = m.anchors.prod(-1).view(-1)  # anchor area
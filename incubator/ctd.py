@@ -1,52 +1,124 @@
 # from https://github.com/kha-white/mokuro/blob/master/mokuro/manga_page_ocr.py
 
+import os
+
 import cv2
 import numpy as np
 
 from helper import download_model
-from comic_text_detector.inference import TextDetector
+from comic_text_detector.inference import TextDetector, OUTPUT_LINES, resolve_outputs
+
+DEFAULT_MODEL_URL = 'https://github.com/zyddnys/manga-image-translator/releases/download/beta-0.3/comictextdetector.pt'
+# the same model exported to onnx, it runs with the opencv or onnxruntime backend and without torch
+DEFAULT_ONNX_MODEL_URL = DEFAULT_MODEL_URL + '.onnx'
 
 
 class ComicTextDetector:
+    refine_mode = 0
+
     def __init__(self,
-                 pretrained_model_name_or_path='https://github.com/zyddnys/manga-image-translator/releases/download/beta-0.3/comictextdetector.pt',
+                 pretrained_model_name_or_path=DEFAULT_MODEL_URL,
                  detector_input_size=1024,
+                 **detector_options,
                  ):
+        # detector_options are passed to TextDetector, e.g. backend, dynamic_input or tile_size
 
         model = download_model(pretrained_model_name_or_path)
+        self.model_path = model
 
         self.text_detector = TextDetector(model_path=model, input_size=detector_input_size,
                                           device='cpu',
-                                          act='leaky')
+                                          act='leaky',
+                                          **detector_options)
 
-    def __call__(self, img):
+    def __call__(self, img, outputs=None):
         # img = np.array(img_or_path)
-        H, W, *_ = img.shape
         mask, mask_refined, blk_list = self.text_detector(
-            img, refine_mode=0, keep_undetected_mask=True)
-
-        result = {'blocks': []}
-
-        for blk_idx, blk in enumerate(blk_list):
-
-            result_blk = {
-                'box': [int(x) for x in blk.xyxy],
-                'vertical': bool(blk.vertical),
-                # 'font_size': float(blk.font_size),
-                # 'line_spacing': float(blk.line_spacing),
-                # 'font_family': blk.font_family,
-                # 'bold': blk.bold,
-                # 'underline': blk.underline,
-                # 'italic': blk.italic,
-                # 'stroke_width': blk.stroke_width,
-                # 'font_colors': [x for x in blk.get_font_colors()],
-                # 'lines_coords': [],
-                # 'lines': [],
-            }
-
-            result['blocks'].append(result_blk)
-
-        return mask, mask_refined, result
+            img, refine_mode=self.refine_mode, keep_undetected_mask=True, outputs=outputs)
+
+        return mask, mask_refined, format_blocks(blk_list, lines=OUTPUT_LINES in resolve_outputs(outputs))
+
+    def batch(self, imgs, outputs=None):
+        with_lines = OUTPUT_LINES in resolve_outputs(outputs)
+        return [(mask, mask_refined, format_blocks(blk_list, lines=with_lines))
+                for mask, mask_refined, blk_list in self.detect_batch(imgs, outputs)]
+
+    def detect_batch(self, imgs, outputs=None):
+        return self.text_detector.batch(
+            imgs, refine_mode=self.refine_mode, keep_undetected_mask=True, outputs=outputs)
+
+    def detect_requests(self, requests):
+        # (img, outputs) pairs share one forward pass, computing every output any of them asked for
+        outputs = frozenset().union(*(resolve_outputs(outputs) for _, outputs in requests))
+        return self.detect_batch([img for img, _ in requests], outputs)
+
+    def close(self):
+        self.text_detector.close()
+
+    def params(self):
+        # everything besides the image that the detection result depends on
+        detector = self.text_detector
+        return {
+            'model': os.path.basename(self.model_path),
+            'backend': detector.backend,
+            'input_size': list(detector.input_size),
+            'dynamic_input': detector.dynamic_input,
+            'tile_size': detector.tile_size,
+            'tile_overlap': detector.tile_overlap,
+            'optimize': detector.optimize,
+            'precision': detector.precision,
+            'conf_thresh': detector.conf_thresh,
+            'nms_thresh': detector.nms_thresh,
+            'refine_mode': self.refine_mode,
+        }
+
+
+def block_crops(img, blk, text_height=64):
+    # axis-aligned horizontal text is recognized from the block box,
+    # vertical and rotated text line by line from rectified regions
+    if not blk.vertical and blk.angle == 0:
+        x1, y1, x2, y2 = blk.xyxy
+        crop = img[max(y1, 0): y2, max(x1, 0): x2]
+        return [crop] if crop.size > 0 else []
+
+    crops = []
+    for line_idx in range(len(blk.lines)):
+        region = blk.get_transformed_region(img, line_idx, text_height)
+        if region.size == 0:
+            continue
+        if blk.vertical:
+            region = cv2.rotate(region, cv2.ROTATE_90_CLOCKWISE)
+        crops.append(region)
+    return crops
+
+
+def format_blocks(blk_list, lines=False):
+    result = {'blocks': []}
+    if blk_list is None:
+        return result
+
+    for blk_idx, blk in enumerate(blk_list):
+
+        result_blk = {
+            'box': [int(x) for x in blk.xyxy],
+            'vertical': bool(blk.vertical),
+            # 'font_size': float(blk.font_size),
+            # 'line_spacing': float(blk.line_spacing),
+            # 'font_family': blk.font_family,
+            # 'bold': blk.bold,
+            # 'underline': blk.underline,
+            # 'italic': blk.italic,
+            # 'stroke_width': blk.stroke_width,
+            # 'font_colors': [x for x in blk.get_font_colors()],
+            # 'lines_coords': [],
+            # 'lines': [],
+        }
+        if lines:
+            result_blk['lines'] = [[[int(x), int(y)] for x, y in line] for line in blk.lines]
+
+        result['blocks'].append(result_blk)
+
+    return result
 
 
 if __name__ == '__main__':
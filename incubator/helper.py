@@ -2,8 +2,38 @@
 
 import os
 import sys
-from torch.hub import download_url_to_file, get_dir
+import tempfile
 from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+from tqdm import tqdm
+
+
+def get_dir():
+    # torch.hub.get_dir() without importing torch, downloads land where torch would put them
+    torch_home = os.getenv('TORCH_HOME', os.path.join(os.getenv('XDG_CACHE_HOME', '~/.cache'), 'torch'))
+    return os.path.join(os.path.expanduser(torch_home), 'hub')
+
+
+def download_url_to_file(url, dst, progress=True):
+    # streamed to a temporary file next to dst, which only appears once complete
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst), suffix='.partial')
+    try:
+        with os.fdopen(fd, 'wb') as f, urlopen(Request(url, headers={'User-Agent': 'incubator'})) as response:
+            size = response.headers.get('Content-Length')
+            with tqdm(total=int(size) if size else None, disable=not progress,
+                      unit='B', unit_scale=True, unit_divisor=1024) as pbar:
+                while True:
+                    buffer = response.read(1 << 16)
+                    if not buffer:
+                        break
+                    f.write(buffer)
+                    pbar.update(len(buffer))
+        os.replace(tmp_path, dst)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
 
 def get_cache_path_by_url(url):
     parts = urlparse(url)
@@ -16,11 +46,21 @@ def get_cache_path_by_url(url):
     return cached_file
 
 
+def get_cache_dir(name):
+    # a directory for our own files next to the downloaded checkpoints
+    cache_dir = os.path.join(get_dir(), name)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return cache_dir
+
+
 def download_model(url):
+    # local model files are used as they are
+    if os.path.isfile(url):
+        return url
     cached_file = get_cache_path_by_url(url)
     if not os.path.exists(cached_file):
         sys.stderr.write('Downloading: "{}" to {}\n'.format(url, cached_file))
-        hash_prefix = None
-        download_url_to_file(url, cached_file, hash_prefix, progress=True)
+        download_url_to_file(url, cached_file, progress=True)
 
     return cached_file
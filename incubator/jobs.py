@@ -0,0 +1,300 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from loguru import logger
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    params TEXT NOT NULL,
+    cancelled INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    job_id TEXT NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    name TEXT,
+    state TEXT NOT NULL,
+    data BLOB,
+    result TEXT,
+    error TEXT,
+    owner TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS pages_state ON pages (state);
+'''
+
+# page states, a page is claimed by one worker thread at a time
+PAGE_QUEUED = 'queued'
+PAGE_RUNNING = 'running'
+PAGE_DONE = 'done'
+PAGE_FAILED = 'failed'
+PAGE_CANCELLED = 'cancelled'
+PAGE_FINISHED = (PAGE_DONE, PAGE_FAILED, PAGE_CANCELLED)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def process_start(pid):
+    # start time of the process in clock ticks since boot, None where there is no /proc
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # the fields after the command name, which may contain spaces, start with the third
+    return stat[stat.rindex(b')') + 2:].split()[19].decode()
+
+
+_owner = None
+
+
+def process_owner():
+    # the owner token of the pages claimed by this process, pid:start. PIDs are reused, a restarted server
+    # often gets the same one, pid 1 in a container, so the start time, or a random nonce, tells the processes apart
+    global _owner
+    pid = os.getpid()
+    if _owner is None or _owner[0] != pid:
+        _owner = (pid, f'{pid}:{process_start(pid) or uuid.uuid4().hex}')
+    return _owner[1]
+
+
+def owner_alive(owner):
+    # whether the process of an owner token still runs. Bare PIDs are the owners of older databases
+    if owner is None:
+        return False
+    pid, _, start = str(owner).partition(':')
+    pid = int(pid)
+    if pid == os.getpid():
+        return owner == process_owner()
+    if not pid_alive(pid):
+        return False
+    current_start = process_start(pid)
+    return not start or current_start is None or start == current_start
+
+
+class Connection:
+    # sqlite3 connections only commit or roll back as context managers, this one also closes
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self.db.in_transaction:
+            self.db.execute('ROLLBACK')
+        self.db.close()
+
+
+class JobStore:
+    '''
+    Jobs and their pages in a SQLite database, so finished pages and the queue outlive the process.
+    The page images are kept until their page is finished. Every method opens its own connection,
+    so the store can be shared by threads and by the server worker processes.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.execute('PRAGMA foreign_keys=ON')
+        return Connection(db)
+
+    def create(self, pages, **params):
+        # pages: list of (name, image bytes), params: passed to the page function with every page
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('INSERT INTO jobs (id, params, created) VALUES (?, ?, ?)', (job_id, json.dumps(params), now))
+            db.executemany('INSERT INTO pages (job_id, idx, name, state, data, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                           [(job_id, idx, name, PAGE_QUEUED, data, now) for idx, (name, data) in enumerate(pages)])
+            db.execute('COMMIT')
+        return job_id
+
+    def claim(self):
+        # the first queued page of the oldest job, marked as running in this process. None if there is none
+        with self._connect() as db:
+            row = db.execute(
+                'UPDATE pages SET state = ?, owner = ?, updated = ? WHERE rowid = ('
+                '  SELECT rowid FROM pages WHERE state = ? ORDER BY rowid LIMIT 1'
+                ') RETURNING job_id, idx, data',
+                (PAGE_RUNNING, process_owner(), time.time(), PAGE_QUEUED)).fetchone()
+            if row is None:
+                return None
+            job_id, idx, data = row
+            params, = db.execute('SELECT params FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return job_id, idx, data, json.loads(params)
+
+    def finish(self, job_id, idx, result=None, error=None):
+        # the image is dropped once the page is done, a failed page can be retried
+        with self._connect() as db:
+            if error is None:
+                db.execute('UPDATE pages SET state = ?, data = NULL, result = ?, error = NULL, updated = ? '
+                           'WHERE job_id = ? AND idx = ?',
+                           (PAGE_DONE, json.dumps(result, ensure_ascii=False), time.time(), job_id, idx))
+            else:
+                db.execute('UPDATE pages SET state = ?, error = ?, updated = ? WHERE job_id = ? AND idx = ?',
+                           (PAGE_FAILED, error, time.time(), job_id, idx))
+
+    def cancel(self, job_id):
+        # pages not started yet are cancelled, running ones still finish. False if there is no such job
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            found = db.execute('UPDATE jobs SET cancelled = 1 WHERE id = ?', (job_id,)).rowcount > 0
+            db.execute('UPDATE pages SET state = ?, data = NULL, updated = ? WHERE job_id = ? AND state = ?',
+                       (PAGE_CANCELLED, time.time(), job_id, PAGE_QUEUED))
+            db.execute('COMMIT')
+        return found
+
+    def retry(self, job_id):
+        # failed pages are queued again. False if there is no such job or it was cancelled
+        with self._connect() as db:
+            row = db.execute('SELECT cancelled FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None or row[0]:
+                return False
+            db.execute('UPDATE pages SET state = ?, error = NULL, updated = ? WHERE job_id = ? AND state = ?',
+                       (PAGE_QUEUED, time.time(), job_id, PAGE_FAILED))
+        return True
+
+    def delete(self, job_id):
+        with self._connect() as db:
+            return db.execute('DELETE FROM jobs WHERE id = ?', (job_id,)).rowcount > 0
+
+    def recover(self):
+        # pages left running by a process that is gone, killed or restarted, are queued again,
+        # also when a new process reuses its PID
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            owners = [owner for owner, in db.execute('SELECT DISTINCT owner FROM pages WHERE state = ?', (PAGE_RUNNING,))]
+            dead = [owner for owner in owners if not owner_alive(owner)]
+            recovered = 0
+            for owner in dead:
+                recovered += db.execute('UPDATE pages SET state = ?, owner = NULL WHERE state = ? AND owner IS ?',
+                                        (PAGE_QUEUED, PAGE_RUNNING, owner)).rowcount
+            db.execute('COMMIT')
+        return recovered
+
+    def status(self, job_id, results=False, since=0):
+        # progress of the job, with results the finished pages from index since on. None if there is no such job
+        with self._connect() as db:
+            row = db.execute('SELECT created FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return None
+            created, = row
+            counts = dict(db.execute('SELECT state, COUNT(*) FROM pages WHERE job_id = ? GROUP BY state', (job_id,)))
+            updated, = db.execute('SELECT MAX(updated) FROM pages WHERE job_id = ?', (job_id,)).fetchone()
+            pages = None
+            if results:
+                pages = [{
+                    'index': idx,
+                    'name': name,
+                    'state': state,
+                    'result': json.loads(result) if result is not None else None,
+                    'error': error,
+                } for idx, name, state, result, error in db.execute(
+                    'SELECT idx, name, state, result, error FROM pages WHERE job_id = ? AND idx >= ? ORDER BY idx',
+                    (job_id, since))]
+
+        total = sum(counts.values())
+        pending = counts.get(PAGE_QUEUED, 0) + counts.get(PAGE_RUNNING, 0)
+        if pending > 0:
+            state = 'running' if pending < total or counts.get(PAGE_RUNNING, 0) > 0 else 'queued'
+        elif counts.get(PAGE_CANCELLED, 0) > 0:
+            state = 'cancelled'
+        elif counts.get(PAGE_FAILED, 0) > 0:
+            state = 'failed'
+        else:
+            state = 'done'
+        status = {
+            'id': job_id,
+            'state': state,
+            'created': created,
+            'updated': updated or created,
+            'pages': total,
+            **{page_state: counts.get(page_state, 0) for page_state in
+               (PAGE_QUEUED, PAGE_RUNNING, PAGE_DONE, PAGE_FAILED, PAGE_CANCELLED)},
+        }
+        if pages is not None:
+            status['results'] = pages
+        return status
+
+
+class JobQueue:
+    '''
+    Runs the pages of the jobs in a JobStore on a pool of worker threads.
+    page_fn(data, **params) returns the JSON-serializable result of one page image.
+    Workers claim pages from the database, so several processes can serve the same store,
+    each running at most num_workers pages at a time. Pages queued by another process are picked up
+    within poll_interval seconds.
+    '''
+
+    def __init__(self, store: JobStore, page_fn, num_workers=2, poll_interval=1.0):
+        assert num_workers > 0, 'num_workers must be positive'
+        self.store = store
+        self.page_fn = page_fn
+        self.num_workers = num_workers
+        self.poll_interval = poll_interval
+        self._wake = threading.Condition()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        # pages left over by a previous run are resumed
+        with self._lock:
+            if self._threads:
+                return
+            recovered = self.store.recover()
+            if recovered:
+                logger.info("Resuming {} job pages", recovered)
+            for ii in range(self.num_workers):
+                thread = threading.Thread(target=self._loop, name=f'job-worker-{ii}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, pages, **params):
+        job_id = self.store.create(pages, **params)
+        self.start()
+        with self._wake:
+            self._wake.notify_all()
+        logger.info("Job {} queued with {} pages", job_id, len(pages))
+        return job_id
+
+    def _loop(self):
+        while True:
+            try:
+                page = self.store.claim()
+            except sqlite3.Error:
+                logger.exception("Failed to claim a job page")
+                page = None
+            if page is None:
+                with self._wake:
+                    self._wake.wait(self.poll_interval)
+                continue
+
+            job_id, idx, data, params = page
+            try:
+                result = self.page_fn(data, **params)
+            except Exception as e:
+                logger.exception("Job {} page {} failed", job_id, idx)
+                self.store.finish(job_id, idx, error=str(e))
+            else:
+                self.store.finish(job_id, idx, result)
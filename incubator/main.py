@@ -1,70 +1,556 @@
-from flask import Flask, request, jsonify
+import base64
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from flask import Flask, Response, abort, request, jsonify
 from flask_cors import CORS
 import cv2
 import numpy as np
-from ctd import ComicTextDetector
-from manga_ocr import MangaOcr
+from ctd import ComicTextDetector, DEFAULT_MODEL_URL, DEFAULT_ONNX_MODEL_URL, block_crops, format_blocks
+from comic_text_detector.inference import DETECTOR_OUTPUTS, OUTPUT_BLOCKS, OUTPUT_LINES, OUTPUT_MASK, \
+    OUTPUT_MASK_REFINED, default_backend, resolve_outputs
+from batching import MicroBatcher
+from cache import ResultCache, make_key
+from jobs import PAGE_FINISHED, JobQueue, JobStore
+from registry import ModelRegistry
+from transport import CONTENT_TYPE_BLOCKS, CONTENT_TYPE_PIXELS, decode_bgr, decode_pil, pack_blocks
+from helper import get_cache_dir
 from PIL import Image
 from loguru import logger
 
 app = Flask(__name__)
 CORS(app)
 
-logger.info("Preloading manga ocr model...")
-mocr = MangaOcr()
-logger.info("loaded!")
 
-logger.info("Preloading comic text detector model...")
-ctd = ComicTextDetector()
-logger.info("loaded!")
+class InterceptHandler(logging.Handler):
+    # forward records of the detector package, such as its stage timings, from the logging module to loguru
+    def emit(self, record):
+        try:
+            level = logger.level(record.levelname).name
+        except ValueError:
+            level = record.levelno
+        logger.opt(depth=6, exception=record.exc_info).log(level, record.getMessage())
+
+
+# only the detector package, the root logger and other libraries keep their own configuration
+ctd_logger = logging.getLogger('comic_text_detector')
+ctd_logger.addHandler(InterceptHandler())
+ctd_logger.setLevel(logging.DEBUG)
+ctd_logger.propagate = False
+
+# full: manga ocr and the comic text detector. lite: the comic text detector only,
+# from its onnx export, so that torch is never imported
+profile = os.environ.get('INCUBATOR_PROFILE', 'full')
+if profile not in ('full', 'lite'):
+    raise ValueError(f"INCUBATOR_PROFILE must be 'full' or 'lite', got {profile!r}")
+logger.info("Starting with the {} profile", profile)
+
+# models load in a background thread once the server is up, or on first use with INCUBATOR_WARMUP=0,
+# so the port is bound right away. GET /health tells when they are ready
+MOCR_MODEL = 'kha-white/manga-ocr-base'
+registry = ModelRegistry()
+ctd_model_path = os.environ.get('INCUBATOR_CTD_MODEL') or (DEFAULT_ONNX_MODEL_URL if profile == 'lite' else DEFAULT_MODEL_URL)
+ctd_backend = os.environ.get('INCUBATOR_CTD_BACKEND') or default_backend(ctd_model_path)
+# fused and frozen torch detector, see TextDetBase.optimize
+ctd_optimize = os.environ.get('INCUBATOR_CTD_OPTIMIZE', '1') == '1'
+# fp32, bf16 or int8 on CPU with the torch backend. int8 is calibrated on the pages of INCUBATOR_CTD_CALIBRATION at load
+ctd_precision = os.environ.get('INCUBATOR_CTD_PRECISION', 'fp32')
+ctd_calibration_dir = os.environ.get('INCUBATOR_CTD_CALIBRATION')
+
+# intra-op threads of the models, 0 keeps the library defaults.
+# With several worker processes, serve.py sets it to the cores per worker
+threads = int(os.environ.get('INCUBATOR_THREADS', 0))
+
+
+def set_threads():
+    if threads <= 0:
+        return
+    cv2.setNumThreads(threads)
+    # only once a model has imported it
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(threads)
+
+
+def load_mocr():
+    from manga_ocr import MangaOcr
+    mocr = MangaOcr(MOCR_MODEL)
+    set_threads()
+    return mocr
+
+
+def load_ctd():
+    ctd = ComicTextDetector(
+        ctd_model_path,
+        backend=ctd_backend,
+        ort_options={'intra_op_threads': threads} if ctd_backend == 'onnxruntime' else None,
+        optimize=ctd_optimize,
+        precision=ctd_precision,
+        calibration_dir=ctd_calibration_dir,
+        refine_workers=int(os.environ.get('INCUBATOR_REFINE_WORKERS', 1)))
+    set_threads()
+    return ctd
+
+
+def warm_up_mocr(mocr):
+    mocr(Image.new('RGB', (224, 224), 'white'))
+
+
+def warm_up_ctd(ctd):
+    # a blank page of the detector input size, through every stage
+    height, width = ctd.text_detector.input_size
+    ctd(np.full((height, width, 3), 255, np.uint8), outputs=DETECTOR_OUTPUTS)
+
+
+# torch models can be loaded before forking the server workers, onnxruntime and opencv
+# start thread pools of their own and are loaded in each worker. So does int8 calibration, which runs the model
+ctd_model = registry.register('comic-text-detector', load_ctd, warm_up_ctd,
+                              fork_safe=ctd_backend == 'torch' and ctd_precision != 'int8')
+mocr_model = None
+if profile == 'full':
+    mocr_model = registry.register('manga-ocr', load_mocr, warm_up_mocr, fork_safe=True)
+
+# requests arriving within the wait window are run as one forward pass
+max_batch_size = int(os.environ.get('INCUBATOR_MAX_BATCH_SIZE', 8))
+max_wait_ms = float(os.environ.get('INCUBATOR_MAX_WAIT_MS', 10))
+mocr_batcher = None
+if mocr_model is not None:
+    mocr_batcher = MicroBatcher('manga-ocr', mocr_model.runner(lambda mocr, imgs: mocr.batch(imgs)),
+                                max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+ctd_batcher = MicroBatcher('comic-text-detector', ctd_model.runner(lambda ctd, requests: ctd.detect_requests(requests)),
+                           max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+# results are cached by the hash of their input and the model parameters,
+# in memory and, with INCUBATOR_DISK_CACHE=1, on disk across restarts
+cache_bytes = int(float(os.environ.get('INCUBATOR_CACHE_MB', 256)) * 1024 * 1024)
+cache_dir = None
+if os.environ.get('INCUBATOR_DISK_CACHE', '0') == '1':
+    cache_dir = os.environ.get('INCUBATOR_CACHE_DIR') or get_cache_dir('incubator')
+    logger.info("Caching results in {}", cache_dir)
+
+
+def make_cache(name):
+    disk_dir = os.path.join(cache_dir, name) if cache_dir is not None else None
+    return ResultCache(name, max_bytes=cache_bytes, disk_dir=disk_dir)
+
+
+mocr_cache = make_cache('manga-ocr')
+ctd_cache = make_cache('comic-text-detector')
+page_cache = make_cache('page')
+mocr_params = {'model': MOCR_MODEL if mocr_model is not None else None}
+
+
+def ctd_params():
+    # the detector parameters are only known once it is loaded
+    return ctd_model.get().params()
+
+
+def page_params():
+    return {'detector': ctd_params(), 'ocr': mocr_params}
+
+
+# requests over the limit are answered 503 with Retry-After right away instead of waiting behind the others,
+# 0 for no limit. It counts the requests in progress in this process, so each server worker has its own
+max_queue = int(os.environ.get('INCUBATOR_MAX_QUEUE', 0))
+retry_after = int(os.environ.get('INCUBATOR_RETRY_AFTER', 1))
+queue_slots = threading.BoundedSemaphore(max_queue) if max_queue > 0 else None
+queue_rejected = 0
+
+
+def limit_queue(route):
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs):
+        global queue_rejected
+        if queue_slots is None:
+            return route(*args, **kwargs)
+        if not queue_slots.acquire(blocking=False):
+            queue_rejected += 1
+            response = jsonify({"error": "Server busy, retry later"})
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 503
+        try:
+            response = app.make_response(route(*args, **kwargs))
+        except BaseException:
+            queue_slots.release()
+            raise
+        # streamed responses hold their slot until sent
+        response.call_on_close(queue_slots.release)
+        return response
+    return wrapper
+
+
+def requires_ocr(route):
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs):
+        if mocr_model is None:
+            return jsonify({"error": f"Manga OCR is not loaded in the {profile} profile"}), 503
+        return route(*args, **kwargs)
+    return wrapper
+
+
+def read_upload():
+    # the uploaded image: the `image` form file, or the whole body when it is an image/* or raw pixels,
+    # which skips the multipart parsing and its copies. None if there is none
+    if 'image' in request.files:
+        return request.files['image'].read()
+    if request.mimetype.startswith('image/') or request.mimetype == CONTENT_TYPE_PIXELS:
+        return request.get_data()
+    return None
+
+
+def decode_upload(data, pil=False):
+    # the uploaded image, BGR for the detector or PIL for the OCR. A body that is not an image is answered with a 400
+    try:
+        if pil:
+            image = decode_pil(data)
+            # PIL only reads the header until then
+            image.load()
+            return image
+        return decode_bgr(data)
+    except (ValueError, OSError) as e:
+        # PIL raises UnidentifiedImageError, an OSError, or OSError for truncated data
+        abort(Response(json.dumps({"error": f"Invalid image: {e}"}), 400, mimetype='application/json'))
+
+
+def wants_packed():
+    # binary detector results, see transport.py, for clients that ask for them
+    return request.accept_mimetypes.best_match(['application/json', CONTENT_TYPE_BLOCKS]) == CONTENT_TYPE_BLOCKS
+
+
+def recognize(image):
+    from manga_ocr import load_image
+
+    # keyed by the pixels of the crop, so every endpoint shares the same entries
+    image = load_image(image)
+    key = make_key(image.tobytes(), size=image.size, **mocr_params)
+    return mocr_cache.cached(key, lambda: mocr_batcher.submit(image))
 
 
 @app.route("/magic/manga-ocr", methods=['POST'])
+@limit_queue
+@requires_ocr
 def inference_manga_ocr():
-    if 'image' not in request.files:
+    data = read_upload()
+    if data is None:
         return jsonify({"error": "Image not provided"}), 400
 
-    fileitem = request.files['image']
-    image = Image.open(fileitem)
+    image = decode_upload(data, pil=True)
 
     logger.info("Inference manga ocr...")
 
     # inference
-    text = mocr(image)
+    text = recognize(image).result()
 
     logger.info("Inference done!, result: {}", text)
 
     return jsonify(text)
 
 
+@app.route("/magic/manga-ocr/batch", methods=['POST'])
+@limit_queue
+@requires_ocr
+def inference_manga_ocr_batch():
+    data = read_upload()
+    if data is None:
+        return jsonify({"error": "Image not provided"}), 400
+
+    # a form field, or a query parameter with a raw body
+    try:
+        boxes = json.loads(request.form.get('boxes') or request.args.get('boxes', ''))
+        boxes = [[float(x) for x in box] for box in boxes]
+    except (ValueError, TypeError):
+        return jsonify({"error": "Boxes must be a JSON list of [x1, y1, x2, y2]"}), 400
+    if any(len(box) != 4 for box in boxes):
+        return jsonify({"error": "Boxes must be a JSON list of [x1, y1, x2, y2]"}), 400
+
+    image = decode_upload(data, pil=True)
+
+    logger.info("Inference manga ocr on {} boxes...", len(boxes))
+
+    # crops join the shared queue, so they are batched with each other
+    # and with concurrent requests
+    futures = [recognize(image.crop(box)) for box in boxes]
+    texts = [future.result() for future in futures]
+
+    logger.info("Inference done!, result: {}", texts)
+
+    return jsonify(texts)
+
+
 @app.route("/magic/comic-text-detector", methods=['POST'])
+@limit_queue
 def inference_comic_text_detector():
-    if 'image' not in request.files:
+    data = read_upload()
+    if data is None:
         return jsonify({"error": "Image not provided"}), 400
 
-    fileitem = request.files['image']
+    # only the requested outputs are computed, e.g. ?outputs=blocks,mask_refined
+    try:
+        outputs = resolve_outputs(request.args.get('outputs', OUTPUT_BLOCKS).split(','))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    npimg = np.frombuffer(fileitem.read(), np.uint8)
-    image = cv2.imdecode(npimg, cv2.IMREAD_COLOR)
+    if wants_packed():
+        return detect_packed(data, outputs)
 
-    logger.info("Inference comic text detector & manga ocr...")
+    key = make_key(data, outputs=sorted(outputs), **ctd_params())
+    result = ctd_cache.get(key)
+    if result is not None:
+        logger.info("Cache hit, result: {}", result['blks'])
+        return jsonify(result)
+
+    logger.info("Inference comic text detector...")
 
     # inference
-    _, mask, blks = ctd(image)
+    mask, mask_refined, blk_list = ctd_batcher((decode_upload(data), outputs))
+    result = {
+        'blks': format_blocks(blk_list, lines=OUTPUT_LINES in outputs),
+    }
+    # masks are sent as base64 encoded png
+    if OUTPUT_MASK in outputs:
+        result['mask'] = encode_png(mask)
+    if OUTPUT_MASK_REFINED in outputs:
+        result['mask_refined'] = encode_png(mask_refined)
+    ctd_cache.put(key, result)
+
+    logger.info("Inference done!, result: {}", result['blks'])
+
+    return jsonify(result)
+
+
+def detect_packed(data, outputs):
+    # the arrays are written out as they are, masks as raw pixels, without building python lists, JSON or PNG
+    key = make_key(data, outputs=sorted(outputs), format=CONTENT_TYPE_BLOCKS, **ctd_params())
+    body = ctd_cache.get(key, raw=True)
+    if body is None:
+        logger.info("Inference comic text detector...")
+        mask, mask_refined, blk_list = ctd_batcher((decode_upload(data), outputs))
+        body = pack_blocks(blk_list if OUTPUT_BLOCKS in outputs or OUTPUT_LINES in outputs else None,
+                           lines=OUTPUT_LINES in outputs,
+                           mask=mask if OUTPUT_MASK in outputs else None,
+                           mask_refined=mask_refined if OUTPUT_MASK_REFINED in outputs else None)
+        ctd_cache.put(key, body, raw=True)
+    return Response(body, mimetype=CONTENT_TYPE_BLOCKS)
+
+
+def encode_png(img):
+    _, buf = cv2.imencode('.png', img)
+    return base64.b64encode(buf.tobytes()).decode()
+
+
+@app.route("/magic/page", methods=['POST'])
+@limit_queue
+@requires_ocr
+def inference_page():
+    data = read_upload()
+    if data is None:
+        return jsonify({"error": "Image not provided"}), 400
+
+    key = make_key(data, **page_params())
+    cached = page_cache.get(key)
+    if cached is not None:
+        logger.info("Cache hit, {} blocks", len(cached))
+        return Response((json.dumps(blk, ensure_ascii=False) + '\n' for blk in cached),
+                        mimetype='application/x-ndjson')
+
+    logger.info("Inference comic text detector & manga ocr...")
+
+    blks, futures = start_page(data, decode_upload(data))
+
+    # stream each block as soon as its own crops are recognized
+    def generate():
+        for blk in join_page(blks, futures):
+            yield json.dumps(blk, ensure_ascii=False) + '\n'
+        page_cache.put(key, blks)
+        logger.info("Inference done!, {} blocks", len(blks))
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+def detect_blocks(data):
+    # the blocks of an encoded page, as returned by POST /magic/comic-text-detector
+    key = make_key(data, outputs=[OUTPUT_BLOCKS], **ctd_params())
+    result = ctd_cache.get(key)
+    if result is None:
+        _, _, blk_list = ctd_batcher((decode_bgr(data), [OUTPUT_BLOCKS]))
+        result = {'blks': format_blocks(blk_list)}
+        ctd_cache.put(key, result)
+    return result['blks']['blocks']
+
+
+def start_page(data, image):
+    # detect the blocks of an encoded page, decoded as image, and queue every crop up front, so they are recognized
+    # in batches. Returns the blocks and the futures of the crops of each block
+    _, _, blk_list = ctd_batcher((image, [OUTPUT_BLOCKS]))
+    blks = format_blocks(blk_list)
+    ctd_cache.put(make_key(data, outputs=[OUTPUT_BLOCKS], **ctd_params()), {'blks': blks})
+
+    futures = []
+    for blk in blk_list:
+        crops = block_crops(image, blk)
+        futures.append([recognize(Image.fromarray(cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)))
+                        for crop in crops])
+    return blks['blocks'], futures
+
+
+def join_page(blks, futures):
+    # yields each block with its index and text, in order, as its crops are recognized
+    for idx, (blk, blk_futures) in enumerate(zip(blks, futures)):
+        blk['index'] = idx
+        blk['text'] = ''.join(future.result() for future in blk_futures)
+        yield blk
+
+
+def read_page(data, ocr=True):
+    # the blocks of a job page, as streamed by POST /magic/page, or only detected without ocr
+    if not ocr:
+        return detect_blocks(data)
+    # a job queued with ocr by a full server can be resumed by a lite one, its pages fail then
+    if mocr_model is None:
+        raise RuntimeError(f"Manga OCR is not loaded in the {profile} profile")
+    key = make_key(data, **page_params())
+    blks = page_cache.get(key)
+    if blks is None:
+        blks, futures = start_page(data, decode_bgr(data))
+        for _ in join_page(blks, futures):
+            pass
+        page_cache.put(key, blks)
+    return blks
 
-    logger.info("Inference done!, result: {}", blks)
 
+# chapters of pages run in the background: POST /jobs queues them and returns a job id to poll.
+# Jobs are kept in SQLite, pages finished before a restart are not run again and the unfinished ones are resumed
+jobs_db = os.environ.get('INCUBATOR_JOBS_DB') or os.path.join(get_cache_dir('incubator'), 'jobs.sqlite3')
+job_queue = JobQueue(JobStore(jobs_db), read_page, num_workers=int(os.environ.get('INCUBATOR_JOB_WORKERS', 2)))
+
+
+@app.route("/jobs", methods=['POST'])
+def create_job():
+    files = request.files.getlist('image')
+    if len(files) == 0:
+        return jsonify({"error": "Image not provided"}), 400
+    # ocr=0 only detects the blocks, which the lite profile also serves
+    ocr = request.form.get('ocr', '1') != '0'
+    if ocr and mocr_model is None:
+        return jsonify({"error": f"Manga OCR is not loaded in the {profile} profile"}), 503
+
+    job_id = job_queue.submit([(fileitem.filename, fileitem.read()) for fileitem in files], ocr=ocr)
+    return jsonify(job_queue.store.status(job_id)), 202
+
+
+@app.route("/jobs/<job_id>", methods=['GET'])
+def job_status(job_id):
+    # ?results=1 adds the pages with their results, from index ?since= on
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({"error": "since must be a page index"}), 400
+    status = job_queue.store.status(job_id, results=request.args.get('results', '0') == '1', since=since)
+    if status is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(status)
+
+
+@app.route("/jobs/<job_id>/stream", methods=['GET'])
+def job_stream(job_id):
+    # NDJSON, a {"page": ...} line with its result for each page in order as soon as it is finished,
+    # then a last {"job": ...} line with the job status
+    if job_queue.store.status(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    def generate():
+        since = 0
+        while True:
+            status = job_queue.store.status(job_id, results=True, since=since)
+            if status is None:
+                return
+            for page in status.pop('results'):
+                if page['state'] not in PAGE_FINISHED:
+                    break
+                since = page['index'] + 1
+                yield json.dumps({'page': page}, ensure_ascii=False) + '\n'
+            if status['state'] not in ('queued', 'running'):
+                yield json.dumps({'job': status}) + '\n'
+                return
+            time.sleep(0.5)
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route("/jobs/<job_id>/cancel", methods=['POST'])
+def cancel_job(job_id):
+    # pages not started yet are skipped, running pages still finish
+    if not job_queue.store.cancel(job_id):
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_queue.store.status(job_id))
+
+
+@app.route("/jobs/<job_id>/retry", methods=['POST'])
+def retry_job(job_id):
+    if not job_queue.store.retry(job_id):
+        return jsonify({"error": "Job not found or cancelled"}), 404
+    job_queue.start()
+    return jsonify(job_queue.store.status(job_id))
+
+
+@app.route("/jobs/<job_id>", methods=['DELETE'])
+def delete_job(job_id):
+    if not job_queue.store.delete(job_id):
+        return jsonify({"error": "Job not found"}), 404
+    return '', 204
+
+
+@app.route("/stats", methods=['GET'])
+def stats():
     return jsonify({
-        # 'mask': mask.tolist(),
-        'blks': blks
+        'profile': profile,
+        'queue': {
+            'max': max_queue,
+            'rejected': queue_rejected,
+        },
+        'batching': {
+            batcher.name: batcher.stats.to_dict() for batcher in (mocr_batcher, ctd_batcher) if batcher is not None
+        },
+        'cache': {
+            cache.name: cache.to_dict() for cache in (mocr_cache, ctd_cache, page_cache)
+        },
     })
 
 
+@app.route("/health", methods=['GET'])
+def health():
+    # 503 until every model is loaded
+    status = registry.health()
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    return jsonify({'models': registry.metrics()})
+
+
 @app.route("/", methods=['GET'])
 def index():
     return "XOXO"
 
 
+def start():
+    # the background threads: model warm-up and the job workers, which resume unfinished jobs.
+    # serve.py starts them in each worker process instead, after the fork
+    if os.environ.get('INCUBATOR_WARMUP', '1') == '1':
+        registry.warm_up()
+    job_queue.start()
+
+
+if os.environ.get('INCUBATOR_DEFER_START', '0') != '1':
+    start()
+
+
 if __name__ == '__main__':
+    # the development server, serve.py runs the app with several workers
     port = 43101
     app.run(port=port)
@@ -13,6 +13,7 @@ import numpy as np
 # TODO: support splitting text into multiple lines
 class MangaOcr:
     def __init__(self, pretrained_model_name_or_path='kha-white/manga-ocr-base', force_cpu=False):
+        self.model_name = str(pretrained_model_name_or_path)
         self.feature_extractor = AutoFeatureExtractor.from_pretrained(
             pretrained_model_name_or_path)
         self.tokenizer = AutoTokenizer.from_pretrained(
@@ -24,28 +25,40 @@ class MangaOcr:
             self.model.cuda()
 
     def __call__(self, img_or_path):
-        if isinstance(img_or_path, str) or isinstance(img_or_path, Path):
-            img = Image.open(img_or_path)
-        elif isinstance(img_or_path, Image.Image):
-            img = img_or_path
-        else:
-            raise ValueError(
-                f'img_or_path must be a path or PIL.Image, instead got: {img_or_path}')
+        return self.batch([img_or_path])[0]
 
-        img = img.convert('L').convert('RGB')
+    @torch.no_grad()
+    def batch(self, imgs_or_paths):
+        imgs = [load_image(img_or_path) for img_or_path in imgs_or_paths]
+        if len(imgs) == 0:
+            return []
 
-        x = self._preprocess(img)
-        x = self.model.generate(x[None].to(
-            self.model.device), max_length=300)[0].cpu()
-        x = self.tokenizer.decode(x, skip_special_tokens=True)
-        x = post_process(x)
+        x = self._preprocess(imgs)
+        x = self.model.generate(x.to(
+            self.model.device), max_length=300).cpu()
+        texts = self.tokenizer.batch_decode(x, skip_special_tokens=True)
 
-        return x
+        return [post_process(text) for text in texts]
 
-    def _preprocess(self, img):
+    def _preprocess(self, imgs):
         pixel_values = self.feature_extractor(
-            img, return_tensors="pt").pixel_values
-        return pixel_values.squeeze()
+            imgs, return_tensors="pt").pixel_values
+        return pixel_values
+
+
+def load_image(img_or_path):
+    if isinstance(img_or_path, str) or isinstance(img_or_path, Path):
+        img = Image.open(img_or_path)
+    elif isinstance(img_or_path, Image.Image):
+        img = img_or_path
+    else:
+        raise ValueError(
+            f'img_or_path must be a path or PIL.Image, instead got: {img_or_path}')
+
+    # gray images, e.g. raw pixel uploads, skip a conversion
+    if img.mode != 'L':
+        img = img.convert('L')
+    return img.convert('RGB')
 
 
 def post_process(text):
@@ -0,0 +1,142 @@
+import resource
+import threading
+import time
+
+from loguru import logger
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # peak rss, in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class LazyModel:
+    '''
+    A model loaded on first use, or ahead of it by load(warm_up=True) from a background thread.
+    load_fn() returns the model, warm_up_fn(model) runs a dummy forward pass to prime allocator and kernel caches.
+    '''
+
+    def __init__(self, name, load_fn, warm_up_fn=None, fork_safe=False):
+        self.name = name
+        self.load_fn = load_fn
+        self.warm_up_fn = warm_up_fn
+        # can be loaded before the server forks its workers, which then share its weights
+        self.fork_safe = fork_safe
+        self.state = 'not_loaded'
+        self.error = None
+        self.load_time = None
+        self.warm_up_time = None
+        self.first_inference_time = None
+        self.rss_mb = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.state == 'ready'
+
+    def get(self):
+        if self._model is None:
+            self.load()
+        if self._model is None:
+            raise RuntimeError(f'{self.name} failed to load: {self.error}')
+        return self._model
+
+    def load(self, warm_up=False):
+        # requests arriving meanwhile wait here, until the model is loaded and warmed up
+        with self._lock:
+            warm_up = warm_up and self.warm_up_fn is not None and self.warm_up_time is None
+            if self._model is not None and not warm_up:
+                return
+            rss_start = rss_mb()
+            model = self._model
+            try:
+                if model is None:
+                    self.state = 'loading'
+                    start = time.perf_counter()
+                    model = self.load_fn()
+                    self.load_time = time.perf_counter() - start
+                if warm_up:
+                    # also when preloaded before a fork, the warm-up runs in the worker
+                    self.state = 'warming_up'
+                    start = time.perf_counter()
+                    self.warm_up_fn(model)
+                    self.warm_up_time = time.perf_counter() - start
+            except Exception as e:
+                logger.exception("Failed to load {}", self.name)
+                self.state = 'failed'
+                self.error = str(e)
+                return
+            self.rss_mb = (self.rss_mb or 0) + rss_mb() - rss_start
+            self.error = None
+            self._model = model
+            self.state = 'ready'
+        logger.info("{} ready, loaded in {:.2f}s", self.name, self.load_time)
+
+    def runner(self, fn):
+        # fn(model, *args) on the loaded model, the first call is timed as the first inference
+        def run(*args, **kwargs):
+            model = self.get()
+            start = time.perf_counter()
+            result = fn(model, *args, **kwargs)
+            if self.first_inference_time is None:
+                self.first_inference_time = time.perf_counter() - start
+            return result
+        return run
+
+    def to_dict(self):
+        return {
+            'state': self.state,
+            'error': self.error,
+            'load_s': self.load_time,
+            'warm_up_s': self.warm_up_time,
+            'first_inference_s': self.first_inference_time,
+            'rss_mb': self.rss_mb,
+        }
+
+
+class ModelRegistry:
+    def __init__(self):
+        self.models = {}
+        self._thread = None
+
+    def register(self, name, load_fn, warm_up_fn=None, fork_safe=False) -> LazyModel:
+        model = LazyModel(name, load_fn, warm_up_fn, fork_safe)
+        self.models[name] = model
+        return model
+
+    def preload(self):
+        # load the fork safe models without running them, in the process about to fork,
+        # so the workers share the weights pages copy-on-write. The others load in each worker
+        for model in self.models.values():
+            if model.fork_safe:
+                model.load()
+
+    def warm_up(self):
+        # load and warm up every model in registration order, without holding up the caller
+        def run():
+            for model in self.models.values():
+                model.load(warm_up=True)
+
+        self._thread = threading.Thread(target=run, name='model-warm-up', daemon=True)
+        self._thread.start()
+
+    @property
+    def ready(self):
+        return all(model.ready for model in self.models.values())
+
+    def health(self):
+        return {
+            'ready': self.ready,
+            'models': {name: model.state for name, model in self.models.items()},
+        }
+
+    def metrics(self):
+        return {name: model.to_dict() for name, model in self.models.items()}
@@ -0,0 +1,78 @@
+'''
+Production server: gunicorn with several worker processes sharing the model weights, run from the incubator directory:
+
+    python serve.py --workers 4
+
+The torch models are loaded once in the master process before it forks the workers, so their weights pages are shared
+copy-on-write instead of loaded again by every worker. Each worker then warms up its models and runs
+INCUBATOR_THREADS intra-op threads, the cores divided by the workers unless set, so workers do not oversubscribe the cores.
+'''
+import argparse
+import gc
+import os
+import sys
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    sys.exit('serve.py needs gunicorn: pip install gunicorn')
+
+
+class Server(BaseApplication):
+    def __init__(self, app, options):
+        self.application = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def post_fork(server, worker):
+    import main as incubator
+
+    # thread pools do not survive the fork, set the thread counts again in the worker
+    incubator.set_threads()
+    incubator.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='incubator production server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=43101)
+    parser.add_argument('--workers', type=int, default=1, help='worker processes')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='request threads per worker, defaults to INCUBATOR_MAX_QUEUE + 4, or 8 without a limit')
+    parser.add_argument('--timeout', type=int, default=120, help='seconds before a silent worker is restarted')
+    args = parser.parse_args()
+
+    os.environ.setdefault('INCUBATOR_THREADS', str(max(1, (os.cpu_count() or 1) // args.workers)))
+    # warm-up and the job workers run in the workers, after the fork
+    os.environ['INCUBATOR_DEFER_START'] = '1'
+    import main as incubator
+
+    threads = args.threads
+    if threads is None:
+        # spare threads answer the requests over the limit, rather than leave them waiting for a thread
+        threads = incubator.max_queue + 4 if incubator.max_queue > 0 else 8
+
+    incubator.registry.preload()
+    # objects loaded so far are never collected, so collections in the workers do not write to their shared pages
+    gc.freeze()
+
+    Server(incubator.app, {
+        'bind': f'{args.host}:{args.port}',
+        'workers': args.workers,
+        'worker_class': 'gthread',
+        'threads': threads,
+        'timeout': args.timeout,
+        'post_fork': post_fork,
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+
+# the tests import the incubator modules as the server does, from the incubator directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# synthetic detector outputs and the reference implementations of the rewritten post-processing,
+# shared by the tests and benchmark.py
+
+
+def synthetic_detections(num_blocks, seed=0):
+    # block boxes and text line polygons in the layout of a manga page, as group_output takes them
+    rng = np.random.default_rng(seed)
+    im_w, im_h = 1200, 1800
+    boxes, lines = [], []
+    for _ in range(num_blocks):
+        x, y = rng.integers(0, im_w - 300), rng.integers(0, im_h - 300)
+        vertical = rng.random() < 0.6
+        font_size = rng.integers(14, 40)
+        blk_lines = []
+        for jj in range(rng.integers(1, 7)):
+            if vertical:
+                lx, ly = x + 250 - jj * (font_size + rng.integers(2, 30)), y + rng.integers(0, 10)
+                w, h = font_size, rng.integers(60, 250)
+            else:
+                lx, ly = x + rng.integers(0, 10), y + jj * (font_size + rng.integers(2, 25))
+                w, h = rng.integers(60, 250), font_size
+            blk_lines.append([[lx, ly], [lx + w, ly], [lx + w, ly + h], [lx, ly + h]])
+        blk_lines = np.array(blk_lines, np.int32)
+        lines.extend(blk_lines)
+        if rng.random() < 0.85:
+            boxes.append(np.concatenate([blk_lines.min(axis=(0, 1)) - 4, blk_lines.max(axis=(0, 1)) + 4]))
+    boxes = np.array(boxes, np.int32).reshape(-1, 4)
+    blks = boxes, rng.integers(0, 2, len(boxes)).astype(np.int32), np.ones(len(boxes))
+    lines = np.array(lines)[rng.permutation(len(lines))]
+    mask = (rng.random((im_h, im_w)) < 0.2).astype(np.uint8) * 255
+    return blks, lines, im_w, im_h, mask
+
+
+def merge_textlines_loop(blk_list):
+    # merge_textlines trying every later block, as before the grid index, kept as the reference
+    from comic_text_detector.utils.textblock import try_merge_textline
+
+    if len(blk_list) < 2:
+        return blk_list
+    blk_list.sort(key=lambda blk: blk.distance[0])
+    merged_list = []
+    for ii, current_blk in enumerate(blk_list):
+        if current_blk.merged:
+            continue
+        for blk in blk_list[ii+1:]:
+            try_merge_textline(current_blk, blk)
+        merged_list.append(current_blk)
+    for blk in merged_list:
+        blk.adjust_bbox(with_bbox=False)
+    return merged_list
+
+
+def scattered_textlines(num_lines, seed=0):
+    # single line blocks left over by group_output, packed so that neighbours merge
+    from comic_text_detector.utils.textblock import TextBlock, TextBlockBatch, examine_textblocks
+
+    rng = np.random.default_rng(seed)
+    im_w, im_h = 1200, 1800
+    lines = []
+    for _ in range(num_lines):
+        font_size = rng.integers(14, 40)
+        x, y = rng.integers(0, im_w - 250), rng.integers(0, im_h - 250)
+        w, h = rng.integers(40, 250), font_size
+        lines.append([[[x, y], [x + w, y], [x + w, y + h], [x, y + h]]])
+    batch = TextBlockBatch.from_blocks([TextBlock([0, 0, 0, 0], lines=blk_lines) for blk_lines in lines])
+    examine_textblocks(batch, im_w, im_h, sort=False)
+    return batch
+
+
+def synthetic_line_map(seed, size=1024, num_lines=120, noise=0.3):
+    # a DB line probability map: text lines at various angles over speckle that leaves many small contours
+    rng = np.random.default_rng(seed)
+    lines_map = np.zeros((size, size), np.float32)
+    for _ in range(num_lines):
+        x, y = rng.integers(0, size - 60, 2)
+        if rng.random() < 0.6:
+            w, h = rng.integers(8, 30), rng.integers(20, 300)
+        else:
+            w, h = rng.integers(20, 300), rng.integers(8, 30)
+        angle = rng.uniform(-20, 20) if rng.random() < 0.3 else 0
+        rect = ((float(x + w / 2), float(y + h / 2)), (float(w), float(h)), angle)
+        cv2.fillPoly(lines_map, [cv2.boxPoints(rect).astype(np.int32)], float(rng.uniform(0.3, 1)))
+    lines_map += rng.random((size, size), np.float32) * noise
+    return np.clip(cv2.GaussianBlur(lines_map, (5, 5), 0), 0, 1)
+
+
+def synthetic_yolo_output(num_candidates, num_anchors=64512, seed=0):
+    # raw detector output with num_candidates boxes above the confidence threshold, clustered as around real blocks
+    rng = np.random.default_rng(seed)
+    prediction = np.zeros((1, num_anchors, 7), np.float32)
+    prediction[..., 4] = rng.uniform(0, 0.3, num_anchors)
+    index = rng.choice(num_anchors, num_candidates, replace=False)
+    centers = rng.uniform(0, 1024, (max(num_candidates // 10, 1), 2))
+    prediction[0, index, :2] = centers[rng.integers(0, len(centers), num_candidates)] + rng.normal(0, 6, (num_candidates, 2))
+    prediction[0, index, 2:4] = rng.uniform(20, 300, (num_candidates, 2))
+    prediction[0, index, 4] = rng.uniform(0.5, 1, num_candidates)
+    prediction[..., 5:] = rng.random((1, num_anchors, 2))
+    return prediction
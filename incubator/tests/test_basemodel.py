@@ -0,0 +1,82 @@
+'''
+Numerical equivalence of the inference optimizations of TextDetBase: BatchNorm folded into the convolutions
+of the heads, and the heads frozen with TorchScript, against the eager network.
+'''
+import copy
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from comic_text_detector.basemodel import DBHead, TextDetBase, UnetHead, fuse_bn
+from comic_text_detector.models.yolov5.yolo import Model
+
+# yolov5s, the block detector of the released model
+YOLOV5S_CFG = {
+    'nc': 2, 'depth_multiple': 0.33, 'width_multiple': 0.5,
+    'anchors': [[10, 13, 16, 30, 33, 23], [30, 61, 62, 45, 59, 119], [116, 90, 156, 198, 373, 326]],
+    'backbone': [[-1, 1, 'Conv', [64, 6, 2, 2]], [-1, 1, 'Conv', [128, 3, 2]], [-1, 3, 'C3', [128]],
+                 [-1, 1, 'Conv', [256, 3, 2]], [-1, 6, 'C3', [256]], [-1, 1, 'Conv', [512, 3, 2]],
+                 [-1, 9, 'C3', [512]], [-1, 1, 'Conv', [1024, 3, 2]], [-1, 3, 'C3', [1024]],
+                 [-1, 1, 'SPPF', [1024, 5]]],
+    'head': [[-1, 1, 'Conv', [512, 1, 1]], [-1, 1, 'nn.Upsample', [None, 2, 'nearest']], [[-1, 6], 1, 'Concat', [1]],
+             [-1, 3, 'C3', [512, False]], [-1, 1, 'Conv', [256, 1, 1]], [-1, 1, 'nn.Upsample', [None, 2, 'nearest']],
+             [[-1, 4], 1, 'Concat', [1]], [-1, 3, 'C3', [256, False]], [-1, 1, 'Conv', [256, 3, 2]],
+             [[-1, 14], 1, 'Concat', [1]], [-1, 3, 'C3', [512, False]], [-1, 1, 'Conv', [512, 3, 2]],
+             [[-1, 10], 1, 'Concat', [1]], [-1, 3, 'C3', [1024, False]], [[17, 20, 23], 1, 'Detect', ['nc', 'anchors']]],
+}
+# the outputs are probabilities, float32 rounding of the folded weights stays far below it
+ATOL = 1e-4
+
+
+def randomize_bn(model):
+    # untrained batchnorm is the identity, which folding would trivially preserve
+    for m in model.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.1, 0.1)
+            m.running_var.uniform_(0.5, 1.5)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.1, 0.1)
+    return model
+
+
+@pytest.fixture(scope='module')
+def model_path(tmp_path_factory):
+    # a checkpoint laid out as the released comictextdetector.pt, with random weights
+    torch.manual_seed(0)
+    blk_det = randomize_bn(Model(copy.deepcopy(YOLOV5S_CFG)))
+    text_seg = randomize_bn(UnetHead(act='leaky'))
+    text_det = randomize_bn(DBHead(64, act='leaky'))
+    path = tmp_path_factory.mktemp('models') / 'random_ctd.pt'
+    torch.save({'blk_det': {'cfg': YOLOV5S_CFG, 'weights': blk_det.state_dict()},
+                'text_seg': text_seg.state_dict(), 'text_det': text_det.state_dict()}, path)
+    return str(path)
+
+
+def assert_outputs_close(result, expected):
+    for name, a, b in zip(('blocks', 'mask', 'lines'), result, expected):
+        assert a.shape == b.shape, name
+        torch.testing.assert_close(a, b, atol=ATOL, rtol=0, msg=lambda msg: f'{name}: {msg}')
+
+
+@pytest.mark.parametrize('optimize', [False, True])
+def test_folded_heads_match_eager(model_path, optimize):
+    eager = TextDetBase(model_path).eval()
+    if optimize:
+        # folded and frozen on the first forward pass
+        folded = TextDetBase(model_path, optimize=True).eval()
+    else:
+        # folded as optimize does it, without freezing
+        folded = TextDetBase(model_path, fuse=True).eval()
+        fuse_bn(folded.text_seg)
+        fuse_bn(folded.text_det)
+    assert not any(isinstance(m, torch.nn.BatchNorm2d) for m in folded.heads.modules())
+
+    torch.manual_seed(1)
+    x = torch.rand(1, 3, 256, 256)
+    with torch.no_grad():
+        assert_outputs_close(folded(x), eager(x))
+        assert isinstance(folded.heads, torch.jit.ScriptModule) == optimize
+        # the heads are traced once, other batch sizes and shapes run through the same graph
+        x = torch.rand(2, 3, 192, 320)
+        assert_outputs_close(folded(x), eager(x))
@@ -0,0 +1,163 @@
+'''
+JobStore page states and the recovery of pages left running by a process that is gone, on a temporary database.
+'''
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+import pytest
+
+from jobs import PAGE_CANCELLED, PAGE_DONE, PAGE_FAILED, PAGE_QUEUED, PAGE_RUNNING, JobQueue, JobStore, \
+    process_owner, process_start
+
+HAS_PROC = os.path.exists('/proc/self/stat')
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'jobs.sqlite3')
+
+
+@pytest.fixture
+def store(db_path):
+    return JobStore(db_path)
+
+
+def page_rows(db_path, job_id):
+    db = sqlite3.connect(db_path)
+    try:
+        return db.execute('SELECT idx, state, owner, data FROM pages WHERE job_id = ? ORDER BY idx', (job_id,)).fetchall()
+    finally:
+        db.close()
+
+
+def set_owner(db_path, job_id, idx, owner):
+    db = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        db.execute('UPDATE pages SET owner = ? WHERE job_id = ? AND idx = ?', (owner, job_id, idx))
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def dead_pid():
+    # the PID of a process that has exited and was reaped
+    proc = subprocess.Popen([sys.executable, '-c', ''])
+    proc.wait()
+    return proc.pid
+
+
+@pytest.fixture
+def live_pid():
+    proc = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+    yield proc.pid
+    proc.kill()
+    proc.wait()
+
+
+def test_create_claim_finish(store, db_path):
+    job_id = store.create([('a.png', b'a'), ('b.png', b'b')], ocr=False)
+    assert store.status(job_id)['state'] == 'queued'
+
+    assert store.claim() == (job_id, 0, b'a', {'ocr': False})
+    assert store.claim() == (job_id, 1, b'b', {'ocr': False})
+    assert store.claim() is None
+    assert [(idx, state, owner) for idx, state, owner, _ in page_rows(db_path, job_id)] == \
+        [(0, PAGE_RUNNING, process_owner()), (1, PAGE_RUNNING, process_owner())]
+
+    store.finish(job_id, 0, [{'text': 'あ'}])
+    store.finish(job_id, 1, error='boom')
+    status = store.status(job_id, results=True)
+    assert status['state'] == 'failed'
+    assert (status[PAGE_DONE], status[PAGE_FAILED]) == (1, 1)
+    assert status['results'] == [
+        {'index': 0, 'name': 'a.png', 'state': PAGE_DONE, 'result': [{'text': 'あ'}], 'error': None},
+        {'index': 1, 'name': 'b.png', 'state': PAGE_FAILED, 'result': None, 'error': 'boom'},
+    ]
+    # the image of a done page is dropped, a failed one keeps it for a retry
+    assert [data for _, _, _, data in page_rows(db_path, job_id)] == [None, b'b']
+    assert [page['index'] for page in store.status(job_id, results=True, since=1)['results']] == [1]
+
+
+def test_retry(store):
+    job_id = store.create([('a.png', b'a')])
+    store.claim()
+    store.finish(job_id, 0, error='boom')
+    assert store.retry(job_id)
+    assert store.status(job_id)[PAGE_QUEUED] == 1
+    assert store.claim() == (job_id, 0, b'a', {})
+    store.finish(job_id, 0, [])
+    assert store.status(job_id)['state'] == 'done'
+    assert not store.retry('missing')
+
+
+def test_cancel(store):
+    job_id = store.create([('a.png', b'a'), ('b.png', b'b')])
+    store.claim()
+    assert store.cancel(job_id)
+    status = store.status(job_id)
+    # the running page still finishes
+    assert (status[PAGE_RUNNING], status[PAGE_CANCELLED]) == (1, 1)
+    assert store.claim() is None
+    store.finish(job_id, 0, error='boom')
+    assert store.status(job_id)['state'] == 'cancelled'
+    assert not store.retry(job_id)
+    assert not store.cancel('missing')
+
+
+def test_delete(store):
+    job_id = store.create([('a.png', b'a')])
+    assert store.delete(job_id)
+    assert store.status(job_id) is None
+    assert store.claim() is None
+    assert not store.delete(job_id)
+
+
+def test_recover_stale_owners(store, db_path, dead_pid):
+    pid = os.getpid()
+    owners = [
+        process_owner(),            # this process, alive
+        f'{dead_pid}:1',            # a process that is gone
+        str(dead_pid),              # a bare PID of an older database, gone
+        str(pid),                   # a bare PID reused by this process
+        f'{pid}:0',                 # an earlier process with the PID of this one
+    ]
+    job_id = store.create([(f'{idx}.png', b'x') for idx in range(len(owners))])
+    for idx, owner in enumerate(owners):
+        store.claim()
+        set_owner(db_path, job_id, idx, owner)
+
+    assert store.recover() == len(owners) - 1
+    assert [(state, owner) for _, state, owner, _ in page_rows(db_path, job_id)] == \
+        [(PAGE_RUNNING, process_owner())] + [(PAGE_QUEUED, None)] * (len(owners) - 1)
+    assert store.recover() == 0
+
+
+@pytest.mark.skipif(not HAS_PROC, reason='process start times are read from /proc')
+def test_recover_reused_pid(store, db_path, live_pid):
+    # a live process only owns the pages claimed with its own start time
+    job_id = store.create([('a.png', b'a'), ('b.png', b'b'), ('c.png', b'c')])
+    for idx, owner in enumerate([f'{live_pid}:{process_start(live_pid)}', f'{live_pid}:0', str(live_pid)]):
+        store.claim()
+        set_owner(db_path, job_id, idx, owner)
+
+    assert store.recover() == 1
+    assert [state for _, state, _, _ in page_rows(db_path, job_id)] == [PAGE_RUNNING, PAGE_QUEUED, PAGE_RUNNING]
+
+
+def test_queue_runs_pages(store):
+    def page_fn(data, scale=1):
+        if data == b'bad':
+            raise RuntimeError('bad page')
+        return len(data) * scale
+
+    queue = JobQueue(store, page_fn, num_workers=2, poll_interval=0.05)
+    job_id = queue.submit([('a.png', b'aa'), ('b.png', b'bad'), ('c.png', b'ccc')], scale=10)
+    deadline = time.time() + 10
+    while store.status(job_id)['state'] in ('queued', 'running') and time.time() < deadline:
+        time.sleep(0.02)
+    results = store.status(job_id, results=True)['results']
+    assert [(page['state'], page['result'], page['error']) for page in results] == \
+        [(PAGE_DONE, 20, None), (PAGE_FAILED, None, 'bad page'), (PAGE_DONE, 30, None)]
@@ -0,0 +1,87 @@
+'''
+Regression tests of the rewritten post-processing against the implementations they replaced:
+numpy NMS against the torchvision path, score-first DB line extraction against the original boxes_from_bitmap,
+and the grid indexed textline merge against the all pairs loop.
+'''
+import cv2
+import numpy as np
+import pytest
+
+from conftest import merge_textlines_loop, scattered_textlines, synthetic_line_map, synthetic_yolo_output
+from comic_text_detector.utils.db_utils import SegDetectorRepresenter
+from comic_text_detector.utils.nms import non_max_suppression
+from comic_text_detector.utils.textblock import merge_textlines, quads_intersect
+
+
+def boxes_from_bitmap_baseline(seg_rep, pred, bitmap):
+    # SegDetectorRepresenter.boxes_from_bitmap before contours were scored first: every contour is unclipped,
+    # boxes are filtered by score afterwards
+    height, width = bitmap.shape
+    contours, _ = cv2.findContours((bitmap * 255).astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    num_contours = min(len(contours), seg_rep.max_candidates)
+    boxes = np.zeros((num_contours, 4, 2), dtype=np.int16)
+    scores = np.zeros((num_contours,), dtype=np.float32)
+    for index in range(num_contours):
+        contour = contours[index].squeeze(1)
+        points, sside = seg_rep.get_mini_boxes(contour)
+        if sside < 2:
+            continue
+        score = seg_rep.box_score_fast(pred, contour)
+        box = seg_rep.unclip(np.array(points), unclip_ratio=seg_rep.unclip_ratio).reshape(-1, 1, 2)
+        box = np.array(seg_rep.get_mini_boxes(box)[0])
+        box[:, 0] = np.clip(np.round(box[:, 0] / width * width), 0, width)
+        box[:, 1] = np.clip(np.round(box[:, 1] / height * height), 0, height)
+        boxes[index] = box.astype(np.int16)
+        scores[index] = score
+    return boxes, scores
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_boxes_from_bitmap_matches_baseline(seed):
+    seg_rep = SegDetectorRepresenter(thresh=0.3)
+    lines_map = synthetic_line_map(seed, size=512)
+    expected_boxes, expected_scores = boxes_from_bitmap_baseline(seg_rep, lines_map, seg_rep.binarize(lines_map))
+
+    boxes, scores = seg_rep(lines_map.shape, lines_map[None, None])
+    np.testing.assert_array_equal(boxes[0], expected_boxes)
+    np.testing.assert_array_equal(scores[0], expected_scores)
+
+    # as the detector calls it, rejecting low scores before unclipping
+    keep = expected_scores > 0.6
+    boxes, scores = seg_rep(lines_map.shape, lines_map[None, None], min_score=0.6)
+    np.testing.assert_array_equal(boxes[0], expected_boxes[keep])
+    np.testing.assert_array_equal(scores[0], expected_scores[keep])
+
+
+@pytest.mark.parametrize('num_candidates', [0, 10, 500, 3000])
+def test_nms_matches_torchvision(num_candidates):
+    torch = pytest.importorskip('torch')
+    pytest.importorskip('torchvision')
+    from comic_text_detector.utils.yolov5_utils import non_max_suppression as non_max_suppression_torch
+
+    # two images, so both are run through one batched call
+    prediction = np.concatenate([synthetic_yolo_output(num_candidates, num_anchors=16128, seed=seed) for seed in (0, 1)])
+    dets = non_max_suppression(prediction, 0.4, 0.35)
+    expected = non_max_suppression_torch(torch.from_numpy(prediction), 0.4, 0.35)
+    assert len(dets) == len(expected)
+    for image_dets, image_expected in zip(dets, expected):
+        np.testing.assert_array_equal(image_dets, image_expected.numpy())
+
+
+def test_quads_intersect_matches_shapely():
+    from shapely.geometry import Polygon
+
+    quads = scattered_textlines(120).lines
+    ii, jj = np.triu_indices(len(quads), 1)
+    expected = np.array([Polygon(quads[i]).intersects(Polygon(quads[j])) for i, j in zip(ii, jj)], bool)
+    np.testing.assert_array_equal(quads_intersect(quads[ii], quads[jj]), expected)
+
+
+@pytest.mark.parametrize('num_lines', [1, 50, 300])
+def test_merge_textlines_matches_loop(num_lines):
+    batch = scattered_textlines(num_lines)
+
+    def run(fn):
+        return [(blk.xyxy, np.asarray(blk.lines).tolist(), blk.font_size) for blk in fn(batch.to_blocks())]
+
+    assert run(merge_textlines) == run(merge_textlines_loop)
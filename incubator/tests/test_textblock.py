@@ -0,0 +1,53 @@
+'''
+group_output on synthetic pages against tests/data/group_output.json, the blocks the implementation before the
+intersection matrix rewrite returned for them.
+'''
+import json
+import os
+
+import numpy as np
+import pytest
+
+from conftest import synthetic_detections
+from comic_text_detector.utils.textblock import group_output
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'group_output.json')
+FIELDS = ('xyxy', 'lines', 'vertical', 'language', 'font_size', 'angle', 'distance')
+
+
+def page(seed, mask_mode):
+    blks, lines, im_w, im_h, mask = synthetic_detections(30, seed)
+    if mask_mode == 'none':
+        mask = None
+    else:
+        # text mask on the right half only, lines and blocks on the left half have too little of it to be kept
+        mask[:, :im_w // 2] = 0
+    return blks, lines, im_w, im_h, mask
+
+
+def block_fields(blk):
+    return json.loads(json.dumps({name: getattr(blk, name) for name in FIELDS}, default=lambda o: o.tolist()))
+
+
+@pytest.fixture(scope='module')
+def golden():
+    with open(GOLDEN) as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('mask_mode', ['none', 'half'])
+def test_group_output_matches_golden(golden, seed, mask_mode):
+    # a block split from a larger one used to keep the distances of all the lines of that block,
+    # it now has none, the golden blocks record the distance as null there
+    result = group_output(*page(seed, mask_mode)).to_blocks()
+    expected = golden[f'{seed}-{mask_mode}']
+    assert len(result) == len(expected)
+    for blk, expected_blk in zip(result, expected):
+        assert block_fields(blk) == pytest.approx(expected_blk)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_group_output_distance_per_line(seed):
+    for blk in group_output(*page(seed, 'none')).to_blocks():
+        assert blk.distance is None or len(blk.distance) == len(blk.lines)
@@ -0,0 +1,73 @@
+'''
+Round trips of the binary request and response bodies of transport.py.
+'''
+import cv2
+import numpy as np
+import pytest
+
+from conftest import synthetic_detections
+from comic_text_detector.utils.textblock import group_output
+from transport import PIXELS_HEADER, PIXELS_MAGIC, decode_bgr, decode_pil, pack_blocks, pack_pixels, unpack_blocks, \
+    unpack_pixels
+
+
+@pytest.mark.parametrize('shape', [(40, 30), (40, 30, 3), (40, 30, 4)])
+def test_pixels_round_trip(shape):
+    img = np.random.default_rng(0).integers(0, 256, shape, dtype=np.uint8)
+    data = pack_pixels(img)
+    np.testing.assert_array_equal(unpack_pixels(data), img)
+    expected = cv2.cvtColor(img, {2: cv2.COLOR_GRAY2BGR, 3: cv2.COLOR_RGB2BGR, 4: cv2.COLOR_RGBA2BGR}[len(shape)])
+    np.testing.assert_array_equal(decode_bgr(data), expected)
+    pil = decode_pil(data)
+    assert pil.size == (30, 40)
+    np.testing.assert_array_equal(np.asarray(pil), img)
+
+
+def test_decode_encoded_image():
+    img = np.random.default_rng(0).integers(0, 256, (40, 30, 3), dtype=np.uint8)
+    data = cv2.imencode('.png', img)[1].tobytes()
+    np.testing.assert_array_equal(decode_bgr(data), img)
+    np.testing.assert_array_equal(np.asarray(decode_pil(data)), img[..., ::-1])
+    with pytest.raises(ValueError):
+        decode_bgr(b'not an image')
+
+
+@pytest.mark.parametrize('data', [
+    pack_pixels(np.zeros((0, 5, 3), np.uint8)),
+    pack_pixels(np.zeros((5, 0), np.uint8)),
+    pack_pixels(np.zeros((5, 5, 3), np.uint8))[:-1],
+    PIXELS_HEADER.pack(PIXELS_MAGIC, 5, 5, 2) + bytes(50),
+    PIXELS_MAGIC,
+], ids=['no rows', 'no columns', 'truncated', 'two channels', 'no header'])
+def test_malformed_pixels(data):
+    with pytest.raises(ValueError):
+        unpack_pixels(data)
+    with pytest.raises(ValueError):
+        decode_bgr(data)
+
+
+@pytest.mark.parametrize('lines', [False, True])
+def test_blocks_round_trip(lines):
+    blks, page_lines, im_w, im_h, mask = synthetic_detections(30, seed=0)
+    batch = group_output(blks, page_lines, im_w, im_h, mask)
+    mask_refined = mask // 2
+    result = unpack_blocks(pack_blocks(batch, lines=lines, mask=mask, mask_refined=mask_refined))
+    np.testing.assert_array_equal(result['boxes'], batch.xyxy)
+    np.testing.assert_array_equal(result['vertical'], batch.vertical)
+    if lines:
+        np.testing.assert_array_equal(result['line_counts'], np.diff(batch.offsets))
+        np.testing.assert_array_equal(result['lines'], batch.lines)
+    else:
+        assert 'lines' not in result and 'line_counts' not in result
+    np.testing.assert_array_equal(result['mask'], mask)
+    np.testing.assert_array_equal(result['mask_refined'], mask_refined)
+    # a list of blocks packs the same as their batch
+    assert pack_blocks(batch.to_blocks(), lines=lines) == pack_blocks(batch, lines=lines)
+
+
+def test_no_blocks_round_trip():
+    result = unpack_blocks(pack_blocks(None, lines=True))
+    assert result['boxes'].shape == (0, 4)
+    assert result['lines'].shape == (0, 4, 2)
+    assert result['vertical'].shape == (0,)
+    assert 'mask' not in result
@@ -0,0 +1,141 @@
+'''
+Binary request and response bodies, an alternative to multipart uploads and JSON results for large pages.
+
+Requests send the page as the raw body: an encoded image with an image/* content type, or its decoded pixels,
+CONTENT_TYPE_PIXELS, as a PIXELS_HEADER followed by height * width * channels uint8 values, row major,
+gray (1 channel), RGB (3) or RGBA (4).
+
+Detector results are sent as CONTENT_TYPE_BLOCKS when the client accepts it: a BLOCKS_HEADER then, in order,
+    boxes        int32   (blocks, 4)        x1, y1, x2, y2
+    line_counts  int32   (blocks,)          with FLAG_LINES, lines of each block
+    lines        int32   (lines, 4, 2)      with FLAG_LINES, the line polygons of all blocks, block after block
+    vertical     uint8   (blocks,)
+    mask         uint8   (height, width)    with FLAG_MASK
+    mask_refined uint8   (height, width)    with FLAG_MASK_REFINED
+All little-endian, the int32 arrays come first so that each starts 4-byte aligned, e.g. for a javascript Int32Array.
+'''
+import io
+import struct
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from comic_text_detector.utils.textblock import TextBlockBatch
+
+CONTENT_TYPE_PIXELS = 'application/x-incubator-pixels'
+CONTENT_TYPE_BLOCKS = 'application/x-incubator-blocks'
+
+# magic, height, width, channels
+PIXELS_MAGIC = b'IPXL'
+PIXELS_HEADER = struct.Struct('<4sIII')
+# magic, version, flags, blocks, lines, mask height, mask width
+BLOCKS_MAGIC = b'IBLK'
+BLOCKS_VERSION = 1
+BLOCKS_HEADER = struct.Struct('<4sHHIIII')
+
+FLAG_LINES = 1
+FLAG_MASK = 2
+FLAG_MASK_REFINED = 4
+
+
+def is_pixels(data) -> bool:
+    return data[:len(PIXELS_MAGIC)] == PIXELS_MAGIC
+
+
+def pack_pixels(img: np.ndarray) -> bytes:
+    # img: (height, width) gray, or (height, width, 3 or 4) RGB(A) uint8
+    img = np.ascontiguousarray(img, np.uint8)
+    height, width = img.shape[:2]
+    channels = 1 if img.ndim == 2 else img.shape[2]
+    return PIXELS_HEADER.pack(PIXELS_MAGIC, height, width, channels) + img.tobytes()
+
+
+def unpack_pixels(data) -> np.ndarray:
+    # a read-only view of the pixels in data, (height, width) for gray, (height, width, channels) otherwise
+    if len(data) < PIXELS_HEADER.size:
+        raise ValueError('Pixels body is shorter than its header')
+    magic, height, width, channels = PIXELS_HEADER.unpack_from(data)
+    if magic != PIXELS_MAGIC:
+        raise ValueError('Pixels body does not start with ' + PIXELS_MAGIC.decode())
+    if channels not in (1, 3, 4):
+        raise ValueError(f'Pixels must have 1, 3 or 4 channels, got {channels}')
+    if height == 0 or width == 0:
+        raise ValueError(f'Pixels body of an empty {height}x{width} image')
+    if len(data) != PIXELS_HEADER.size + height * width * channels:
+        raise ValueError(f'Pixels body of {len(data)} bytes does not hold {height}x{width}x{channels} pixels')
+    pixels = np.frombuffer(data, np.uint8, offset=PIXELS_HEADER.size)
+    return pixels.reshape((height, width) if channels == 1 else (height, width, channels))
+
+
+def decode_bgr(data) -> np.ndarray:
+    # the page of an encoded image or a pixels body, as BGR for the detector
+    if is_pixels(data):
+        pixels = unpack_pixels(data)
+        if pixels.ndim == 2:
+            return cv2.cvtColor(pixels, cv2.COLOR_GRAY2BGR)
+        return cv2.cvtColor(pixels, cv2.COLOR_RGB2BGR if pixels.shape[2] == 3 else cv2.COLOR_RGBA2BGR)
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError('Image could not be decoded')
+    return img
+
+
+def decode_pil(data) -> Image.Image:
+    # the image of an encoded image or a pixels body, for the OCR. Gray pixels are wrapped without a copy
+    if is_pixels(data):
+        pixels = unpack_pixels(data)
+        if pixels.ndim == 2:
+            return Image.frombuffer('L', (pixels.shape[1], pixels.shape[0]), pixels, 'raw', 'L', 0, 1)
+        return Image.fromarray(pixels, 'RGB' if pixels.shape[2] == 3 else 'RGBA')
+    return Image.open(io.BytesIO(data))
+
+
+def pack_blocks(blk_list, lines=False, mask=None, mask_refined=None) -> bytes:
+    # blk_list: a TextBlockBatch or a list of TextBlock, None for no blocks
+    if blk_list is None:
+        blk_list = []
+    if not isinstance(blk_list, TextBlockBatch):
+        blk_list = TextBlockBatch.from_blocks(list(blk_list))
+    flags = (FLAG_LINES if lines else 0) | (FLAG_MASK if mask is not None else 0) \
+        | (FLAG_MASK_REFINED if mask_refined is not None else 0)
+    masks = [m for m in (mask, mask_refined) if m is not None]
+    height, width = masks[0].shape[:2] if masks else (0, 0)
+
+    parts = [
+        BLOCKS_HEADER.pack(BLOCKS_MAGIC, BLOCKS_VERSION, flags, len(blk_list.xyxy), len(blk_list.lines) if lines else 0,
+                           height, width),
+        blk_list.xyxy.astype('<i4').tobytes(),
+    ]
+    if lines:
+        parts.append(np.diff(blk_list.offsets).astype('<i4').tobytes())
+        parts.append(blk_list.lines.astype('<i4').tobytes())
+    parts.append(blk_list.vertical.astype(np.uint8).tobytes())
+    for m in masks:
+        parts.append(np.ascontiguousarray(m, np.uint8).tobytes())
+    return b''.join(parts)
+
+
+def unpack_blocks(data) -> dict:
+    # the arrays of a pack_blocks body, views into data
+    magic, version, flags, num_blks, num_lines, height, width = BLOCKS_HEADER.unpack_from(data)
+    if magic != BLOCKS_MAGIC or version != BLOCKS_VERSION:
+        raise ValueError('Not a version 1 blocks body')
+    offset = BLOCKS_HEADER.size
+
+    def take(dtype, shape):
+        nonlocal offset
+        array = np.frombuffer(data, dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+        offset += array.nbytes
+        return array
+
+    result = {'boxes': take('<i4', (num_blks, 4))}
+    if flags & FLAG_LINES:
+        result['line_counts'] = take('<i4', (num_blks,))
+        result['lines'] = take('<i4', (num_lines, 4, 2))
+    result['vertical'] = take(np.uint8, (num_blks,)).astype(bool)
+    if flags & FLAG_MASK:
+        result['mask'] = take(np.uint8, (height, width))
+    if flags & FLAG_MASK_REFINED:
+        result['mask_refined'] = take(np.uint8, (height, width))
+    return result
@@ -22,7 +22,7 @@ class MangaOcr:
         if not force_cpu and torch.cuda.is_available():
             self.model.cuda()
 
-    def __call__(self, img_or_path, boxes=[]):
+    def __call__(self, img_or_path, boxes=[], batch_size=8):
         if isinstance(img_or_path, str) or isinstance(img_or_path, Path):
             img = Image.open(img_or_path)
         elif isinstance(img_or_path, Image.Image):
@@ -33,28 +33,28 @@ class MangaOcr:
 
         img = img.convert('L').convert('RGB')
 
+        rois = [img.crop((x1, y1, x2, y2)) for x1, y1, x2, y2 in boxes]
+
         results = []
-        for idx, box in enumerate(boxes):
+        for idx in range(0, len(rois), batch_size):
             start_time = time.time()
 
-            x1, y1, x2, y2 = box
-            roi = img.crop((x1, y1, x2, y2))
-            x = self._preprocess(roi)
-            x = self.model.generate(x[None].to(
-                self.model.device), max_length=300)[0].cpu()
-            x = self.tokenizer.decode(x, skip_special_tokens=True)
-            x = post_process(x)
-            results.append(x)
+            x = self._preprocess(rois[idx: idx + batch_size])
+            with torch.no_grad():
+                x = self.model.generate(x.to(
+                    self.model.device), max_length=300).cpu()
+            x = self.tokenizer.batch_decode(x, skip_special_tokens=True)
+            results += [post_process(text) for text in x]
 
             end_time = time.time()  # <-- Measure end time
-            print(f"Runtime for Box {idx + 1}: {end_time - start_time:.4f} seconds")  # <-- Print runtime
+            print(f"Runtime for Boxes {idx + 1}-{len(results)}: {end_time - start_time:.4f} seconds")  # <-- Print runtime
 
         return results
 
-    def _preprocess(self, img):
+    def _preprocess(self, imgs):
         pixel_values = self.feature_extractor(
-            img, return_tensors="pt").pixel_values
-        return pixel_values.squeeze()
+            imgs, return_tensors="pt").pixel_values
+        return pixel_values
 
 
 def post_process(text):
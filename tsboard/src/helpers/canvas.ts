@@ -5,7 +5,7 @@ import { uid } from '../libs/uid'
 import { inferenceYoloDetection } from '../libs/inferenceOnnx'
 import { orderTextBoxes } from '../libs/manga'
 import { readFileAsBlob, restoreCanvasData, storeCanvasData, writeToFile } from '../libs/storage'
-import { inferenceMangaOcr, inferenceComicTextDetector, isIncubatorAvailable } from '../libs/incubator'
+import { inferenceMangaOcrBatch, inferenceComicTextDetector, isIncubatorAvailable } from '../libs/incubator'
 import events from '../events'
 
 const canvasState = useCanvas()
@@ -249,23 +249,22 @@ export async function ocr() {
   const blob = await readFileAsBlob(image)
   const objects = canvasState.canvas.value!.getObjects().filter((obj) => obj.get('ts')?.type == 'textbox')
 
-  const promises = []
+  if (objects.length == 0) return
 
-  for (const obj of objects) {
-    const layer = obj.get('ts') as Layer
+  const bboxes = objects.map((obj) => {
     const bbox = extractBBox(obj)
+    return [bbox.left, bbox.top, bbox.width, bbox.height]
+  })
+  const texts = await inferenceMangaOcrBatch(blob, bboxes)
 
-    const promise = inferenceMangaOcr(blob, [bbox.left, bbox.top, bbox.width, bbox.height]).then((text) => {
-      layer.textbox!.text = text
-      layer.name = text
-      obj.set('ts', layer)
-      events.emit('canvas:ocr')
-    })
-
-    promises.push(promise)
+  for (const [i, obj] of objects.entries()) {
+    const layer = obj.get('ts') as Layer
+    layer.textbox!.text = texts[i]
+    layer.name = texts[i]
+    obj.set('ts', layer)
   }
 
-  await Promise.all(promises)
+  events.emit('canvas:ocr')
   await storeCanvas()
 }
 